@@ -0,0 +1,72 @@
+'''
+    Shared setup for the benchmark scripts: a throwaway database file and
+    a synthetic dataset of a chosen size, built through the same
+    create_app(test_config) factory and init_db the tests use.
+'''
+import os
+import random
+import sys
+import tempfile
+from contextlib import contextmanager
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flaskr import create_app
+from flaskr.blog import make_excerpt
+from flaskr.db import get_db, init_db
+from flaskr.hashing import hash_password
+
+# the user the benchmarks log in as, it's always user 1
+USERNAME = 'bench'
+PASSWORD = 'bench'
+
+
+@contextmanager
+def temp_database():
+    fd, database = tempfile.mkstemp(suffix='.sqlite')
+    os.close(fd)
+
+    try:
+        yield database
+    finally:
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(database + suffix):
+                os.unlink(database + suffix)
+
+def make_app(database, **config):
+    return create_app(dict({'TESTING': True, 'DATABASE': database}, **config))
+
+def seed(database, users=10, posts=1000, body_size=500, seed=0):
+    '''
+        Creates the bench user plus users - 1 others, and posts spread
+        over all of them with bodies of body_size characters on average.
+        Only the bench user gets a real password hash, since hashing is
+        slow and nobody else logs in.
+    '''
+    rng = random.Random(seed)
+    app = make_app(database)
+
+    with app.app_context():
+        init_db()
+        db = get_db()
+        db.execute(
+            'INSERT INTO user (username, password) VALUES (?, ?)',
+            (USERNAME, hash_password(PASSWORD))
+        )
+        db.executemany(
+            "INSERT INTO user (username, password) VALUES (?, 'x')",
+            ((f'user{i}',) for i in range(2, users + 1))
+        )
+        bodies = (
+            'x' * max(1, int(rng.gauss(body_size, body_size / 4)))
+            for _ in range(posts)
+        )
+        db.executemany(
+            'INSERT INTO post'
+            ' (title, excerpt, body_length, body, author_id, created)'
+            " VALUES (?, ?, ?, ?, ?, datetime('2018-01-01', ? || ' seconds'))",
+            ((f'post {i}', make_excerpt(body), len(body), body,
+              rng.randint(1, users), i)
+             for i, body in enumerate(bodies))
+        )
+        db.commit()
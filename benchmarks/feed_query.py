@@ -0,0 +1,88 @@
+'''
+    Times the index and single post queries reading the username stored
+    on each post, against the same queries joining user for it as they
+    used to:
+
+        python benchmarks/feed_query.py --posts 1000000 --users 1000
+
+    Pages are read from random points in the feed, each query --runs
+    times with a warm cache, and the median is reported.
+'''
+import argparse
+import random
+import statistics
+import time
+
+from dataset import make_app, seed, temp_database
+
+from flaskr.blog import LIST_SELECT, POST_SELECT
+from flaskr.db import get_db
+
+
+JOIN = ' FROM post p JOIN user u ON p.author_id = u.id'
+
+def joined(query):
+    # the same columns, with username from user instead of post
+    return query.replace('username', 'u.username').replace(' FROM post p', JOIN)
+
+def queries():
+    page = ' WHERE (created, p.id) < (?, ?) ORDER BY created DESC, p.id DESC LIMIT ?'
+    return {
+        'index page': (LIST_SELECT + page, joined(LIST_SELECT) + page),
+        'single post': (POST_SELECT + ' WHERE p.id = ?', joined(POST_SELECT) + ' WHERE p.id = ?'),
+    }
+
+def time_query(db, sql, params):
+    start = time.perf_counter()
+    db.execute(sql, params).fetchall()
+    return time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument('--posts', type=int, default=1000000)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--body-size', type=int, default=200)
+    parser.add_argument('--page-size', type=int, default=20)
+    parser.add_argument('--runs', type=int, default=2000)
+    args = parser.parse_args()
+
+    with temp_database() as database:
+        start = time.perf_counter()
+        seed(database, users=args.users, posts=args.posts, body_size=args.body_size)
+        print(f'seeded {args.posts} posts in {time.perf_counter() - start:.0f}s')
+
+        app = make_app(database)
+        rng = random.Random(0)
+
+        with app.app_context():
+            db = get_db()
+            cursors = db.execute(
+                'SELECT created, id FROM post ORDER BY random() LIMIT ?',
+                (args.runs,)
+            ).fetchall()
+            params = {
+                'index page': [(c['created'], c['id'], args.page_size) for c in cursors],
+                'single post': [(rng.randint(1, args.posts),) for _ in range(args.runs)],
+            }
+
+            for name, (stored, join) in queries().items():
+                results = {}
+
+                # alternate the two so neither gets a warmer cache
+                for label, sql in (('stored', stored), ('join', join)) * 2:
+                    results[label] = [
+                        time_query(db, sql, p) for p in params[name]
+                    ]
+
+                stored_us = statistics.median(results['stored']) * 1e6
+                join_us = statistics.median(results['join']) * 1e6
+                print(
+                    f'{name}: stored username {stored_us:.1f}us,'
+                    f' join {join_us:.1f}us ({join_us / stored_us:.2f}x)'
+                )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,247 @@
+'''
+    Load test of the main endpoints, for sizing and for catching
+    performance regressions between changes.
+
+    A synthetic dataset is seeded into a temporary database, then each
+    scenario is run for --requests requests, through Flask's test client
+    (app cost only) and against a local threaded WSGI server over HTTP
+    (adds the server and network stack). Throughput and p50/p95/p99
+    latency are saved as JSON, and --compare prints the change from an
+    earlier results file:
+
+        python benchmarks/load_test.py --posts 100000 -o before.json
+        python benchmarks/load_test.py --posts 100000 -o after.json --compare before.json
+'''
+import argparse
+import http.client
+import json
+import os
+import platform
+import sqlite3
+import sys
+import threading
+import time
+from urllib.parse import urlencode
+
+from dataset import PASSWORD, USERNAME, make_app, seed, temp_database
+from werkzeug.serving import WSGIRequestHandler, make_server
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'tests')
+)
+from conftest import AuthActions
+
+from flaskr.db import get_db
+
+
+'''
+    A scenario is (name, method, path). Paths with {id} are filled in with
+    posts owned by the bench user. update cycles through them, delete uses
+    each one once so it always has something to delete.
+'''
+SCENARIOS = (
+    ('index', 'GET', '/'),
+    ('login', 'POST', '/auth/login'),
+    ('create', 'POST', '/create'),
+    ('update', 'POST', '/{id}/update'),
+    ('delete', 'POST', '/{id}/delete'),
+)
+
+def form_for(name):
+    if name == 'login':
+        return {'username': USERNAME, 'password': PASSWORD}
+
+    if name in ('create', 'update'):
+        return {'title': 'benchmark', 'body': 'x' * 500}
+
+    return {}
+
+def own_post_ids(app):
+    with app.app_context():
+        return [row[0] for row in get_db().execute(
+            'SELECT id FROM post WHERE author_id = 1 ORDER BY id'
+        )]
+
+def percentile(sorted_values, p):
+    index = min(len(sorted_values) - 1, int(round(p / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+def summarize(latencies, elapsed):
+    latencies = sorted(latencies)
+
+    return {
+        'requests': len(latencies),
+        'throughput_rps': round(len(latencies) / elapsed, 2),
+        'mean_ms': round(sum(latencies) / len(latencies) * 1000, 3),
+        'p50_ms': round(percentile(latencies, 50) * 1000, 3),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 3),
+    }
+
+
+class TestClientTransport(object):
+    name = 'test_client'
+
+    def __init__(self, app):
+        self.client = app.test_client()
+        AuthActions(self.client).login(USERNAME, PASSWORD)
+
+    def request(self, method, path, form):
+        response = self.client.open(path, method=method, data=form)
+        assert response.status_code < 400, (path, response.status_code)
+
+    def close(self):
+        pass
+
+
+class QuietHandler(WSGIRequestHandler):
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+class HTTPTransport(object):
+    '''
+        Runs the app in a threaded werkzeug server on a free local port and
+        talks to it over one keep-alive connection.
+    '''
+    name = 'wsgi_server'
+
+    def __init__(self, app):
+        self.server = make_server(
+            '127.0.0.1', 0, app, threaded=True, request_handler=QuietHandler
+        )
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+        self.conn = http.client.HTTPConnection('127.0.0.1', self.server.port)
+        self.cookie = None
+        self.request('POST', '/auth/login', form_for('login'))
+
+    def request(self, method, path, form):
+        headers = {'Cookie': self.cookie} if self.cookie else {}
+        body = None
+
+        if method == 'POST':
+            body = urlencode(form)
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+
+        self.conn.request(method, path, body=body, headers=headers)
+        response = self.conn.getresponse()
+        response.read()
+        assert response.status < 400, (path, response.status)
+
+        cookie = response.getheader('Set-Cookie')
+        if cookie:
+            self.cookie = cookie.split(';', 1)[0]
+
+    def close(self):
+        self.conn.close()
+        self.server.shutdown()
+
+
+def run_scenario(transport, name, method, path, requests, post_ids):
+    form = form_for(name)
+    latencies = []
+    start = time.perf_counter()
+
+    for i in range(requests):
+        target = path.format(id=post_ids[i % len(post_ids)]) if post_ids else path
+        t = time.perf_counter()
+        transport.request(method, target, form)
+        latencies.append(time.perf_counter() - t)
+
+    return summarize(latencies, time.perf_counter() - start)
+
+def run(args, database):
+    app = make_app(database, **args.config)
+    results = {}
+
+    for transport_class in (TestClientTransport, HTTPTransport):
+        transport = transport_class(app)
+        results[transport.name] = {}
+
+        try:
+            for name, method, path in SCENARIOS:
+                if args.only and name not in args.only:
+                    continue
+
+                count = args.login_requests if name == 'login' else args.requests
+                post_ids = own_post_ids(app) if '{id}' in path else None
+
+                if name == 'delete' and len(post_ids) < count:
+                    sys.exit(f'Not enough posts by {USERNAME} for {count} '
+                             f'deletes, seed more with --posts.')
+
+                results[transport.name][name] = run_scenario(
+                    transport, name, method, path, count, post_ids
+                )
+                print(transport.name, name, results[transport.name][name],
+                      file=sys.stderr)
+        finally:
+            transport.close()
+
+    return results
+
+def compare(current, previous):
+    for transport, scenarios in current.items():
+        for name, stats in scenarios.items():
+            before = previous.get(transport, {}).get(name)
+
+            if before is None:
+                continue
+
+            changes = ', '.join(
+                f'{key} {(stats[key] - before[key]) / before[key] * 100:+.1f}%'
+                for key in ('throughput_rps', 'p50_ms', 'p95_ms', 'p99_ms')
+                if before[key]
+            )
+            print(f'{transport} {name}: {changes}')
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--posts', type=int, default=10000)
+    parser.add_argument('--body-size', type=int, default=500)
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--login-requests', type=int, default=20,
+                        help='login is much slower, so it runs fewer times')
+    parser.add_argument('--only', nargs='*', choices=[s[0] for s in SCENARIOS])
+    parser.add_argument('--config', type=json.loads, default={},
+                        help='extra app config as JSON, e.g. {"DB_POOL_SIZE": 4}')
+    parser.add_argument('-o', '--output', default='bench_results.json')
+    parser.add_argument('--compare', help='an earlier results file')
+    args = parser.parse_args()
+
+    with temp_database() as database:
+        seed(database, users=args.users, posts=args.posts,
+             body_size=args.body_size)
+        results = run(args, database)
+
+    report = {
+        'dataset': {
+            'users': args.users,
+            'posts': args.posts,
+            'body_size': args.body_size,
+        },
+        'config': args.config,
+        'environment': {
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'platform': platform.platform(),
+        },
+        'results': results,
+    }
+
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f)['results'])
+
+
+if __name__ == '__main__':
+    main()
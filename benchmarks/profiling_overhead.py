@@ -0,0 +1,59 @@
+'''
+    Measures what PROFILING=True costs on the index, logged in, by timing
+    the same requests through the test client with profiling off and on.
+    The two alternate in short rounds and the medians are compared, so
+    drift and bursts of other load on the machine affect both equally
+    instead of landing on whichever was running at the time:
+
+        python benchmarks/profiling_overhead.py --rounds 500
+'''
+import argparse
+import statistics
+import time
+
+from dataset import PASSWORD, USERNAME, make_app, seed, temp_database
+
+
+def make_client(database, profiling):
+    client = make_app(database, PROFILING=profiling).test_client()
+    client.post('/auth/login', data={'username': USERNAME, 'password': PASSWORD})
+    return client
+
+def run(client, requests):
+    start = time.perf_counter()
+
+    for _ in range(requests):
+        client.get('/')
+
+    return (time.perf_counter() - start) / requests
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--requests', type=int, default=10,
+                        help='requests per round')
+    parser.add_argument('--rounds', type=int, default=300)
+    parser.add_argument('--posts', type=int, default=1000)
+    args = parser.parse_args()
+
+    with temp_database() as database:
+        seed(database, users=1, posts=args.posts)
+        clients = {False: make_client(database, False),
+                   True: make_client(database, True)}
+        results = {False: [], True: []}
+
+        for client in clients.values():
+            run(client, 50)
+
+        for _ in range(args.rounds):
+            for profiling, client in clients.items():
+                results[profiling].append(run(client, args.requests))
+
+        off = statistics.median(results[False])
+        on = statistics.median(results[True])
+        print(f'profiling off: {off * 1000:.3f} ms/request')
+        print(f'profiling on:  {on * 1000:.3f} ms/request')
+        print(f'overhead:      {(on - off) / off * 100:+.2f}%')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+'''
+    Measures a worker's cold start: importing flaskr, create_app, and the
+    first request to the index, each in a fresh Python process so nothing
+    is already imported or compiled.
+
+    Each bytecode cache setting is run --runs times, with the filesystem
+    cache both empty and filled by precompile-templates first:
+
+        python benchmarks/startup.py --runs 20
+'''
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+
+SETTINGS = (
+    ('no cache', None, False),
+    ('filesystem, empty', 'filesystem', False),
+    ('filesystem, precompiled', 'filesystem', True),
+)
+
+def child(config):
+    '''
+        Runs in the fresh process and prints the timings as JSON.
+    '''
+    start = time.perf_counter()
+    from flaskr import create_app
+    imported = time.perf_counter()
+
+    app = create_app(config)
+    created = time.perf_counter()
+
+    response = app.test_client().get('/')
+    assert response.status_code == 200
+    responded = time.perf_counter()
+
+    print(json.dumps({
+        'import_ms': (imported - start) * 1000,
+        'create_app_ms': (created - imported) * 1000,
+        'first_response_ms': (responded - created) * 1000,
+        'total_ms': (responded - start) * 1000,
+    }))
+
+def run_child(config):
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    output = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), '--child', json.dumps(config)],
+        check=True, capture_output=True, text=True,
+        env=dict(os.environ, PYTHONPATH=root),
+    ).stdout
+    return json.loads(output.splitlines()[-1])
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--posts', type=int, default=100)
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        return child(json.loads(args.child))
+
+    # imported here, it imports flaskr, which the child has to time itself
+    from dataset import make_app, seed, temp_database
+
+    with temp_database() as database:
+        seed(database, users=1, posts=args.posts)
+        cache_dir = tempfile.mkdtemp()
+
+        try:
+            for name, kind, precompile in SETTINGS:
+                config = {
+                    'TESTING': True,
+                    'DATABASE': database,
+                    'TEMPLATE_BYTECODE_CACHE': kind,
+                    'TEMPLATE_BYTECODE_CACHE_DIR': cache_dir,
+                }
+                runs = []
+
+                for _ in range(args.runs):
+                    shutil.rmtree(cache_dir)
+                    os.mkdir(cache_dir)
+
+                    if precompile:
+                        app = make_app(database, **config)
+                        app.test_cli_runner().invoke(args=['precompile-templates'])
+
+                    runs.append(run_child(config))
+
+                print(f'{name}:', ', '.join(
+                    f'{key} {statistics.median(run[key] for run in runs):.1f}'
+                    for key in runs[0]
+                ))
+        finally:
+            shutil.rmtree(cache_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+'''
+    Compares peak memory and time to first byte of listing every post with
+    the streaming /all view against the old fetchall() + render_template()
+    path the index used to take.
+
+    Each path runs in its own process so the peak RSS of one doesn't hide
+    the other's:
+
+        python benchmarks/stream_memory.py --posts 200000 --body-size 2000
+'''
+import argparse
+import json
+import resource
+import subprocess
+import sys
+import time
+
+from dataset import make_app, seed, temp_database
+from flask import render_template
+
+from flaskr.blog import LIST_SELECT, render_post_fragment
+from flaskr.db import get_db
+
+
+def peak_rss_kb():
+    # ru_maxrss is in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def run_fetchall(app):
+    start = time.perf_counter()
+
+    with app.test_request_context('/'):
+        app.preprocess_request()
+        rows = get_db().execute(
+            LIST_SELECT + ' ORDER BY created DESC, p.id DESC'
+        ).fetchall()
+        posts = [(post, render_post_fragment(post, cached=False)) for post in rows]
+        html = render_template('blog/index.html', page=None, posts=posts)
+        # nothing can be sent until the whole page exists
+        first_byte = time.perf_counter() - start
+        size = len(html.encode())
+
+    return first_byte, time.perf_counter() - start, size
+
+def run_stream(app):
+    start = time.perf_counter()
+    first_byte = None
+    size = 0
+
+    response = app.test_client().get('/all', buffered=False)
+
+    for chunk in response.iter_encoded():
+        if first_byte is None:
+            first_byte = time.perf_counter() - start
+        size += len(chunk)
+
+    response.close()
+    return first_byte, time.perf_counter() - start, size
+
+def child(mode, database):
+    app = make_app(database)
+    baseline = peak_rss_kb()
+    first_byte, total, size = (run_stream if mode == 'stream' else run_fetchall)(app)
+
+    print(json.dumps({
+        'mode': mode,
+        'baseline_rss_kb': baseline,
+        'peak_rss_kb': peak_rss_kb(),
+        'time_to_first_byte_s': round(first_byte, 4),
+        'total_s': round(total, 4),
+        'bytes': size,
+    }))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--posts', type=int, default=50000)
+    parser.add_argument('--body-size', type=int, default=1000)
+    parser.add_argument('--child', choices=('stream', 'fetchall'))
+    parser.add_argument('--database')
+    args = parser.parse_args()
+
+    if args.child:
+        return child(args.child, args.database)
+
+    with temp_database() as database:
+        seed(database, users=1, posts=args.posts, body_size=args.body_size)
+
+        for mode in ('fetchall', 'stream'):
+            subprocess.run(
+                [sys.executable, __file__, '--child', mode, '--database', database],
+                check=True,
+            )
+
+
+if __name__ == '__main__':
+    main()
@@ -18,11 +18,49 @@ def create_app(test_config=None):
         and the database file.
     
     '''
-    print("NAME!:" , __name__)
-
     app.config.from_mapping(
         SECRET_KEY='DEV',
         DATABASE=os.path.join(app.instance_path, 'flaskr.sqlite'),
+        POSTS_PER_PAGE=20,
+        DB_READ_ROUTING=False,
+        DATABASE_REPLICA=None,
+        DATABASE_SHARDS=None,
+        SHARD_BUCKETS=64,
+        DB_POOL_SIZE=0,
+        DB_POOL_MAX_LIFETIME=3600,
+        DB_POOL_PRE_PING=True,
+        USER_CACHE_SIZE=1024,
+        USER_CACHE_TTL=60,
+        POST_FRAGMENT_CACHE_SIZE=4096,
+        CACHE_COHERENCE=False,
+        PASSWORD_HASH_METHOD='pbkdf2:sha256:260000',
+        PASSWORD_SALT_LENGTH=16,
+        PASSWORD_HASH_WORKERS=2,
+        PASSWORD_HASH_QUEUE_LIMIT=32,
+        PROFILING=False,
+        SLOW_QUERY_THRESHOLD=None,
+        N_PLUS_ONE_THRESHOLD=None,
+        ASYNC_VIEWS=False,
+        ASGI_WORKERS=10,
+        BODY_COMPRESSION_THRESHOLD=None,
+        BODY_COMPRESSION_LEVEL=6,
+        BODY_COMPRESSION_DICT=False,
+        SESSION_BACKEND=None,
+        SESSION_CACHE_SIZE=10000,
+        SESSION_SWEEP_INTERVAL=300,
+        TEMPLATE_BYTECODE_CACHE=None,
+        TEMPLATE_BYTECODE_CACHE_DIR=None,
+        WRITE_BATCH_WINDOW=None,
+        WRITE_BATCH_MAX=64,
+        WRITE_BATCH_TIMEOUT=30,
+        DB_PRAGMAS={
+            'journal_mode': 'WAL',
+            'synchronous': 'NORMAL',
+            'cache_size': -16000,
+            'mmap_size': 64 * 1024 * 1024,
+            'temp_store': 'MEMORY',
+            'busy_timeout': 5000,
+        },
     )
 
     '''
@@ -33,6 +71,43 @@ def create_app(test_config=None):
         DATABASE is the path where the SQLite db file will be saved.
         it's under app.instance_path, which is the path that Flask has
         chosen for the instance folder. 
+
+        DATABASE_SHARDS is a list of database files to spread posts over,
+        SHARD_BUCKETS how many buckets they're split into (see
+        flaskr.shards). None keeps posts in DATABASE.
+
+        POSTS_PER_PAGE is how many posts the index shows before linking
+        to the next page.
+
+        DB_READ_ROUTING sends reads to a separate read-only connection,
+        opened on DATABASE_REPLICA instead when that's set (see flaskr.db).
+
+        DB_POOL_SIZE is how many idle database connections are kept
+        between requests. 0 opens a fresh connection for every request.
+
+        DB_PRAGMAS is the PRAGMA profile run on every new connection.
+        cache_size is negative so it's in KiB (16MB) rather than pages.
+
+        CACHE_COHERENCE checks table_version at the start of each request
+        so in-process caches drop what other workers have changed (see
+        flaskr.db).
+
+        WRITE_BATCH_WINDOW turns on group commit, see flaskr.writer.
+        0.002 (2ms) is a reasonable start.
+
+        TEMPLATE_BYTECODE_CACHE keeps compiled templates between workers,
+        'filesystem' is the only kind (see flaskr.templating).
+
+        SESSION_BACKEND keeps sessions on the server instead of in the
+        cookie, 'memory' or 'sqlite' (see flaskr.sessions).
+
+        BODY_COMPRESSION_THRESHOLD compresses post bodies longer than it,
+        see flaskr.compression.
+
+        ASYNC_VIEWS swaps the main views for the async ones in flaskr.aio.
+
+        ASGI_WORKERS is how many requests flaskr.asgi runs at once, each
+        on its own thread.
     '''
 
 
@@ -54,17 +129,9 @@ def create_app(test_config=None):
     else:
         #load the test config if passed in
         app.config.from_mapping(test_config)
-    
-    #esnure the instance folder exists
-    '''
-        this ensures that app.instance_path exists. Flask doesn't create
-        the instance folder automatically, but it needs to be created because
-        the project will create the SQLite db file there
-    '''
-    try:
-        os.makedirs(app.instance_path)
-    except OSError:
-        pass
+
+    #the instance folder is created by init_db, when the SQLite db file
+    #is first created there, rather than on every start
 
     #a simple page that says hello
     '''
@@ -72,14 +139,47 @@ def create_app(test_config=None):
         working before developing any further. It creates a connection
         between the URL /hello and a function that returns a response
     '''
+    from .auth import skip_user_load
+
     @app.route('/hello')
+    @skip_user_load
     def hello():
         return 'Hello, World!'
 
+    #template bytecode cache, this has to come before anything
+    #creates app.jinja_env
+    from . import templating
+    templating.init_app(app)
+
+    #the body codec comes first, every db connection uses it
+    from . import compression
+    compression.init_app(app)
+
     #register the db with the application
     from . import db 
     db.init_app(app)
 
+    #opt in group commit for writes
+    from . import writer
+    writer.init_app(app)
+
+    #opt in sharding of posts over several database files
+    from . import shards
+    shards.init_app(app)
+
+    #opt in server side sessions
+    from . import sessions
+    sessions.init_app(app)
+
+    #set up the password hashing worker pool
+    from . import hashing
+    hashing.init_app(app)
+
+    #opt in request timing, this has to come before the auth blueprint
+    #so the timer is running when load_logged_in_user is
+    from . import profiling
+    profiling.init_app(app)
+
     #register the auth blueprint with the application
     from .import auth
     app.register_blueprint(auth.bp)
@@ -90,4 +190,33 @@ def create_app(test_config=None):
     app.register_blueprint(blog.bp)
     app.add_url_rule('/', endpoint='index')
 
-    return app
\ No newline at end of file
+    #opt in async views, these replace the blueprint views so they have
+    #to come after the blueprints are registered
+    from . import aio
+    aio.init_app(app)
+
+    return app
+
+def close_app(app):
+    '''
+        Stops what an app keeps running between requests: the group
+        commit writer threads, the pooled connections and the password
+        hashing workers. A server keeps its app until the process exits,
+        this is for tests and scripts that create apps and then are done
+        with them. The writers go first, so their last batches are
+        committed before anything else is closed.
+    '''
+    writers = [app.extensions.get('flaskr.writer')]
+    writers += app.extensions.get('flaskr.shard_writers', [])
+
+    pools = [
+        app.extensions.get('flaskr.db_pool'),
+        app.extensions.get('flaskr.db_read_pool'),
+    ]
+    pools += app.extensions.get('flaskr.shard_pools', [])
+
+    for resource in writers + pools:
+        if resource is not None:
+            resource.close()
+
+    app.extensions['flaskr.hasher'].shutdown()
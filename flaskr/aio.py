@@ -0,0 +1,90 @@
+import asyncio
+import functools
+
+from flaskr.db import get_db
+from flaskr.writer import write
+
+
+'''
+    The optional async mode, turned on with ASYNC_VIEWS=True (it needs
+    Flask's async extra, pip install flaskr[async]).
+
+    It swaps the main blog and auth views for async endpoints generated
+    from the sync ones: each runs the sync view in a worker thread and
+    awaits it, so the view itself, its SQLite calls and its password
+    hashing never block the event loop. asyncio.to_thread copies the
+    context over, so request, g and session work the same in there, and
+    the views keep a single implementation.
+
+    That doesn't let a thread serve more than one request. Flask is a
+    WSGI app and runs each async view to completion from the request's
+    thread, which waits on it the whole time, under a WSGI server and
+    under flaskr.asgi alike. flaskr.asgi runs each request on a thread of
+    its own, so requests overlap as they do on a threaded WSGI server,
+    and no more than that. The sync views stay the default.
+
+    AsyncConnection, get_async_db and write_async are for async code of
+    its own that needs the database.
+'''
+
+class AsyncConnection(object):
+    '''
+        Wraps the connection from get_db so every call runs in a thread.
+        asyncio.to_thread copies the context over, so g and current_app
+        (and the statement hooks that use them) still work in there.
+    '''
+    def __init__(self, db):
+        self.db = db
+
+    async def execute(self, sql, parameters=()):
+        return await asyncio.to_thread(self.db.execute, sql, parameters)
+
+    async def fetchone(self, sql, parameters=()):
+        return await asyncio.to_thread(
+            lambda: self.db.execute(sql, parameters).fetchone()
+        )
+
+    async def fetchall(self, sql, parameters=()):
+        return await asyncio.to_thread(
+            lambda: self.db.execute(sql, parameters).fetchall()
+        )
+
+    async def commit(self):
+        await asyncio.to_thread(self.db.commit)
+
+async def get_async_db():
+    # connecting is blocking too, so that also happens in a thread
+    return AsyncConnection(await asyncio.to_thread(get_db))
+
+async def write_async(sql, parameters=(), shard=None):
+    return await asyncio.to_thread(write, sql, parameters, shard)
+
+
+def async_view(view):
+    # an async endpoint that runs the sync view in a worker thread
+    @functools.wraps(view)
+    async def run_in_thread(*args, **kwargs):
+        return await asyncio.to_thread(view, *args, **kwargs)
+
+    return run_in_thread
+
+
+ASYNC_VIEWS = (
+    'blog.index',
+    'blog.create',
+    'blog.update',
+    'blog.delete',
+    'auth.register',
+    'auth.login',
+)
+
+def init_app(app):
+    '''
+        Runs after the blueprints are registered, replacing the sync view
+        for each endpoint above. URLs and endpoint names stay the same.
+    '''
+    if not app.config['ASYNC_VIEWS']:
+        return
+
+    for endpoint in ASYNC_VIEWS:
+        app.view_functions[endpoint] = async_view(app.view_functions[endpoint])
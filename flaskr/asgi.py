@@ -0,0 +1,21 @@
+from a2wsgi import WSGIMiddleware
+
+from flaskr import create_app
+
+
+'''
+    An ASGI entry point, for serving flaskr with an ASGI server (it needs
+    a2wsgi, pip install flaskr[asgi]):
+
+        uvicorn --factory flaskr.asgi:create_asgi_app
+
+    Flask itself is still a WSGI app, so each request runs from start to
+    finish in a worker thread, with the calls adapted to ASGI by a2wsgi's
+    WSGIMiddleware. It gives each request a thread of its own from a pool
+    of ASGI_WORKERS, so up to that many requests overlap, the way they do
+    on a threaded WSGI server. Set ASYNC_VIEWS=True in the instance config
+    to use the async views as well.
+'''
+def create_asgi_app(test_config=None):
+    app = create_app(test_config)
+    return WSGIMiddleware(app, workers=app.config['ASGI_WORKERS'])
@@ -1,13 +1,16 @@
 import functools
+import sqlite3
 
 from flask import (
-    Blueprint, flash, g, redirect, render_template, request,
+    Blueprint, current_app, flash, g, redirect, render_template, request,
     session, url_for
 )
 
-from werkzeug.security import check_password_hash, generate_password_hash
-
-from flaskr.db import get_db
+from flaskr.cache import LRUCache
+from flaskr.db import get_db, get_invalidation_hooks
+from flaskr.hashing import hash_password, needs_rehash, verify_password
+from flaskr.profiling import phase
+from flaskr.writer import write
 
 bp = Blueprint('auth', __name__ , url_prefix='/auth')
 
@@ -47,7 +50,6 @@ def register():
     if request.method == 'POST':
         username = request.form['username']
         password = request.form['password']
-        db = get_db()
         error = None
 
         if not username:
@@ -57,14 +59,14 @@ def register():
         
         if error is None:
             try:
-                db.execute(
+                # The query modifies data, write() commits it to save
+                # the changes
+                user_id = write(
                     "INSERT INTO user (username, password) VALUES (?, ?)",
-                    (username, generate_password_hash(password))
+                    (username, hash_password(password))
                 )
-                # The query modifies data, db.commit() is called to save
-                # the changes
-                db.commit()
-            except db.IntegrityError:
+                invalidate_user(user_id)
+            except sqlite3.IntegrityError:
                 error = f"Users {username} is already registered."
             else:
                 return redirect(url_for("auth.login"))
@@ -81,8 +83,9 @@ def login():
         fetchone() returns one row from the query. None is returned if there
         are no results.
 
-        check_password_hash() hashes the submitted password in the same way as 
-        stored and compares them.
+        verify_password() hashes the submitted password in the same way as 
+        stored and compares them. The hashing runs in flaskr.hashing's
+        worker pool so it doesn't tie up this thread's CPU.
 
         session is a duct that stores data across reqeusts. When validation 
         succeeds, the user's id is stored in a new sesion. The data is stored 
@@ -102,10 +105,20 @@ def login():
 
         if user is None:
             error = 'Incorrect username.'
-        elif not check_password_hash(user['password'], password):
+        elif not verify_password(user['password'], password):
             error = 'Incorrect password.'
     
         if error is None:
+            # the password is known to be right at this point, so hashes
+            # made with an older method or cost are upgraded to the
+            # configured one while it's available
+            if needs_rehash(user['password']):
+                write(
+                    'UPDATE user SET password = ? WHERE id = ?',
+                    (hash_password(password), user['id'])
+                )
+                invalidate_user(user['id'])
+
             session.clear()
             #store user_id in the sesson, it will now be available on
             #subsequent requests. 
@@ -118,6 +131,65 @@ def login():
     return render_template('auth/login.html')
 
 
+'''
+    Users are cached in process by id so an authenticated request doesn't
+    have to query the user table before every view. The cache is created
+    when the blueprint is registered, sized by USER_CACHE_SIZE (0 turns
+    it off) with entries expiring after USER_CACHE_TTL seconds. Anything
+    that changes a user row must call invalidate_user. With CACHE_COHERENCE
+    on, the cache is also emptied when another worker (or anything else)
+    changes the user table.
+'''
+@bp.record_once
+def setup_user_cache(state):
+    config = state.app.config
+
+    if config['USER_CACHE_SIZE'] > 0:
+        cache = LRUCache(config['USER_CACHE_SIZE'], ttl=config['USER_CACHE_TTL'])
+        state.app.extensions['flaskr.user_cache'] = cache
+        get_invalidation_hooks('user', state.app).append(lambda name: cache.clear())
+
+def get_user_cache():
+    return current_app.extensions.get('flaskr.user_cache')
+
+def get_user(id):
+    cache = get_user_cache()
+    user = cache.get(id) if cache is not None else None
+
+    if user is None:
+        user = get_db().execute(
+            'SELECT * FROM user WHERE id = ?', (id,)
+        ).fetchone()
+
+        if user is not None and cache is not None:
+            cache.set(id, user)
+
+    return user
+
+def invalidate_user(id):
+    cache = get_user_cache()
+
+    if cache is not None:
+        cache.delete(id)
+
+
+'''
+    Views that never look at g.user can be marked with skip_user_load so
+    the lookup doesn't happen at all for them. Static files are always
+    skipped.
+'''
+def skip_user_load(view):
+    view.skip_user_load = True
+    return view
+
+def _skips_user_load(endpoint):
+    if endpoint is None or endpoint == 'static' or endpoint.endswith('.static'):
+        return True
+
+    view = current_app.view_functions.get(endpoint)
+    return getattr(view, 'skip_user_load', False)
+
+
 '''
     bp.before_app_request() registers a function that runs before the view
     function, no matter what URL is requested.
@@ -126,17 +198,16 @@ def login():
 def load_logged_in_user():
     ''' 
         load_logged_in_user checks if a user id is stored in the session and 
-        gets that user's data from the database, storing it on g.user, which
-        lasts for the length of the request.
+        gets that user's data from the cache or the database, storing it on
+        g.user, which lasts for the length of the request.
     '''
     user_id = session.get('user_id')
 
-    if user_id is None:
+    if user_id is None or _skips_user_load(request.endpoint):
         g.user = None
     else:
-        g.user = get_db().execute(
-            'SELECT * FROM user WHERE id = ?', (user_id,)
-        ).fetchone()
+        with phase('user_load'):
+            g.user = get_user(user_id)
 
 
 
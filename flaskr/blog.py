@@ -1,24 +1,427 @@
+from collections import namedtuple
+from datetime import datetime
+from itertools import islice
+
+import click
 from flask import (
-    Blueprint, flash, g, redirect, render_template,
-    request, url_for
+    Blueprint, current_app, flash, g, make_response, redirect,
+    render_template, request, session, stream_with_context, url_for
 )
-
+from flask.cli import with_appcontext
+from markupsafe import Markup, escape
 from werkzeug.exceptions import abort
+from werkzeug.http import is_resource_modified
 
 from flaskr.auth import login_required
-from flaskr.db import get_db
+from flaskr.cache import LRUCache
+from flaskr.compression import StoredPost, add_body_z, compress_body
+from flaskr.db import get_db, get_post_dbs, get_table_version
+from flaskr.shards import (
+    author_shard, get_post_shards, merge_posts, new_post_id, owned_posts,
+    post_shard, shard_db
+)
+from flaskr.writer import write
 
 bp = Blueprint('blog', __name__)
 
+POST_SELECT = (
+    'SELECT p.id, title, body, body_z, created, author_id, username, version'
+    ' FROM post p'
+)
+
+'''
+    Listings (the index, author pages and /all) show an excerpt of each
+    post, linking to the post's own page for the full body. The excerpt
+    and the body's length are stored with the post when it's written, so
+    LIST_SELECT never reads body. Rows written some other way, like the
+    test data or an import, have no excerpt until backfill-excerpts is
+    run, and fall back to cutting one from the body in the query.
+'''
+EXCERPT_LENGTH = 300
+
+LIST_SELECT = (
+    'SELECT p.id, title, created, author_id, username, version,'
+    f' COALESCE(excerpt, substr(body_text(body, body_z), 1, {EXCERPT_LENGTH}))'
+    ' AS excerpt,'
+    ' COALESCE(body_length, length(body_text(body, body_z))) AS body_length'
+    ' FROM post p'
+)
+
+def make_excerpt(body):
+    '''
+        The start of body, cut at a space where there's one in the second
+        half, with an ellipsis added. It's always shorter than the body
+        it came from, which is how templates tell it was cut.
+    '''
+    if len(body) <= EXCERPT_LENGTH:
+        return body
+
+    excerpt = body[:EXCERPT_LENGTH - 1]
+    space = excerpt.rfind(' ')
+
+    if space > EXCERPT_LENGTH // 2:
+        excerpt = excerpt[:space]
+
+    return excerpt.rstrip() + '…'
+
+def body_columns(body):
+    '''
+        The (excerpt, body_length, body, body_z) values to store for a
+        post's body, compressed if it's long enough (see flaskr.compression).
+    '''
+    stored, body_z = compress_body(get_db(), body)
+    return make_excerpt(body), len(body), stored, body_z
+
+Page = namedtuple('Page', 'posts next_cursor prev_cursor')
+
+
+'''
+    Posts are paged with a keyset (cursor) instead of OFFSET or fetchall().
+    A cursor is the (created, id) pair of the last post a page showed, so
+    the next page is just "posts ordered before this pair", which the
+    post_created_id index answers without reading any of the skipped rows.
+    id breaks ties between posts created in the same second.
+'''
+
+def encode_cursor(post):
+    return f"{post['created']},{post['id']}"
+
+def decode_cursor(cursor):
+    created, _, id = cursor.rpartition(',')
+
+    try:
+        datetime.fromisoformat(created)
+        id = int(id)
+    except ValueError:
+        abort(400, f"Invalid cursor {cursor!r}.")
+
+    return created, id
+
+def post_order(post):
+    return post['created'], post['id']
+
+def list_query(clauses, shard, tail):
+    # LIST_SELECT for one shard, see owned_posts
+    clauses = [c for c in (*clauses, owned_posts(shard)) if c]
+    query = LIST_SELECT
+
+    if clauses:
+        query += ' WHERE ' + ' AND '.join(clauses)
+
+    return query + tail
+
+def get_posts_page(after=None, before=None, where=None, params=(), shards=None):
+    '''
+        after pages towards older posts, before pages back towards newer
+        ones. One extra row is fetched to know if there is another page
+        in the direction being read without a separate COUNT query.
+
+        shards are the shards to read, all of them unless it's given.
+        With shards, each one is asked for a page and the pages are
+        merged, which is still one keyset lookup per shard.
+    '''
+    page_size = current_app.config['POSTS_PER_PAGE']
+    forward = before is None
+    cursor = after if forward else before
+
+    clauses = [where] if where else []
+    args = list(params)
+
+    if cursor is not None:
+        clauses.append(
+            '(created, p.id) < (?, ?)' if forward else '(created, p.id) > (?, ?)'
+        )
+        args.extend(decode_cursor(cursor))
+
+    order = 'DESC' if forward else 'ASC'
+    args.append(page_size + 1)
+
+    tail = f' ORDER BY created {order}, p.id {order} LIMIT ?'
+
+    posts = list(islice(merge_posts(
+        (db.execute(list_query(clauses, shard, tail), args)
+         for shard, db in get_post_shards(shards)),
+        key=post_order, reverse=forward,
+    ), page_size + 1))
+    has_more = len(posts) > page_size
+    posts = posts[:page_size]
+
+    if not forward:
+        posts.reverse()
+
+    if not posts:
+        return Page(posts, None, None)
+
+    has_next = has_more if forward else True
+    has_prev = cursor is not None if forward else has_more
+
+    return Page(
+        posts,
+        encode_cursor(posts[-1]) if has_next else None,
+        encode_cursor(posts[0]) if has_prev else None,
+    )
+
+'''
+    Rendered posts are cached as HTML fragments keyed by (id, version).
+    version goes up every time a post is updated, so an edited post simply
+    misses the cache, even in another process. The Edit link depends on who
+    is looking, so each fragment is stored as the HTML before and after
+    where the link goes and the index template fills in the gap.
+
+    POST_FRAGMENT_CACHE_SIZE bounds how many fragments are kept, least
+    recently used first out, and 0 turns the cache off.
+'''
+Fragment = namedtuple('Fragment', 'head tail')
+
+# user content is escaped, so it can never contain this literally
+_EDIT_LINK = Markup('<edit-link>')
+
+@bp.record_once
+def setup_fragment_cache(state):
+    size = state.app.config['POST_FRAGMENT_CACHE_SIZE']
+
+    if size > 0:
+        state.app.extensions['flaskr.fragment_cache'] = LRUCache(size)
+
+def get_fragment_cache():
+    return current_app.extensions.get('flaskr.fragment_cache')
+
+def render_post_fragment(post, cached=True):
+    cache = get_fragment_cache() if cached else None
+    key = (post['id'], post['version'])
+    fragment = cache.get(key) if cache is not None else None
+
+    if fragment is None:
+        html = current_app.jinja_env.get_template('blog/_post.html').render(
+            post=post, edit_link=_EDIT_LINK
+        )
+        head, _, tail = html.partition(_EDIT_LINK)
+        fragment = Fragment(Markup(head), Markup(tail))
+
+        if cache is not None:
+            cache.set(key, fragment)
+
+    return fragment
+
+def invalidate_post_fragment(post):
+    cache = get_fragment_cache()
+
+    if cache is not None:
+        cache.delete((post['id'], post['version']))
+
+'''
+    The index can be revalidated cheaply. Its ETag is made from the post
+    table's version counter and the logged in user (the page shows their
+    name and Edit links). If the client already has that version, a 304 is
+    sent before any posts are queried or rendered. Pages with flashed
+    messages are always sent in full so the messages aren't lost.
+
+    There's no Last-Modified. It would be the same for every user and only
+    accurate to the second, so If-Modified-Since on its own could get a
+    304 for a page showing someone else's links, or missing a post made in
+    the same second.
+'''
+def posts_etag():
+    version = get_table_version('post')[0]
+    user = g.user['id'] if g.user is not None else 'anon'
+
+    return f'posts-{version}-{user}'
+
+def not_modified(etag):
+    if session.get('_flashes'):
+        return None
+
+    if is_resource_modified(request.environ, etag):
+        return None
+
+    response = current_app.response_class(status=304)
+    response.set_etag(etag)
+    return response
+
 @bp.route('/')
 def index():
-    db = get_db()
-    posts = db.execute(
-        'SELECT p.id, title, body, created, author_id, username'
-        ' FROM post p JOIN user u ON p.author_id = u.id'
-        ' ORDER BY created DESC'
-    ).fetchall()
-    return render_template('blog/index.html', posts=posts)
+    etag = posts_etag()
+    cached = not_modified(etag)
+
+    if cached is not None:
+        return cached
+
+    page = get_posts_page(
+        after=request.args.get('after'),
+        before=request.args.get('before'),
+    )
+    posts = [(post, render_post_fragment(post)) for post in page.posts]
+
+    response = make_response(
+        render_template('blog/index.html', page=page, posts=posts)
+    )
+    response.set_etag(etag)
+    response.cache_control.no_cache = True
+    return response
+
+'''
+    /u/<username> pages through one author's posts. post_author_created
+    holds (author_id, created, id) in the order the page is read, so the
+    lookup and the keyset both come straight off that index.
+'''
+@bp.route('/u/<username>')
+def author(username):
+    user = get_db().execute(
+        'SELECT id, username FROM user WHERE username = ?', (username,)
+    ).fetchone()
+
+    if user is None:
+        abort(404, f"User {username} doesn't exist.")
+
+    etag = posts_etag()
+    cached = not_modified(etag)
+
+    if cached is not None:
+        return cached
+
+    page = get_posts_page(
+        after=request.args.get('after'),
+        before=request.args.get('before'),
+        where='p.author_id = ?',
+        params=(user['id'],),
+        shards=[author_shard(user['id'])],
+    )
+    posts = [(post, render_post_fragment(post)) for post in page.posts]
+
+    response = make_response(render_template(
+        'blog/index.html', page=page, posts=posts, author=user
+    ))
+    response.set_etag(etag)
+    response.cache_control.no_cache = True
+    return response
+
+'''
+    /all lists every post, or every post by ?author=<username>, in one
+    response. Rather than fetchall() and rendering the page into a single
+    string, rows are read from the cursor as the template asks for them
+    and the HTML is sent in chunks as it's rendered, so memory stays flat
+    however many posts there are and the first bytes go out straight away.
+
+    stream_with_context keeps the request (and g.db) around until the
+    generator is done. Fragments are rendered without the cache here so a
+    full listing doesn't push the index's hot posts out of it.
+'''
+def stream_template(template_name, **context):
+    current_app.update_template_context(context)
+    stream = current_app.jinja_env.get_template(template_name).stream(context)
+    stream.enable_buffering(STREAM_BUFFER_SIZE)
+    return stream
+
+# number of template output pieces joined together per chunk sent
+STREAM_BUFFER_SIZE = 64
+
+@bp.route('/all')
+def all_posts():
+    etag = posts_etag()
+    cached = not_modified(etag)
+
+    if cached is not None:
+        return cached
+
+    author = request.args.get('author')
+    clauses = []
+    args = ()
+    shards = None
+
+    if author:
+        user = get_db().execute(
+            'SELECT id FROM user WHERE username = ?', (author,)
+        ).fetchone()
+        clauses.append('p.author_id = ?')
+        args = (user['id'] if user is not None else None,)
+        shards = [author_shard(user['id'])] if user is not None else []
+
+    tail = ' ORDER BY created DESC, p.id DESC'
+
+    rows = merge_posts(
+        (db.execute(list_query(clauses, shard, tail), args)
+         for shard, db in get_post_shards(shards)),
+        key=post_order, reverse=True,
+    )
+    posts = ((post, render_post_fragment(post, cached=False)) for post in rows)
+
+    response = current_app.response_class(stream_with_context(
+        stream_template('blog/index.html', page=None, posts=posts)
+    ))
+    response.set_etag(etag)
+    response.cache_control.no_cache = True
+    return response
+
+'''
+    Search runs against post_fts, an FTS5 index over post titles and bodies
+    that triggers in schema.sql keep in step with the post table. Results
+    are ordered by bm25 relevance (lower is better) and paged with a
+    (rank, id) keyset the same way the index pages on (created, id).
+
+    Every word the user typed is quoted so FTS5 query syntax in the search
+    box is matched literally instead of raising an error. Snippets mark
+    matches with control characters, which are swapped for <mark> tags
+    after the rest of the snippet has been escaped.
+'''
+SearchPage = namedtuple('SearchPage', 'results next_cursor')
+
+def fts_query(q):
+    return ' '.join('"' + word.replace('"', '""') + '"' for word in q.split())
+
+def highlight(snippet):
+    return Markup(
+        str(escape(snippet)).replace('\x02', '<mark>').replace('\x03', '</mark>')
+    )
+
+def search_posts(q, after=None):
+    page_size = current_app.config['POSTS_PER_PAGE']
+    query = (
+        'SELECT p.id, p.title, created, author_id, username,'
+        ' bm25(post_fts) AS rank,'
+        " snippet(post_fts, -1, char(2), char(3), '…', 16) AS snippet"
+        ' FROM post_fts'
+        ' JOIN post p ON p.id = post_fts.rowid'
+        ' WHERE post_fts MATCH ?'
+    )
+    args = [fts_query(q)]
+
+    if after is not None:
+        rank, _, id = after.rpartition(',')
+
+        try:
+            args.extend((float(rank), int(id)))
+        except ValueError:
+            abort(400, f"Invalid cursor {after!r}.")
+
+        query += ' AND (bm25(post_fts), p.id) > (?, ?)'
+
+    args.append(page_size + 1)
+
+    def shard_query(shard):
+        owned = owned_posts(shard)
+        return query + (f' AND {owned}' if owned else '') + ' ORDER BY rank, p.id LIMIT ?'
+
+    # bm25 only knows about the posts on its own shard, so ranks from
+    # different shards are close but not exact
+    results = list(islice(merge_posts(
+        (db.execute(shard_query(shard), args) for shard, db in get_post_shards()),
+        key=lambda row: (row['rank'], row['id']),
+    ), page_size + 1))
+    next_cursor = None
+
+    if len(results) > page_size:
+        results = results[:page_size]
+        next_cursor = f"{results[-1]['rank']!r},{results[-1]['id']}"
+
+    return SearchPage(results, next_cursor)
+
+@bp.route('/search')
+def search():
+    q = request.args.get('q', '').strip()
+    page = search_posts(q, after=request.args.get('after')) if q else None
+    return render_template(
+        'blog/search.html', q=q, page=page, highlight=highlight
+    )
 
 @bp.route('/create', methods=('GET', 'POST'))
 @login_required
@@ -34,17 +437,36 @@ def create():
         if error is not None:
             flash(error)
         else:
-            db = get_db()
-            db.execute(
-                'INSERT INTO post (title, body, author_id)'
-                ' VALUES (?, ?, ?)',
-                 (title, body, g.user['id'])
-            )
-            db.commit()
+            insert_post(g.user, title, body)
             return redirect(url_for('blog.index'))
     
     return render_template('blog/create.html')
 
+INSERT_COLUMNS = 'title, excerpt, body_length, body, body_z, author_id, username'
+
+def insert_post(author, title, body):
+    '''
+        Writes a new post by author (a user row) and returns its id. On
+        a shard the id is made there to carry the author's bucket, see
+        flaskr.shards.
+    '''
+    values = (title, *body_columns(body), author['id'], author['username'])
+    shard = author_shard(author['id'])
+
+    if shard is None:
+        return write(
+            f'INSERT INTO post ({INSERT_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?)',
+            values
+        )
+
+    id_sql, id_params = new_post_id(author['id'])
+    return write(
+        f'INSERT INTO post (id, {INSERT_COLUMNS})'
+        f' VALUES ({id_sql}, ?, ?, ?, ?, ?, ?, ?)',
+        (*id_params, *values),
+        shard=shard,
+    )
+
 def get_post(id, check_author=True):
     ''' 
         abort raises a special exception that returns a HTTP status code.
@@ -52,10 +474,8 @@ def get_post(id, check_author=True):
         verifying the post owner is/isn't necessary.
             is necessary when updating a post, isn't when displaying one.
     '''
-    post = get_db().execute(
-        'SELECT p.id, title, body, created, author_id, username'
-        ' FROM post p JOIN user u ON p.author_id = u.id'
-        ' WHERE p.id = ?',
+    post = shard_db(post_shard(id)).execute(
+        POST_SELECT + ' WHERE p.id = ?',
          (id,)
     ).fetchone()
 
@@ -65,7 +485,16 @@ def get_post(id, check_author=True):
     if check_author and post['author_id'] != g.user['id']:
         abort(403)
 
-    return post
+    # the body is only decompressed if something reads it
+    return StoredPost(post)
+
+
+'''
+    A post's own page, the only place its full body is shown.
+'''
+@bp.route('/<int:id>')
+def post(id):
+    return render_template('blog/post.html', post=get_post(id, check_author=False))
 
 
 '''
@@ -90,13 +519,13 @@ def update(id):
         if error is not None:
             flash(error)
         else:
-            db = get_db()
-            db.execute(
-                'UPDATE post SET title = ?, body = ?'
-                ' WHERE id = ?',
-                 (title, body, id)
+            write(
+                'UPDATE post SET title = ?, excerpt = ?, body_length = ?,'
+                ' body = ?, body_z = ?, version = version + 1 WHERE id = ?',
+                 (title, *body_columns(body), id),
+                 shard=post_shard(id),
             )
-            db.commit()
+            invalidate_post_fragment(post)
             return redirect(url_for('blog.index'))
     
     return render_template('blog/update.html', post=post)
@@ -105,10 +534,117 @@ def update(id):
 @bp.route('/<int:id>/delete', methods=('POST',))
 @login_required
 def delete(id):
-    get_post(id)
-    db = get_db()
-    db.execute('DELETE FROM post WHERE id = ?', (id,))
-    db.commit()
+    post = get_post(id)
+    write('DELETE FROM post WHERE id = ?', (id,), shard=post_shard(id))
+    invalidate_post_fragment(post)
     return redirect(url_for('blog.index'))
 
-    
\ No newline at end of file
+    
+
+
+'''
+    Fills in excerpt and body_length for posts that don't have them, a
+    batch of rows per transaction. Databases made before the columns
+    existed get them added first, and body_z too (see add_body_z). --all
+    redoes every post, e.g. after EXCERPT_LENGTH changes. Each post's
+    version is bumped so cached fragments of it are replaced.
+'''
+@click.command('backfill-excerpts')
+@click.option('--all', 'redo_all', is_flag=True,
+              help='Recompute excerpts that are already set as well.')
+@click.option('--batch-size', default=1000, show_default=True)
+@with_appcontext
+def backfill_excerpts_command(redo_all, batch_size):
+    '''Store excerpts and body lengths for existing posts'''
+    where = '' if redo_all else ' AND excerpt IS NULL'
+    count = 0
+
+    for db in get_post_dbs():
+        columns = {row['name'] for row in db.execute('PRAGMA table_info(post)')}
+
+        for column, kind in (('excerpt', 'TEXT'), ('body_length', 'INTEGER')):
+            if column not in columns:
+                db.execute(f'ALTER TABLE post ADD COLUMN {column} {kind}')
+
+        add_body_z(db)
+
+        last_id = 0
+
+        while True:
+            rows = db.execute(
+                'SELECT id, body_text(body, body_z) AS body FROM post'
+                f' WHERE id > ?{where} ORDER BY id LIMIT ?',
+                (last_id, batch_size)
+            ).fetchall()
+
+            if not rows:
+                break
+
+            db.executemany(
+                'UPDATE post SET excerpt = ?, body_length = ?,'
+                ' version = version + 1 WHERE id = ?',
+                ((make_excerpt(row['body']), len(row['body']), row['id'])
+                 for row in rows)
+            )
+            db.commit()
+
+            last_id = rows[-1]['id']
+            count += len(rows)
+
+    click.echo(f'Backfilled {count} posts.')
+
+
+'''
+    check-usernames compares each post's copy of its author's username
+    with the user table. The triggers in schema.sql keep them in step, so
+    a difference means something wrote around them, e.g. a restore of the
+    post table alone, or a user was renamed while posts are sharded,
+    which the triggers can't follow onto the shards. --fix copies the
+    names over and bumps the version of the posts it changes.
+'''
+@click.command('check-usernames')
+@click.option('--fix', is_flag=True, help='Repair the posts that differ.')
+@with_appcontext
+def check_usernames_command(fix):
+    '''Check post.username against the user table'''
+    # posts may be on shards, away from the user table, so the names are
+    # compared here rather than with a join
+    usernames = dict(
+        tuple(row) for row in get_db().execute('SELECT id, username FROM user')
+    )
+    wrong = []
+
+    for db in get_post_dbs():
+        for row in db.execute('SELECT id, author_id, username FROM post ORDER BY id'):
+            actual = usernames.get(row['author_id'])
+
+            if row['username'] != actual:
+                wrong.append((db, row['id'], row['username'], actual))
+
+    for db, post_id, username, actual in wrong[:10]:
+        click.echo(f'post {post_id}: {username!r}, user has {actual!r}')
+
+    if len(wrong) > 10:
+        click.echo(f'... and {len(wrong) - 10} more')
+
+    if not wrong:
+        click.echo('All post usernames match.')
+        return
+
+    if not fix:
+        raise click.ClickException(f'{len(wrong)} posts have the wrong username.')
+
+    for db in get_post_dbs():
+        db.executemany(
+            'UPDATE post SET username = ?, version = version + 1 WHERE id = ?',
+            ((actual, post_id) for post_db, post_id, _, actual in wrong
+             if post_db is db)
+        )
+        db.commit()
+
+    click.echo(f'Fixed {len(wrong)} posts.')
+
+@bp.record_once
+def register_commands(state):
+    state.app.cli.add_command(backfill_excerpts_command)
+    state.app.cli.add_command(check_usernames_command)
@@ -0,0 +1,85 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    '''
+        A small thread safe in-process cache. It holds at most maxsize
+        entries, dropping the least recently used one when it's full, and
+        entries older than ttl seconds are treated as missing (ttl=None
+        keeps them until they're evicted).
+
+        hits and misses are counted so the cache can be monitored.
+    '''
+    def __init__(self, maxsize, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, expires = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+
+            if expires is not None and expires < time.monotonic():
+                del self._data[key]
+                self.misses += 1
+                return default
+
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        expires = None if self.ttl is None else time.monotonic() + self.ttl
+
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def expire(self):
+        '''
+            Drops every expired entry in one pass and returns how many
+            went. get only notices an entry is expired when it's read.
+        '''
+        now = time.monotonic()
+
+        with self._lock:
+            expired = [
+                key for key, (value, expires) in self._data.items()
+                if expires is not None and expires < now
+            ]
+
+            for key in expired:
+                del self._data[key]
+
+        return len(expired)
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self._data),
+            'maxsize': self.maxsize,
+        }
@@ -0,0 +1,376 @@
+import sqlite3
+import struct
+import threading
+import time
+import zlib
+from collections import Counter
+from collections.abc import Mapping
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+
+
+'''
+    Opt in compressed storage for long post bodies, turned on by setting
+    BODY_COMPRESSION_THRESHOLD to a length in characters.
+
+    A body longer than that is zlib compressed (at BODY_COMPRESSION_LEVEL)
+    into post.body_z, and post.body is left empty. Shorter bodies are
+    stored as before. Each compressed body starts with a 4 byte header,
+    the id of the compression_dict row it was compressed with, 0 for none.
+
+    With BODY_COMPRESSION_DICT on, new bodies are compressed against the
+    latest dictionary from flask train-body-dict. Posts on one site tend
+    to share words and markup, and a shared dictionary lets even a short
+    body refer back to them instead of spelling them out again.
+
+    SQL that needs the text calls body_text(body, body_z), a function
+    every connection from flaskr.db has, e.g. the search index triggers
+    and the post_content view the index reads from. Writing posts from a
+    connection without it, like the sqlite3 shell, fails on the triggers.
+'''
+HEADER = struct.Struct('>I')
+
+class BodyCodec(object):
+    def __init__(self, database, threshold=None, level=6, use_dictionary=False):
+        self.database = database
+        self.threshold = threshold
+        self.level = level
+        self.use_dictionary = use_dictionary
+        self._dictionaries = {}
+        self._lock = threading.Lock()
+
+    def dictionary(self, id):
+        '''
+            Dictionaries never change once stored, so each one is read
+            once per process. body_text runs inside SQLite, which can't
+            run another query on the same connection, hence the separate
+            connection to read it.
+        '''
+        with self._lock:
+            data = self._dictionaries.get(id)
+
+        if data is None:
+            db = sqlite3.connect(self.database)
+
+            try:
+                row = db.execute(
+                    'SELECT data FROM compression_dict WHERE id = ?', (id,)
+                ).fetchone()
+            finally:
+                db.close()
+
+            if row is None:
+                raise LookupError(f'Compression dictionary {id} is missing.')
+
+            data = row[0]
+
+            with self._lock:
+                self._dictionaries[id] = data
+
+        return data
+
+    def compress(self, body, dictionary_id=0):
+        '''
+            Returns the (body, body_z) pair to store for a body.
+        '''
+        if self.threshold is None or len(body) <= self.threshold:
+            return body, None
+
+        if dictionary_id:
+            compressor = zlib.compressobj(
+                self.level, zdict=self.dictionary(dictionary_id)
+            )
+        else:
+            compressor = zlib.compressobj(self.level)
+
+        data = compressor.compress(body.encode('utf-8')) + compressor.flush()
+        return '', HEADER.pack(dictionary_id) + data
+
+    def decompress(self, body_z):
+        (dictionary_id,) = HEADER.unpack_from(body_z)
+
+        if dictionary_id:
+            decompressor = zlib.decompressobj(zdict=self.dictionary(dictionary_id))
+        else:
+            decompressor = zlib.decompressobj()
+
+        data = decompressor.decompress(body_z[HEADER.size:])
+        return (data + decompressor.flush()).decode('utf-8')
+
+    def body_text(self, body, body_z):
+        return body if body_z is None else self.decompress(body_z)
+
+
+def get_codec(app=None):
+    app = app or current_app
+    return app.extensions['flaskr.body_codec']
+
+def current_dictionary_id(db):
+    '''
+        The dictionary new bodies should use, 0 when there's none or
+        dictionaries are turned off.
+    '''
+    if not get_codec().use_dictionary:
+        return 0
+
+    row = db.execute('SELECT MAX(id) FROM compression_dict').fetchone()
+    return row[0] or 0
+
+def compress_body(db, body):
+    return get_codec().compress(body, current_dictionary_id(db))
+
+
+class StoredPost(Mapping):
+    '''
+        A post row whose body is only decompressed when something reads
+        post['body'], which is only the views that show the whole post.
+    '''
+    __slots__ = ('_row', '_body')
+
+    def __init__(self, row):
+        self._row = row
+        self._body = None
+
+    def __getitem__(self, key):
+        if key != 'body':
+            return self._row[key]
+
+        if self._body is None:
+            self._body = get_codec().body_text(self._row['body'], self._row['body_z'])
+
+        return self._body
+
+    def __iter__(self):
+        return iter(self._row.keys())
+
+    def __len__(self):
+        return len(self._row)
+
+
+def train_dictionary(bodies, size=32 * 1024):
+    '''
+        zlib has no dictionary trainer, so this builds one from the words
+        and word pairs that would save the most bytes across the sample
+        (length times how often they occur). zlib reaches the end of the
+        dictionary most cheaply, so the most valuable strings go last.
+    '''
+    counts = Counter()
+
+    for body in bodies:
+        words = body.split()
+        counts.update(word + ' ' for word in words)
+        counts.update(f'{a} {b} ' for a, b in zip(words, words[1:]))
+
+    scored = sorted(
+        ((len(s.encode('utf-8')) * n, s) for s, n in counts.items() if n > 1),
+        reverse=True,
+    )
+
+    chosen = []
+    total = 0
+
+    for score, s in scored:
+        data = s.encode('utf-8')
+
+        if total + len(data) > size:
+            continue
+
+        chosen.append(data)
+        total += len(data)
+
+    return b''.join(reversed(chosen))
+
+def time_reads(samples):
+    # average time to read and decompress one body, with a warm cache,
+    # over (db, id) pairs
+    if not samples:
+        return 0.0
+
+    start = time.perf_counter()
+
+    for db, id in samples:
+        db.execute(
+            'SELECT body_text(body, body_z) FROM post WHERE id = ?', (id,)
+        ).fetchone()
+
+    return (time.perf_counter() - start) / len(samples)
+
+'''
+    Databases made before compression have no body_z column, post_content
+    view or compression_dict table, and their search index reads body
+    straight from post. add_body_z brings one up to date in a single
+    transaction: the index is pointed at post_content and rebuilt from it
+    (the text is the same, an FTS5 table just can't change its content
+    table in place), and the triggers are replaced by ones that read
+    body_text. compress-bodies, train-body-dict and backfill-excerpts run
+    it first, so after upgrading flaskr any of them makes an old database
+    usable again.
+'''
+BODY_Z_MIGRATION = """
+BEGIN;
+ALTER TABLE post ADD COLUMN body_z BLOB;
+
+CREATE TABLE IF NOT EXISTS compression_dict (
+  id INTEGER PRIMARY KEY,
+  data BLOB NOT NULL,
+  created TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+DROP TRIGGER IF EXISTS post_fts_insert;
+DROP TRIGGER IF EXISTS post_fts_delete;
+DROP TRIGGER IF EXISTS post_fts_update;
+DROP TABLE IF EXISTS post_fts;
+
+CREATE VIEW post_content AS
+  SELECT id, title, body_text(body, body_z) AS body FROM post;
+
+CREATE VIRTUAL TABLE post_fts USING fts5(
+  title, body, content='post_content', content_rowid='id'
+);
+INSERT INTO post_fts (post_fts) VALUES ('rebuild');
+
+CREATE TRIGGER post_fts_insert AFTER INSERT ON post BEGIN
+  INSERT INTO post_fts (rowid, title, body)
+  VALUES (new.id, new.title, body_text(new.body, new.body_z));
+END;
+
+CREATE TRIGGER post_fts_delete AFTER DELETE ON post BEGIN
+  INSERT INTO post_fts (post_fts, rowid, title, body)
+  VALUES ('delete', old.id, old.title, body_text(old.body, old.body_z));
+END;
+
+CREATE TRIGGER post_fts_update AFTER UPDATE OF title, body, body_z ON post BEGIN
+  INSERT INTO post_fts (post_fts, rowid, title, body)
+  VALUES ('delete', old.id, old.title, body_text(old.body, old.body_z));
+  INSERT INTO post_fts (rowid, title, body)
+  VALUES (new.id, new.title, body_text(new.body, new.body_z));
+END;
+COMMIT;
+"""
+
+def add_body_z(db):
+    # returns whether db needed it
+    columns = {row['name'] for row in db.execute('PRAGMA table_info(post)')}
+
+    if 'body_z' in columns:
+        return False
+
+    db.executescript(BODY_Z_MIGRATION)
+    return True
+
+@click.command('compress-bodies')
+@click.option('--batch-size', default=1000, show_default=True)
+@click.option('--sample', default=200, show_default=True,
+              help='How many posts to time reading before and after.')
+@with_appcontext
+def compress_bodies_command(batch_size, sample):
+    '''Compress stored post bodies longer than BODY_COMPRESSION_THRESHOLD'''
+    # imported here, flaskr.db needs this module to set up connections
+    from flaskr.db import get_db, get_post_dbs
+
+    codec = get_codec()
+
+    if codec.threshold is None:
+        raise click.UsageError('BODY_COMPRESSION_THRESHOLD is not set.')
+
+    dbs = get_post_dbs()
+
+    for db in dbs:
+        add_body_z(db)
+    pending = ' AND body_z IS NULL AND length(body) > ?'
+    samples = [(db, row[0]) for db in dbs for row in db.execute(
+        f'SELECT id FROM post WHERE 1{pending} ORDER BY random() LIMIT ?',
+        (codec.threshold, sample)
+    )]
+    read_before = time_reads(samples)
+    dictionary_id = current_dictionary_id(get_db())
+
+    count = 0
+    text_bytes = 0
+    stored_bytes = 0
+
+    for db in dbs:
+        last_id = 0
+
+        while True:
+            rows = db.execute(
+                f'SELECT id, body FROM post WHERE id > ?{pending} ORDER BY id LIMIT ?',
+                (last_id, codec.threshold, batch_size)
+            ).fetchall()
+
+            if not rows:
+                break
+
+            updates = []
+
+            for row in rows:
+                body_z = codec.compress(row['body'], dictionary_id)[1]
+                text_bytes += len(row['body'].encode('utf-8'))
+                stored_bytes += len(body_z)
+                updates.append((body_z, row['id']))
+
+            db.executemany("UPDATE post SET body = '', body_z = ? WHERE id = ?", updates)
+            db.commit()
+
+            last_id = rows[-1]['id']
+            count += len(rows)
+            click.echo(f'{count} posts compressed', err=True)
+
+    read_after = time_reads(samples)
+
+    if count:
+        click.echo(
+            f'Compressed {count} posts, {text_bytes} bytes of text now take'
+            f' {stored_bytes} ({1 - stored_bytes / text_bytes:.0%} smaller).'
+        )
+        click.echo(
+            f'Reading a body took {read_before * 1000:.3f}ms before and'
+            f' {read_after * 1000:.3f}ms after (average of {len(samples)}).'
+        )
+        click.echo('Run VACUUM to give the freed pages back to the filesystem.')
+    else:
+        click.echo('Nothing to compress.')
+
+@click.command('train-body-dict')
+@click.option('--samples', default=1000, show_default=True,
+              help='How many random posts to learn from, per shard.')
+@click.option('--size', default=32 * 1024, show_default=True,
+              help='Dictionary size in bytes, zlib uses at most 32KB.')
+@with_appcontext
+def train_body_dict_command(samples, size):
+    '''Build a compression dictionary from a sample of posts'''
+    from flaskr.db import get_db, get_post_dbs
+
+    db = get_db()
+
+    for post_db in get_post_dbs():
+        add_body_z(post_db)
+
+    bodies = [row[0] for post_db in get_post_dbs() for row in post_db.execute(
+        'SELECT body_text(body, body_z) FROM post ORDER BY random() LIMIT ?',
+        (samples,)
+    )]
+
+    if not bodies:
+        raise click.UsageError('There are no posts to learn from.')
+
+    data = train_dictionary(bodies, size)
+    cursor = db.execute('INSERT INTO compression_dict (data) VALUES (?)', (data,))
+    db.commit()
+
+    click.echo(
+        f'Stored dictionary {cursor.lastrowid}, {len(data)} bytes from'
+        f' {len(bodies)} posts. Set BODY_COMPRESSION_DICT to use it.'
+    )
+
+def init_app(app):
+    app.cli.add_command(compress_bodies_command)
+    app.cli.add_command(train_body_dict_command)
+    app.extensions['flaskr.body_codec'] = BodyCodec(
+        app.config['DATABASE'],
+        threshold=app.config['BODY_COMPRESSION_THRESHOLD'],
+        level=app.config['BODY_COMPRESSION_LEVEL'],
+        use_dictionary=app.config['BODY_COMPRESSION_DICT'],
+    )
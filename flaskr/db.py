@@ -1,9 +1,23 @@
+import contextvars
+import json
+import logging
+import os
+import queue
+import re
 import sqlite3
+import threading
+import time
+from collections import Counter
+from functools import lru_cache
+from urllib.request import pathname2url
 
 import click
-from flask import current_app, g
+from flask import current_app, g, has_app_context, has_request_context, request
 from flask.cli import with_appcontext
 
+from flaskr.compression import get_codec
+from flaskr.profiling import phase
+
 
 '''
    g is a special object that is unique for each request.
@@ -22,33 +36,585 @@ from flask.cli import with_appcontext
    can be used.
 '''
 
-def get_db():
+class TimedCursor(sqlite3.Cursor):
+    '''
+        A cursor that times each statement, then passes the statement, its
+        parameters and the time taken to the connection's statement_hooks.
+
+        Only execute and the bulk fetches (fetchmany, fetchall) are timed.
+        SQLite does a query's work while stepping through rows, and
+        execute steps to the first one, which for a sorted, grouped or
+        single row query is nearly all of it. Rows read one at a time after
+        that, by iterating or fetchone, run on the plain cursor methods:
+        timing each of those added around 8% to the index with PROFILING
+        on. The hooks are called once per statement, when a bulk fetch
+        runs out of rows or the cursor is reused, closed or dropped.
+    '''
+    _statement = None
+    _elapsed = 0.0
+
+    def _finish(self):
+        if self._statement is None:
+            return
+
+        sql, parameters = self._statement
+        self._statement = None
+
+        for hook in self.connection.statement_hooks:
+            hook(sql, parameters, self._elapsed)
+
+    def execute(self, sql, parameters=()):
+        self._finish()
+        self._statement = (sql, parameters)
+        done = True
+        start = time.perf_counter()
+
+        try:
+            super().execute(sql, parameters)
+            # statements that return rows finish when they're fetched
+            done = self.description is None
+            return self
+        finally:
+            self._elapsed = time.perf_counter() - start
+
+            if done:
+                self._finish()
+
+    def executemany(self, sql, seq_of_parameters):
+        self._finish()
+        self._statement = (sql, None)
+        start = time.perf_counter()
+
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            self._elapsed = time.perf_counter() - start
+            self._finish()
+
+    def fetchmany(self, size=None):
+        size = self.arraysize if size is None else size
+        start = time.perf_counter()
+        rows = super().fetchmany(size)
+        self._elapsed += time.perf_counter() - start
+
+        if len(rows) < size:
+            self._finish()
+
+        return rows
+
+    def fetchall(self):
+        start = time.perf_counter()
+        rows = super().fetchall()
+        self._elapsed += time.perf_counter() - start
+        self._finish()
+        return rows
+
+    def close(self):
+        self._finish()
+        super().close()
+
+    def __del__(self):
+        # statements whose rows were read one at a time, or not at all
+        self._finish()
+
+
+class Connection(sqlite3.Connection):
+    '''
+        sqlite3.Connection doesn't allow setting attributes on it, so
+        connections are created from this subclass instead. created_at
+        lets the pool retire connections that have been open too long.
+
+        statement_hooks are called as hook(sql, parameters, seconds) after
+        each statement run through execute or executemany. While there are
+        none, statements run on plain cursors and cost nothing extra.
+    '''
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.created_at = time.monotonic()
+        self.statement_hooks = ()
+
+    def execute(self, sql, parameters=()):
+        if not self.statement_hooks:
+            return super().execute(sql, parameters)
+
+        return self.cursor(TimedCursor).execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        if not self.statement_hooks:
+            return super().executemany(sql, seq_of_parameters)
+
+        return self.cursor(TimedCursor).executemany(sql, seq_of_parameters)
+
+def connect(read_only=False, database=None):
+    config = current_app.config
+    database = database or config['DATABASE']
+    pragmas = config['DB_PRAGMAS']
+
+    if read_only:
+        # mode=ro makes SQLite itself refuse writes on this connection
+        replica = config['DATABASE_REPLICA'] or database
+        database = f'file:{pathname2url(os.path.abspath(replica))}?mode=ro'
+        # only a writer can change the journal mode
+        pragmas = {k: v for k, v in pragmas.items() if k != 'journal_mode'}
+
+    db = sqlite3.connect(
+        database,
+        detect_types=sqlite3.PARSE_DECLTYPES,
+        factory=Connection,
+        # pooled connections are handed to whichever thread borrows them,
+        # but only ever to one thread at a time
+        check_same_thread=False,
+        uri=read_only,
+    )
+
+    #this tells the connection to return rows that behave
+    #like dicts. Allows for accessing the columns by name
+    db.row_factory = sqlite3.Row
+
+    apply_pragmas(db, pragmas)
+    db.create_function(
+        'body_text', 2, get_codec().body_text, deterministic=True
+    )
+    db.statement_hooks = get_statement_hooks()
+
+    return db
+
+def get_statement_hooks(app=None):
+    '''
+        The app's list of statement hooks. Every connection shares the same
+        list, so a hook added later is seen by connections already open.
+    '''
+    app = app or current_app
+    return app.extensions.setdefault('flaskr.statement_hooks', [])
+
+'''
+    PRAGMAs are per connection settings, so the profile from DB_PRAGMAS is
+    applied every time a connection is opened. journal_mode=WAL lets readers
+    keep going while a write is in progress instead of queueing behind it,
+    and busy_timeout makes a writer wait for the lock rather than failing
+    straight away with "database is locked".
+'''
+def apply_pragmas(db, pragmas):
+    for name, value in pragmas.items():
+        db.execute(f'PRAGMA {name} = {value}')
+
+
+class ConnectionPool(object):
+    '''
+        Keeps up to size idle connections around between requests so
+        every request doesn't pay for opening the file, parsing the schema
+        and warming SQLite's page cache again.
+
+        Connections are handed out most recently used first, since those
+        are the ones with the warmest cache. A borrowed connection is
+        pinged before it's returned, and connections older than
+        max_lifetime seconds are closed instead of reused.
+    '''
+    def __init__(self, connect, size, max_lifetime=None, pre_ping=True):
+        self._connect = connect
+        self._idle = queue.LifoQueue(maxsize=size)
+        self.max_lifetime = max_lifetime
+        self.pre_ping = pre_ping
+
+    def _usable(self, db):
+        if (self.max_lifetime is not None
+                and time.monotonic() - db.created_at > self.max_lifetime):
+            return False
+
+        if self.pre_ping:
+            try:
+                db.execute('SELECT 1')
+            except sqlite3.Error:
+                return False
+
+        return True
+
+    def acquire(self):
+        while True:
+            try:
+                db = self._idle.get_nowait()
+            except queue.Empty:
+                return self._connect()
+
+            if self._usable(db):
+                return db
+
+            db.close()
+
+    def release(self, db):
+        # never hand out a connection in the middle of someone
+        # else's transaction
+        try:
+            if db.in_transaction:
+                db.rollback()
+        except sqlite3.ProgrammingError:
+            # the connection was already closed
+            return
+
+        try:
+            self._idle.put_nowait(db)
+        except queue.Full:
+            db.close()
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+'''
+    Statement logging, built on the statement hooks. Each log line is a
+    JSON object so it can be aggregated:
+
+    - statements slower than SLOW_QUERY_THRESHOLD seconds are logged with
+      their parameters and the endpoint that ran them.
+    - when one request runs the same statement shape more than
+      N_PLUS_ONE_THRESHOLD times, a warning is logged once for that shape.
+      That's usually a query in a loop that could be a single query.
+
+    Both are off when set to None. Turning either on sends every statement
+    through TimedCursor, the same as PROFILING does, which adds a few
+    Python calls to each statement but none to the rows read one at a
+    time. The N+1 count normalises each distinct SQL string with a regex
+    once and then reuses the shape, so a statement run in a loop costs a
+    dict lookup. Measure it with benchmarks/load_test.py before leaving it
+    on in production.
+
+    Writes made through the group commit writer run on its thread, outside
+    any request. The writer takes statement_source() when a write is
+    submitted and runs it under logged_as(source), so those statements
+    are logged with the endpoint (and counted against the request) that
+    made them.
+'''
+logger = logging.getLogger(__name__)
+
+_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+
+@lru_cache(maxsize=1024)
+def statement_shape(sql):
+    # statements written with literals instead of ? still group together
+    return _LITERALS.sub('?', ' '.join(sql.split()))
+
+def _loggable(parameters):
+    if parameters is None:
+        return None
+
+    values = parameters.values() if isinstance(parameters, dict) else parameters
+    # keep log lines small when a parameter is something like a post body
+    return [
+        v[:64] + '…' if isinstance(v, str) and len(v) > 64 else v
+        for v in values
+    ]
+
+def _log(event, endpoint, **fields):
+    logger.warning(json.dumps(
+        {'event': event, 'endpoint': endpoint, **fields}, default=str
+    ))
+
+_writer_source = contextvars.ContextVar('flaskr.statement_source', default=None)
+
+def statement_source():
+    '''
+        The app, endpoint and per request statement counts that statements
+        run now are logged against, None outside an app context.
+    '''
+    if not has_app_context():
+        return None
+
+    counts = None
+
+    if current_app.config['N_PLUS_ONE_THRESHOLD'] is not None:
+        counts = g.get('_statement_counts')
+
+        if counts is None:
+            counts = g._statement_counts = Counter()
+
+    endpoint = request.endpoint if has_request_context() else None
+    return current_app._get_current_object(), endpoint, counts
+
+class logged_as(object):
+    # logs the statements run inside it against source, for the writer
+    def __init__(self, source):
+        self.source = source
+
+    def __enter__(self):
+        self._token = _writer_source.set(self.source)
+
+    def __exit__(self, *exc_info):
+        _writer_source.reset(self._token)
+
+def log_statement(sql, parameters, seconds):
+    source = _writer_source.get() or statement_source()
+
+    if source is None:
+        return
+
+    app, endpoint, counts = source
+    threshold = app.config['SLOW_QUERY_THRESHOLD']
+
+    if threshold is not None and seconds >= threshold:
+        _log('slow_query', endpoint, sql=sql, parameters=_loggable(parameters),
+             ms=round(seconds * 1000, 3))
+
+    limit = app.config['N_PLUS_ONE_THRESHOLD']
+
+    if limit is not None and counts is not None:
+        shape = statement_shape(sql)
+        counts[shape] += 1
+
+        if counts[shape] == limit + 1:
+            _log('n_plus_one', endpoint, sql=shape, count=counts[shape])
+
+
+def get_pool(app=None, read_only=False):
+    app = app or current_app
+    name = 'flaskr.db_read_pool' if read_only else 'flaskr.db_pool'
+    return app.extensions.get(name)
+
+def _open(read_only):
+    pool = get_pool(read_only=read_only)
+
+    with phase('db_connect'):
+        if pool is not None:
+            return pool.acquire()
+
+        return connect(read_only=read_only)
+
+
+'''
+    With DB_READ_ROUTING on, each request gets up to two connections: a
+    read-only one (a mode=ro URI, on DATABASE_REPLICA if that's set) and
+    the usual read-write one. Reads on the read-only connection never
+    wait on or hold up the writer.
+
+    get_db picks one for the current request. GET, HEAD and OPTIONS
+    requests get the read-only connection, everything else (and the CLI)
+    gets the read-write one. A view can choose for itself with the
+    read_only or read_write decorators. Code that has to write, whatever
+    the request, uses get_write_db.
+
+    With DB_READ_ROUTING off, all three return the same connection.
+'''
+READ_METHODS = frozenset(('GET', 'HEAD', 'OPTIONS'))
+
+def read_only(view):
+    view.db_routing = 'read'
+    return view
+
+def read_write(view):
+    view.db_routing = 'write'
+    return view
+
+def _routes_to_read():
+    if not current_app.config['DB_READ_ROUTING'] or not has_request_context():
+        return False
+
+    view = current_app.view_functions.get(request.endpoint)
+    routing = getattr(view, 'db_routing', None)
+
+    if routing is not None:
+        return routing == 'read'
+
+    return request.method in READ_METHODS
+
+def get_write_db():
     if 'db' not in g:
-        g.db = sqlite3.connect(
-            current_app.config['DATABASE'],
-            detect_types=sqlite3.PARSE_DECLTYPES
-        )
-        
-        #this tells the connection to return rows that behave
-        #like dicts. Allows for accessing the columns by name
-        g.db.row_factory = sqlite3.Row
+        g.db = _open(read_only=False)
 
     return g.db
 
+def get_read_db():
+    if not current_app.config['DB_READ_ROUTING']:
+        return get_write_db()
+
+    if 'read_db' not in g:
+        g.read_db = _open(read_only=True)
+
+    return g.read_db
+
+def get_db():
+    return get_read_db() if _routes_to_read() else get_write_db()
+
 def close_db(e=None):
     '''
       checks if a connection was created by checking if g.db
-      was set. If the connection exists, it is closed. Further
-      along, application gets told about close_db in the app factory
-      so that it is called after each request.
+      was set. If the connection exists, it is handed back to the
+      pool or closed when pooling is off. Further along, application
+      gets told about close_db in the app factory so that it is called
+      after each request.
+    '''
+
+    for name, read_only in (('db', False), ('read_db', True)):
+        db = g.pop(name, None)
+
+        if db is not None:
+            pool = get_pool(read_only=read_only)
+
+            if pool is not None:
+                pool.release(db)
+            else:
+                db.close()
+
+    pools = current_app.extensions.get('flaskr.shard_pools')
+
+    for index, db in g.pop('shard_dbs', {}).items():
+        if pools is not None:
+            pools[index].release(db)
+        else:
+            db.close()
+
+
+'''
+    With DATABASE_SHARDS set, posts are kept in those database files
+    instead of DATABASE, which still holds users, sessions and the rest
+    (flaskr.shards decides which shard a post goes in). get_shard_db(n)
+    is the connection to shard n, opened the first time it's asked for
+    and pooled like the main one. Shards are always read-write, read
+    routing only covers DATABASE.
+
+    get_post_dbs returns every connection that holds posts, the shards
+    or just get_db(), for code that has to go through all the posts.
+'''
+def get_shard_count(app=None):
+    app = app or current_app
+    return len(app.config['DATABASE_SHARDS'] or ())
+
+def get_shard_db(index):
+    dbs = g.setdefault('shard_dbs', {})
+
+    if index not in dbs:
+        pools = current_app.extensions.get('flaskr.shard_pools')
+
+        with phase('db_connect'):
+            if pools is not None:
+                dbs[index] = pools[index].acquire()
+            else:
+                dbs[index] = connect(
+                    database=current_app.config['DATABASE_SHARDS'][index]
+                )
+
+    return dbs[index]
+
+def get_post_dbs():
+    count = get_shard_count()
+
+    if not count:
+        return [get_db()]
+
+    return [get_shard_db(index) for index in range(count)]
+
+def _table_version(db, name):
+    return db.execute(
+        'SELECT version, modified FROM table_version WHERE name = ?', (name,)
+    ).fetchone()
+
+def get_table_version(name):
     '''
+        Returns the (version, modified) pair table_version keeps for a
+        table. version goes up on every insert, update or delete (only
+        updates and deletes for user, see schema.sql). With shards, the
+        post version adds up every shard's counter, and modified is the
+        latest change on any of them.
+    '''
+    if name == 'post' and get_shard_count():
+        rows = [_table_version(db, name) for db in get_post_dbs()]
+        return (sum(row['version'] for row in rows),
+                max(row['modified'] for row in rows))
+
+    row = _table_version(get_db(), name)
+    return row['version'], row['modified']
+
+
+'''
+    Cache coherence between workers, turned on with CACHE_COHERENCE.
 
-    db = g.pop('db', None)
+    Every worker process has its own in-process caches, and a write made
+    in one worker never reaches the others'. table_version already counts
+    the changes to each table it tracks, through triggers, so any write
+    from anywhere shows up there. With coherence on, each request starts
+    by reading that one small table (static files and views marked
+    skip_user_load don't), and for every table whose version moved since
+    this process last looked, the invalidation hooks registered for it
+    are called. A cache owner adds one with
 
-    if db is not None:
-        db.close()
+        get_invalidation_hooks('user', app).append(callback)
+
+    and callback(name) is called with the table's name.
+
+    PRAGMA data_version would save the query, but it only tells one
+    connection that some other connection committed since it last asked,
+    not which table changed. Connections here come and go with requests
+    and the pool, and a new post shouldn't empty the user cache, so the
+    counters are the better fit.
+'''
+class TableVersions(object):
+    def __init__(self):
+        self._seen = {}
+        self._lock = threading.Lock()
+
+    def changed(self, rows):
+        '''
+            Records the (name, version) rows and returns the names whose
+            version is new to this process.
+        '''
+        with self._lock:
+            names = [name for name, version in rows if self._seen.get(name) != version]
+            self._seen.update(rows)
+
+        return names
+
+def get_invalidation_hooks(name, app=None):
+    app = app or current_app
+    hooks = app.extensions.setdefault('flaskr.invalidation_hooks', {})
+    return hooks.setdefault(name, [])
+
+def check_table_versions():
+    hooks = current_app.extensions.get('flaskr.invalidation_hooks')
+    endpoint = request.endpoint
+
+    if not hooks or endpoint is None or endpoint.rsplit('.', 1)[-1] == 'static':
+        return
+
+    # views that skip loading the user, like /hello and /metrics, don't
+    # read any cache either
+    view = current_app.view_functions.get(endpoint)
+
+    if getattr(view, 'skip_user_load', False):
+        return
+
+    sharded = get_shard_count()
+    query = 'SELECT name, version FROM table_version'
+
+    if sharded:
+        # DATABASE's own post row is left over from before sharding, the
+        # shards' rows are the ones that change
+        query += " WHERE name != 'post'"
+
+    rows = [tuple(row) for row in get_db().execute(query)]
+
+    # the post version is on every shard, so they're only all opened when
+    # something is listening for it
+    if sharded and hooks.get('post'):
+        rows.append(('post', get_table_version('post')[0]))
+
+    for name in current_app.extensions['flaskr.table_versions'].changed(rows):
+        for hook in hooks.get(name, ()):
+            hook(name)
 
 def init_db():
+    '''
+        SQLite creates the database file but not the folder it goes in,
+        which is the instance folder by default, and Flask doesn't create
+        that automatically. So it's made here, where the file is first
+        created, rather than every time the app starts.
+    '''
+    config = current_app.config
+
+    for database in [config['DATABASE'], *(config['DATABASE_SHARDS'] or ())]:
+        os.makedirs(os.path.dirname(os.path.abspath(database)), exist_ok=True)
+
     db = get_db()
 
     ''' 
@@ -58,9 +624,32 @@ def init_db():
        the commands read from the file.
     '''
 
+    create_post_tables(db)
+
     with current_app.open_resource('schema.sql') as f:
         db.executescript(f.read().decode('utf8'))
 
+    count = get_shard_count()
+
+    if count:
+        for index in range(count):
+            create_post_tables(get_shard_db(index))
+
+        # to start with, bucket n goes on shard n % count
+        db.executemany(
+            'INSERT INTO shard_map (bucket, shard) VALUES (?, ?)',
+            ((bucket, bucket % count) for bucket in range(config['SHARD_BUCKETS']))
+        )
+        db.commit()
+
+def create_post_tables(db):
+    '''
+        post.sql holds the post tables on their own, so they can be
+        created on DATABASE and on each shard alike.
+    '''
+    with current_app.open_resource('post.sql') as f:
+        db.executescript(f.read().decode('utf8'))
+
 '''
     click.command() definds a command line command called init-db
     that calls the init_db function and shows a success message to
@@ -73,10 +662,80 @@ def init_db_command():
     init_db()
     click.echo('Initialized the database.')
 
+@click.command('rebuild-search')
+@with_appcontext
+def rebuild_search_command():
+    '''Rebuild the post search index from the post table'''
+    for db in get_post_dbs():
+        db.execute("INSERT INTO post_fts (post_fts) VALUES ('rebuild')")
+        db.commit()
+
+    click.echo('Rebuilt the search index.')
+
+@click.command('db-tune')
+@with_appcontext
+def db_tune_command():
+    '''Show the effective PRAGMA settings of a database connection'''
+    db = get_db()
+
+    for name in current_app.config['DB_PRAGMAS']:
+        value = db.execute(f'PRAGMA {name}').fetchone()[0]
+        click.echo(f'{name} = {value}')
+
 def init_app(app):
+    '''
+        DB_POOL_SIZE turns on connection pooling when it's above 0.
+        DB_POOL_MAX_LIFETIME (seconds, None for no limit) and
+        DB_POOL_PRE_PING tune how pooled connections are recycled.
+        With read routing on, read-only connections get a pool of the
+        same size of their own, and so does each shard.
+    '''
+    if app.config['DB_POOL_SIZE'] > 0:
+        app.extensions['flaskr.db_pool'] = ConnectionPool(
+            connect,
+            app.config['DB_POOL_SIZE'],
+            max_lifetime=app.config['DB_POOL_MAX_LIFETIME'],
+            pre_ping=app.config['DB_POOL_PRE_PING'],
+        )
+
+        if app.config['DB_READ_ROUTING']:
+            app.extensions['flaskr.db_read_pool'] = ConnectionPool(
+                lambda: connect(read_only=True),
+                app.config['DB_POOL_SIZE'],
+                max_lifetime=app.config['DB_POOL_MAX_LIFETIME'],
+                pre_ping=app.config['DB_POOL_PRE_PING'],
+            )
+
+        if app.config['DATABASE_SHARDS']:
+            app.extensions['flaskr.shard_pools'] = [
+                ConnectionPool(
+                    lambda database=database: connect(database=database),
+                    app.config['DB_POOL_SIZE'],
+                    max_lifetime=app.config['DB_POOL_MAX_LIFETIME'],
+                    pre_ping=app.config['DB_POOL_PRE_PING'],
+                )
+                for database in app.config['DATABASE_SHARDS']
+            ]
+
+    if app.config['CACHE_COHERENCE']:
+        app.extensions['flaskr.table_versions'] = TableVersions()
+        app.before_request(check_table_versions)
+
+    if (app.config['SLOW_QUERY_THRESHOLD'] is not None
+            or app.config['N_PLUS_ONE_THRESHOLD'] is not None):
+        get_statement_hooks(app).append(log_statement)
+
     #tell flask to call that function when cleaning up after
     #returning the response
     app.teardown_appcontext(close_db)
     #adds a new command that can be called with the flask command
     app.cli.add_command(init_db_command)
+    app.cli.add_command(db_tune_command)
+    app.cli.add_command(rebuild_search_command)
+
+    from flaskr import transfer
+    app.cli.add_command(transfer.import_posts_command)
+    app.cli.add_command(transfer.export_posts_command)
+    app.cli.add_command(transfer.import_users_command)
+    app.cli.add_command(transfer.export_users_command)
 
@@ -0,0 +1,172 @@
+import multiprocessing
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from werkzeug.exceptions import abort
+from werkzeug.security import (
+    DEFAULT_PBKDF2_ITERATIONS, check_password_hash, generate_password_hash
+)
+
+from flaskr.db import get_db
+from flaskr.profiling import phase
+
+
+'''
+    Password hashing is deliberately slow and CPU bound, so running it on
+    the request thread holds up every other request in the worker while a
+    burst of logins is being checked. PasswordHasher sends the work to a
+    pool of PASSWORD_HASH_WORKERS processes instead (0 hashes inline).
+
+    At most PASSWORD_HASH_QUEUE_LIMIT hashes may be waiting or running at
+    once. Past that, requests are turned away with a 503 straight away
+    rather than queueing up behind the backlog.
+
+    PASSWORD_HASH_METHOD and PASSWORD_SALT_LENGTH are passed to werkzeug's
+    generate_password_hash, e.g. 'pbkdf2:sha256:600000' sets the cost.
+'''
+def get_mp_context():
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('forkserver')
+
+    return multiprocessing.get_context('spawn')
+
+class PasswordHasher(object):
+    def __init__(self, method, salt_length, workers=0, queue_limit=32):
+        self.method = method
+        self.salt_length = salt_length
+        self.workers = workers
+        self._slots = threading.BoundedSemaphore(queue_limit)
+        self._executor = None
+        self._lock = threading.Lock()
+
+        self.count = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+        self.rejected = 0
+
+    def _get_executor(self):
+        '''
+            The pool is only started when the first hash is needed, which
+            keeps it out of processes that fork after the app is created.
+            That first hash comes from a request thread, and forking there
+            would copy any lock another thread holds at that moment (the
+            group commit writer's, logging's) into a child that can never
+            release it. So the workers are started by a forkserver, or
+            spawned where there isn't one, never forked from here.
+        '''
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(
+                    self.workers, mp_context=get_mp_context()
+                )
+
+            return self._executor
+
+    def _run(self, func, *args):
+        if not self._slots.acquire(blocking=False):
+            self.rejected += 1
+            abort(503, 'Too many password checks in progress, try again.')
+
+        start = time.perf_counter()
+
+        try:
+            with phase('hash'):
+                if self.workers > 0:
+                    return self._get_executor().submit(func, *args).result()
+
+                return func(*args)
+        finally:
+            self._slots.release()
+            elapsed = time.perf_counter() - start
+
+            with self._lock:
+                self.count += 1
+                self.total_seconds += elapsed
+                self.max_seconds = max(self.max_seconds, elapsed)
+
+    def hash(self, password):
+        return self._run(
+            generate_password_hash, password, self.method, self.salt_length
+        )
+
+    def verify(self, pwhash, password):
+        return self._run(check_password_hash, pwhash, password)
+
+    @property
+    def target_method(self):
+        '''
+            The method prefix a new hash gets, with werkzeug's defaults
+            filled in (e.g. 'pbkdf2:sha256' becomes 'pbkdf2:sha256:260000').
+            It's worked out from the method the same way werkzeug does,
+            so nothing is hashed and the pool and stats aren't touched.
+        '''
+        if not self.method.startswith('pbkdf2:'):
+            return self.method
+
+        name, colon, iterations = self.method[7:].partition(':')
+
+        if not colon:
+            iterations = DEFAULT_PBKDF2_ITERATIONS
+
+        return f'pbkdf2:{name}:{int(iterations or 0)}'
+
+    def needs_rehash(self, pwhash):
+        method, _, rest = pwhash.partition('$')
+        salt = rest.partition('$')[0]
+
+        return method != self.target_method or len(salt) != self.salt_length
+
+    def stats(self):
+        return {
+            'count': self.count,
+            'total_seconds': self.total_seconds,
+            'max_seconds': self.max_seconds,
+            'rejected': self.rejected,
+        }
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+
+
+def get_hasher():
+    return current_app.extensions['flaskr.hasher']
+
+def hash_password(password):
+    return get_hasher().hash(password)
+
+def verify_password(pwhash, password):
+    return get_hasher().verify(pwhash, password)
+
+def needs_rehash(pwhash):
+    return get_hasher().needs_rehash(pwhash)
+
+@click.command('hash-report')
+@with_appcontext
+def hash_report_command():
+    '''Show how many users have each password hash method'''
+    target = get_hasher().target_method
+    rows = get_db().execute(
+        "SELECT substr(password, 1, instr(password, '$') - 1) AS method,"
+        ' COUNT(*) AS users'
+        ' FROM user GROUP BY method ORDER BY users DESC'
+    )
+
+    for row in rows:
+        marker = ' (target)' if row['method'] == target else ''
+        click.echo(f"{row['method']}: {row['users']}{marker}")
+
+def init_app(app):
+    app.extensions['flaskr.hasher'] = PasswordHasher(
+        app.config['PASSWORD_HASH_METHOD'],
+        app.config['PASSWORD_SALT_LENGTH'],
+        workers=app.config['PASSWORD_HASH_WORKERS'],
+        queue_limit=app.config['PASSWORD_HASH_QUEUE_LIMIT'],
+    )
+    app.cli.add_command(hash_report_command)
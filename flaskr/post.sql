@@ -0,0 +1,86 @@
+-- The post tables, indexes and triggers. init-db runs this on DATABASE
+-- before schema.sql, and on every shard in DATABASE_SHARDS when posts
+-- are sharded (see flaskr.shards), so nothing here can refer to a table
+-- from schema.sql.
+
+DROP TABLE IF EXISTS post_fts;
+DROP TABLE IF EXISTS post;
+DROP TABLE IF EXISTS table_version;
+DROP VIEW IF EXISTS post_content;
+
+CREATE TABLE post (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  author_id INTEGER NOT NULL,
+  username TEXT,
+  created TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  title TEXT NOT NULL,
+  version INTEGER NOT NULL DEFAULT 0,
+  excerpt TEXT,
+  body_length INTEGER,
+  body TEXT NOT NULL,
+  body_z BLOB,
+  FOREIGN KEY (author_id) REFERENCES user (id)
+);
+
+-- excerpt and body_length are what listings show, so they come before
+-- body: a row's columns are stored in order, and a long body spills into
+-- overflow pages that reading the columns before it never touches.
+
+CREATE INDEX post_created_id ON post (created DESC, id DESC);
+CREATE INDEX post_author_created ON post (author_id, created DESC, id DESC);
+
+-- table_version counts changes to a table. It's bumped by triggers so
+-- anything that writes to post keeps it up to date, and reading one row
+-- is enough to tell if the posts have changed.
+CREATE TABLE table_version (
+  name TEXT PRIMARY KEY,
+  version INTEGER NOT NULL DEFAULT 0,
+  modified TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+INSERT INTO table_version (name) VALUES ('post');
+
+CREATE TRIGGER post_version_insert AFTER INSERT ON post BEGIN
+  UPDATE table_version SET version = version + 1, modified = CURRENT_TIMESTAMP
+  WHERE name = 'post';
+END;
+
+CREATE TRIGGER post_version_update AFTER UPDATE ON post BEGIN
+  UPDATE table_version SET version = version + 1, modified = CURRENT_TIMESTAMP
+  WHERE name = 'post';
+END;
+
+CREATE TRIGGER post_version_delete AFTER DELETE ON post BEGIN
+  UPDATE table_version SET version = version + 1, modified = CURRENT_TIMESTAMP
+  WHERE name = 'post';
+END;
+
+-- body_z holds the body compressed when it's long (see flaskr.compression),
+-- with body left empty. body_text(body, body_z) gives the text either way.
+-- It's a function flaskr registers on its connections, not built in.
+CREATE VIEW post_content AS
+  SELECT id, title, body_text(body, body_z) AS body FROM post;
+
+-- post_fts is a full text index over post titles and bodies. It stores no
+-- text of its own (content='post_content'), only the index, and the
+-- triggers below keep it in step with the post table.
+CREATE VIRTUAL TABLE post_fts USING fts5(
+  title, body, content='post_content', content_rowid='id'
+);
+
+CREATE TRIGGER post_fts_insert AFTER INSERT ON post BEGIN
+  INSERT INTO post_fts (rowid, title, body)
+  VALUES (new.id, new.title, body_text(new.body, new.body_z));
+END;
+
+CREATE TRIGGER post_fts_delete AFTER DELETE ON post BEGIN
+  INSERT INTO post_fts (post_fts, rowid, title, body)
+  VALUES ('delete', old.id, old.title, body_text(old.body, old.body_z));
+END;
+
+CREATE TRIGGER post_fts_update AFTER UPDATE OF title, body, body_z ON post BEGIN
+  INSERT INTO post_fts (post_fts, rowid, title, body)
+  VALUES ('delete', old.id, old.title, body_text(old.body, old.body_z));
+  INSERT INTO post_fts (rowid, title, body)
+  VALUES (new.id, new.title, body_text(new.body, new.body_z));
+END;
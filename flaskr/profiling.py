@@ -0,0 +1,229 @@
+import contextvars
+import threading
+import time
+from collections import defaultdict
+
+from flask import current_app, request
+from jinja2 import Template
+
+
+'''
+    Opt in request profiling, turned on with PROFILING=True.
+
+    Each request records how long it spent in a handful of phases:
+
+        user_load   load_logged_in_user
+        db_connect  get_db opening or borrowing a connection
+        sql         running statements and fetching their rows
+        db_write    write(), including waiting for a group commit
+        template    rendering templates
+        hash        hashing or checking passwords
+        total       the whole request
+
+    Phases can overlap (user_load includes the sql it runs). The timings
+    go out with the response in a Server-Timing header, which browser dev
+    tools show in the network panel, and are added up per endpoint, along
+    with per statement SQL timings and the cache and hashing counters, for
+    /metrics to export in the Prometheus text format.
+
+    Code marks a phase with "with phase('name'):", which does nothing when
+    profiling is off or outside a request.
+
+    The request's timings are kept in a ContextVar rather than on g.
+    Phases and statements are recorded several times a request, and each
+    trip through g's proxy took a few microseconds, which on its own came
+    to a couple of percent of the index.
+'''
+class RequestTimings(object):
+    __slots__ = ('start', 'phases', 'statements')
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.phases = defaultdict(float)
+        self.statements = defaultdict(lambda: [0, 0.0])
+
+_request_timings = contextvars.ContextVar('flaskr.request_timings', default=None)
+
+class phase(object):
+    # a plain class rather than @contextmanager, it's on the hot path
+    __slots__ = ('name', 'timings', 'start')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.timings = _request_timings.get()
+
+        if self.timings is not None:
+            self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        if self.timings is not None:
+            self.timings.phases[self.name] += time.perf_counter() - self.start
+
+
+class Metrics(object):
+    '''
+        Running totals since the process started. Sums and counts only,
+        so recording a request is a few additions under a lock.
+    '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = defaultdict(lambda: [0, 0.0])
+        self.phases = defaultdict(float)
+        self.statements = defaultdict(lambda: [0, 0.0])
+
+    def record_request(self, endpoint, timings):
+        with self._lock:
+            totals = self.requests[endpoint]
+            totals[0] += 1
+            totals[1] += timings.phases['total']
+
+            for name, seconds in timings.phases.items():
+                if name != 'total':
+                    self.phases[endpoint, name] += seconds
+
+            for sql, (count, seconds) in timings.statements.items():
+                totals = self.statements[sql]
+                totals[0] += count
+                totals[1] += seconds
+
+
+class TimedTemplate(Template):
+    def render(self, *args, **kwargs):
+        with phase('template'):
+            return super().render(*args, **kwargs)
+
+
+def get_metrics():
+    return current_app.extensions['flaskr.metrics']
+
+def start_timer():
+    _request_timings.set(RequestTimings())
+
+def stop_timer(e=None):
+    _request_timings.set(None)
+
+def record_statement(sql, parameters, seconds):
+    # added to the request's timings, Metrics gets them once at the end
+    timings = _request_timings.get()
+
+    if timings is not None:
+        timings.phases['sql'] += seconds
+        totals = timings.statements[sql]
+        totals[0] += 1
+        totals[1] += seconds
+
+def add_server_timing(response):
+    timings = _request_timings.get()
+
+    if timings is None:
+        return response
+
+    timings.phases['total'] = time.perf_counter() - timings.start
+    get_metrics().record_request(request.endpoint or 'none', timings)
+
+    response.headers['Server-Timing'] = ', '.join(
+        f'{name};dur={seconds * 1000:.2f}'
+        for name, seconds in timings.phases.items()
+    )
+    return response
+
+
+def _label(value):
+    return (str(value).replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+def render_metrics(metrics, app):
+    lines = [
+        '# HELP flaskr_request_seconds Time spent handling requests.',
+        '# TYPE flaskr_request_seconds summary',
+    ]
+    for endpoint, (count, total) in sorted(metrics.requests.items()):
+        label = f'endpoint="{_label(endpoint)}"'
+        lines.append(f'flaskr_request_seconds_count{{{label}}} {count}')
+        lines.append(f'flaskr_request_seconds_sum{{{label}}} {total:.6f}')
+
+    lines += [
+        '# HELP flaskr_phase_seconds_total Time spent in each request phase.',
+        '# TYPE flaskr_phase_seconds_total counter',
+    ]
+    for (endpoint, name), total in sorted(metrics.phases.items()):
+        lines.append(
+            f'flaskr_phase_seconds_total{{endpoint="{_label(endpoint)}",'
+            f'phase="{name}"}} {total:.6f}'
+        )
+
+    lines += [
+        '# HELP flaskr_sql_seconds Time spent running each SQL statement.',
+        '# TYPE flaskr_sql_seconds summary',
+    ]
+    for sql, (count, total) in sorted(metrics.statements.items()):
+        label = f'statement="{_label(sql)}"'
+        lines.append(f'flaskr_sql_seconds_count{{{label}}} {count}')
+        lines.append(f'flaskr_sql_seconds_sum{{{label}}} {total:.6f}')
+
+    lines += [
+        '# HELP flaskr_cache_requests_total Cache lookups by result.',
+        '# TYPE flaskr_cache_requests_total counter',
+    ]
+    for name in ('user_cache', 'fragment_cache'):
+        cache = app.extensions.get(f'flaskr.{name}')
+
+        if cache is not None:
+            lines.append(f'flaskr_cache_requests_total{{cache="{name}",result="hit"}} {cache.hits}')
+            lines.append(f'flaskr_cache_requests_total{{cache="{name}",result="miss"}} {cache.misses}')
+
+    hasher = app.extensions.get('flaskr.hasher')
+    if hasher is not None:
+        stats = hasher.stats()
+        lines += [
+            '# HELP flaskr_password_hash_seconds Time spent hashing passwords.',
+            '# TYPE flaskr_password_hash_seconds summary',
+            f"flaskr_password_hash_seconds_count {stats['count']}",
+            f"flaskr_password_hash_seconds_sum {stats['total_seconds']:.6f}",
+            '# HELP flaskr_password_hash_rejected_total Hashes refused with a 503.',
+            '# TYPE flaskr_password_hash_rejected_total counter',
+            f"flaskr_password_hash_rejected_total {stats['rejected']}",
+        ]
+
+    writer = app.extensions.get('flaskr.writer')
+    if writer is not None:
+        stats = writer.stats()
+        lines += [
+            '# HELP flaskr_group_commits_total Transactions committed by the writer.',
+            '# TYPE flaskr_group_commits_total counter',
+            f"flaskr_group_commits_total {stats['batches']}",
+            '# HELP flaskr_group_commit_writes_total Writes committed by the writer.',
+            '# TYPE flaskr_group_commit_writes_total counter',
+            f"flaskr_group_commit_writes_total {stats['writes']}",
+        ]
+
+    return '\n'.join(lines) + '\n'
+
+
+def init_app(app):
+    '''
+        Needs to run before the auth blueprint is registered, so the timer
+        starts before load_logged_in_user runs.
+    '''
+    if not app.config['PROFILING']:
+        return
+
+    from flaskr.auth import skip_user_load
+    from flaskr.db import get_statement_hooks
+
+    app.extensions['flaskr.metrics'] = Metrics()
+    get_statement_hooks(app).append(record_statement)
+    app.jinja_env.template_class = TimedTemplate
+    app.before_request(start_timer)
+    app.after_request(add_server_timing)
+    app.teardown_request(stop_timer)
+
+    @app.route('/metrics')
+    @skip_user_load
+    def metrics():
+        return current_app.response_class(
+            render_metrics(get_metrics(), current_app),
+            mimetype='text/plain; version=0.0.4',
+        )
@@ -1,5 +1,10 @@
 DROP TABLE IF EXISTS user;
-DROP TABLE IF EXISTS post;
+DROP TABLE IF EXISTS import_progress;
+DROP TABLE IF EXISTS session;
+DROP TABLE IF EXISTS compression_dict;
+DROP TABLE IF EXISTS shard_map;
+
+-- post.sql has already run, so post and table_version are there.
 
 CREATE TABLE user (
   id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -7,11 +12,76 @@ CREATE TABLE user (
   password TEXT NOT NULL
 );
 
-CREATE TABLE post (
-  id INTEGER PRIMARY KEY AUTOINCREMENT,
-  author_id INTEGER NOT NULL,
-  created TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
-  title TEXT NOT NULL,
-  body TEXT NOT NULL,
-  FOREIGN KEY (author_id) REFERENCES user (id)
-);
\ No newline at end of file
+-- username is a copy of the author's username, so listing posts and
+-- showing one reads the post table alone instead of joining user for
+-- every row. The triggers below fill it in for new posts and keep it in
+-- step when a post changes author or a user is renamed (which also bumps
+-- the version of their posts, since cached fragments show the name).
+-- flask check-usernames finds and repairs any copies that have drifted.
+-- Shards (see flaskr.shards) have no user table, so there the app sets
+-- username itself when it writes a post and only the copies here in
+-- DATABASE are kept by triggers. A rename doesn't reach the posts on
+-- the shards, check-usernames --fix updates those. insert_post sets username on new posts
+-- here as well, and the insert trigger only fills in the ones that come
+-- without it, e.g. from the sqlite3 shell, so a post is written once.
+CREATE TRIGGER post_username_insert AFTER INSERT ON post
+WHEN new.username IS NULL BEGIN
+  UPDATE post SET username = (SELECT username FROM user WHERE id = new.author_id)
+  WHERE id = new.id;
+END;
+
+CREATE TRIGGER post_username_author AFTER UPDATE OF author_id ON post BEGIN
+  UPDATE post SET username = (SELECT username FROM user WHERE id = new.author_id)
+  WHERE id = new.id;
+END;
+
+CREATE TRIGGER user_username_update AFTER UPDATE OF username ON user BEGIN
+  UPDATE post SET username = new.username, version = version + 1
+  WHERE author_id = new.id;
+END;
+
+-- The user version only counts changes to existing users. What it's for
+-- is telling caches of user rows to drop them (see CACHE_COHERENCE), and
+-- a new user can't be in a cache yet, so a registration leaves it alone.
+INSERT INTO table_version (name) VALUES ('user');
+
+CREATE TRIGGER user_version_update AFTER UPDATE ON user BEGIN
+  UPDATE table_version SET version = version + 1, modified = CURRENT_TIMESTAMP
+  WHERE name = 'user';
+END;
+
+CREATE TRIGGER user_version_delete AFTER DELETE ON user BEGIN
+  UPDATE table_version SET version = version + 1, modified = CURRENT_TIMESTAMP
+  WHERE name = 'user';
+END;
+
+-- compression_dict holds the dictionaries from flask train-body-dict.
+CREATE TABLE compression_dict (
+  id INTEGER PRIMARY KEY,
+  data BLOB NOT NULL,
+  created TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+-- import_progress remembers how many records of a file the bulk import
+-- commands have committed, so a failed import can resume from there.
+CREATE TABLE import_progress (
+  source TEXT PRIMARY KEY,
+  rows INTEGER NOT NULL
+);
+
+-- session holds server side sessions when SESSION_BACKEND is 'sqlite'.
+-- id is the random id in the session cookie, expires a unix time.
+CREATE TABLE session (
+  id TEXT PRIMARY KEY,
+  data TEXT NOT NULL,
+  expires REAL NOT NULL
+);
+
+CREATE INDEX session_expires ON session (expires);
+
+-- shard_map says which of DATABASE_SHARDS holds each bucket of posts
+-- when posts are sharded, see flaskr.shards. It's empty otherwise.
+CREATE TABLE shard_map (
+  bucket INTEGER PRIMARY KEY,
+  shard INTEGER NOT NULL
+);
@@ -0,0 +1,190 @@
+import secrets
+import threading
+import time
+
+from flask.sessions import SessionInterface, SessionMixin, session_json_serializer
+from werkzeug.datastructures import CallbackDict
+
+from flaskr.cache import LRUCache
+from flaskr.db import get_write_db
+from flaskr.writer import write
+
+
+'''
+    Server side sessions, turned on with SESSION_BACKEND.
+
+    Flask's default session is the whole session dict in a signed cookie.
+    It's checked with an HMAC on every request, signed again whenever it
+    changes, and the cookie grows with everything put in the session.
+    With a server side session, the cookie only holds a random session
+    id and the data stays on the server, in one of two stores:
+
+        'memory'  an LRUCache of up to SESSION_CACHE_SIZE sessions, per
+                  process. Sessions are lost on restart, or when the
+                  least recently used one is pushed out.
+        'sqlite'  the session table, shared by every worker.
+
+    Either way a session is found by its id in one lookup. Sessions expire
+    after PERMANENT_SESSION_LIFETIME. Expired ones are cleared out in a
+    single sweep at most every SESSION_SWEEP_INTERVAL seconds, rather
+    than checked one by one.
+
+    A session that's cleared, as login and logout do, gets a new id when
+    it's saved, so an id someone had before logging in is no use after.
+'''
+class ServerSideSession(CallbackDict, SessionMixin):
+    def __init__(self, initial=None, sid=None):
+        def on_update(self):
+            self.modified = True
+
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.modified = False
+        self.rotate = False
+
+    def clear(self):
+        super().clear()
+        self.rotate = True
+
+
+class MemorySessionStore(object):
+    def __init__(self, maxsize, lifetime):
+        self._cache = LRUCache(maxsize, ttl=lifetime)
+
+    def load(self, sid):
+        return self._cache.get(sid)
+
+    def save(self, sid, data):
+        self._cache.set(sid, data)
+
+    def delete(self, sid):
+        self._cache.delete(sid)
+
+    def sweep(self):
+        self._cache.expire()
+
+
+class SQLiteSessionStore(object):
+    '''
+        Uses the read-write connection even on GET requests, since the
+        read-only one may be a replica that hasn't seen a new login yet.
+    '''
+    def __init__(self, lifetime):
+        self.lifetime = lifetime
+
+    def load(self, sid):
+        row = get_write_db().execute(
+            'SELECT data FROM session WHERE id = ? AND expires > ?',
+            (sid, time.time())
+        ).fetchone()
+
+        return row['data'] if row is not None else None
+
+    def save(self, sid, data):
+        write(
+            'INSERT OR REPLACE INTO session (id, data, expires) VALUES (?, ?, ?)',
+            (sid, data, time.time() + self.lifetime)
+        )
+
+    def delete(self, sid):
+        write('DELETE FROM session WHERE id = ?', (sid,))
+
+    def sweep(self):
+        write('DELETE FROM session WHERE expires <= ?', (time.time(),))
+
+
+class ServerSideSessionInterface(SessionInterface):
+    serializer = session_json_serializer
+
+    def __init__(self, store, sweep_interval):
+        self.store = store
+        self.sweep_interval = sweep_interval
+        self._next_sweep = time.monotonic() + sweep_interval
+        self._lock = threading.Lock()
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(app.config['SESSION_COOKIE_NAME'])
+
+        if sid:
+            data = self.store.load(sid)
+
+            if data is not None:
+                return ServerSideSession(self.serializer.loads(data), sid)
+
+        return ServerSideSession()
+
+    def _sweep_if_due(self):
+        with self._lock:
+            now = time.monotonic()
+
+            if now < self._next_sweep:
+                return
+
+            self._next_sweep = now + self.sweep_interval
+
+        self.store.sweep()
+
+    def save_session(self, app, session, response):
+        name = app.config['SESSION_COOKIE_NAME']
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+
+        self._sweep_if_due()
+        response.vary.add('Cookie')
+
+        if not session:
+            if session.sid is not None:
+                self.store.delete(session.sid)
+                response.delete_cookie(name, domain=domain, path=path)
+
+            return
+
+        new_id = session.sid is None or session.rotate
+
+        if new_id:
+            if session.sid is not None:
+                self.store.delete(session.sid)
+
+            session.sid = secrets.token_urlsafe(32)
+
+        refresh = session.permanent and app.config['SESSION_REFRESH_EACH_REQUEST']
+
+        if new_id or session.modified or refresh:
+            self.store.save(session.sid, self.serializer.dumps(dict(session)))
+
+        if new_id or self.should_set_cookie(app, session):
+            response.set_cookie(
+                name,
+                session.sid,
+                expires=self.get_expiration_time(app, session),
+                httponly=self.get_cookie_httponly(app),
+                domain=domain,
+                path=path,
+                secure=self.get_cookie_secure(app),
+                samesite=self.get_cookie_samesite(app),
+            )
+
+
+def init_app(app):
+    '''
+        SESSION_BACKEND is None (Flask's signed cookie), 'memory' or
+        'sqlite'. The sqlite backend needs the session table from
+        schema.sql.
+    '''
+    backend = app.config['SESSION_BACKEND']
+
+    if backend is None:
+        return
+
+    lifetime = app.permanent_session_lifetime.total_seconds()
+
+    if backend == 'memory':
+        store = MemorySessionStore(app.config['SESSION_CACHE_SIZE'], lifetime)
+    elif backend == 'sqlite':
+        store = SQLiteSessionStore(lifetime)
+    else:
+        raise ValueError(f'Unknown SESSION_BACKEND {backend!r}')
+
+    app.session_interface = ServerSideSessionInterface(
+        store, app.config['SESSION_SWEEP_INTERVAL']
+    )
@@ -0,0 +1,509 @@
+import heapq
+
+import click
+from flask import current_app, g, request
+from flask.cli import with_appcontext
+from werkzeug.exceptions import abort
+
+from flaskr.db import create_post_tables, get_db, get_shard_count, get_shard_db
+
+
+'''
+    Sharding posts over several SQLite files, turned on by setting
+    DATABASE_SHARDS to a list of database paths.
+
+    SQLite lets one connection at a time write to a database file, so
+    with every post in DATABASE every post write queues on the same lock.
+    Each shard is a file with a lock (and group commit writer) of its
+    own, so writes to different shards go ahead side by side. Users,
+    sessions and the rest stay in DATABASE.
+
+    Posts are routed by author. An author's posts are in bucket
+    author_id % SHARD_BUCKETS, and the shard_map table in DATABASE says
+    which shard holds each bucket, so an author's posts are always
+    together and their page reads a single shard. There are many more
+    buckets than shards so that adding a shard means moving some whole
+    buckets onto it, see flask rebalance-shards.
+
+    A post's id carries its bucket, id % SHARD_BUCKETS, so get_post finds
+    the shard from the id alone and ids don't change when a bucket moves.
+    Each shard hands out ids in its buckets above the largest id it has
+    ever held, which sqlite_sequence keeps even for ids copied in from
+    another shard, so an id is never used twice. That makes SHARD_BUCKETS
+    fixed once there are posts.
+
+    The index and other listings read a page from every shard and merge
+    them, see owned_posts and merge_posts.
+
+    Posts keep a copy of their author's username. In DATABASE a trigger
+    updates the copies when a user is renamed, but triggers can't reach
+    another file, so posts on the shards keep the old name until flask
+    check-usernames --fix copies the new one over. Run it after renaming
+    users.
+'''
+
+# the next id in bucket ? for a new post, the parameters are
+# (SHARD_BUCKETS, SHARD_BUCKETS, bucket)
+NEW_POST_ID = (
+    '(SELECT (COALESCE(MAX(seq), 0) / ? + 1) * ? + ?'
+    " FROM sqlite_sequence WHERE name = 'post')"
+)
+
+def get_bucket_count():
+    return current_app.config['SHARD_BUCKETS']
+
+def shard_for_bucket(bucket):
+    row = get_db().execute(
+        'SELECT shard FROM shard_map WHERE bucket = ?', (bucket,)
+    ).fetchone()
+
+    if row is None:
+        raise LookupError(
+            f'Bucket {bucket} is not in shard_map, run flask rebalance-shards.'
+        )
+
+    return row['shard']
+
+def author_shard(author_id):
+    '''
+        The index of the shard that holds author_id's posts, None when
+        posts aren't sharded.
+    '''
+    if not get_shard_count():
+        return None
+
+    return shard_for_bucket(author_id % get_bucket_count())
+
+def post_shard(id):
+    '''
+        The index of the shard that holds post id, None when posts
+        aren't sharded.
+    '''
+    if not get_shard_count():
+        return None
+
+    return shard_for_bucket(id % get_bucket_count())
+
+def new_post_id(author_id):
+    '''
+        The SQL and parameters for a new post id in author_id's bucket,
+        to use inside an INSERT on the author's shard. It's worked out by
+        the INSERT itself so concurrent writers can't pick the same one.
+    '''
+    buckets = get_bucket_count()
+    return NEW_POST_ID, (buckets, buckets, author_id % buckets)
+
+def shard_db(shard):
+    # the connection for a shard index from the functions above
+    return get_db() if shard is None else get_shard_db(shard)
+
+def get_shard_map():
+    # bucket -> shard, read once per request
+    if 'shard_map' not in g:
+        g.shard_map = dict(
+            tuple(row) for row in get_db().execute('SELECT bucket, shard FROM shard_map')
+        )
+
+    return g.shard_map
+
+def get_post_shards(shards=None):
+    '''
+        (shard, connection) pairs for every database that holds posts, or
+        for the shards listed. shard is None when posts aren't sharded.
+    '''
+    if not get_shard_count():
+        return [(None, get_db())] if shards is None or shards else []
+
+    if shards is None:
+        shards = range(get_shard_count())
+
+    return [(shard, get_shard_db(shard)) for shard in shards]
+
+def owned_posts(shard, column='p.id'):
+    '''
+        A condition that keeps a query on shard to the posts in the
+        buckets shard_map puts there, None when posts aren't sharded.
+
+        While rebalance-shards is moving a bucket, and after a move that
+        was cut short, the shard it's leaving still has copies of its
+        posts, and they can be older than the live ones. Reading each post
+        only from the shard it belongs to keeps them out of listings, and
+        as it's part of the query a LIMIT still counts live posts only.
+    '''
+    if shard is None:
+        return None
+
+    buckets = [b for b, s in get_shard_map().items() if s == shard]
+    # only ints go in here, and it only needs the rowid
+    return f"{column} % {get_bucket_count()} IN ({', '.join(map(str, buckets))})"
+
+def merge_posts(streams, key, reverse=False):
+    '''
+        Merges rows that each stream already returns in key order into
+        one stream in that order, reading each stream only as far as the
+        merge needs. Each stream should come from a query limited with
+        owned_posts, so no post turns up twice.
+    '''
+    return heapq.merge(*streams, key=key, reverse=reverse)
+
+
+def plan_buckets(current, shard_count, bucket_count):
+    '''
+        Spreads the buckets evenly over shard_count shards, moving as few
+        as it can. Every shard keeps the buckets it has up to its share,
+        and the rest go to the shards furthest under theirs.
+    '''
+    shares = [
+        bucket_count // shard_count + (shard < bucket_count % shard_count)
+        for shard in range(shard_count)
+    ]
+    counts = [0] * shard_count
+    plan = {}
+    spare = []
+
+    for bucket in range(bucket_count):
+        shard = current.get(bucket)
+
+        if shard is not None and counts[shard] < shares[shard]:
+            plan[bucket] = shard
+            counts[shard] += 1
+        else:
+            spare.append(bucket)
+
+    for bucket in spare:
+        shard = min(range(shard_count), key=lambda s: counts[s] - shares[s])
+        plan[bucket] = shard
+        counts[shard] += 1
+
+    return plan
+
+def move_posts(source, plan, batch_size):
+    '''
+        Moves the buckets shard_map has on shard source that plan puts on
+        another shard: copies their posts over, switches shard_map, then
+        deletes them from source. Returns how many posts moved and how
+        many leftover copies were deleted.
+
+        Any posts on source in buckets shard_map has elsewhere are copies
+        left by a move that was cut short after shard_map was switched,
+        and may be older than the live ones, so they're deleted rather
+        than copied. For the same reason a target is cleared of the
+        buckets it's about to get before they're copied. So a move that
+        was cut short can simply be run again.
+    '''
+    buckets = get_bucket_count()
+    current = dict(
+        tuple(row) for row in get_db().execute('SELECT bucket, shard FROM shard_map')
+    )
+    moving = sorted(b for b in range(buckets) if current.get(b) == source != plan[b])
+    leftover = sorted(b for b in range(buckets) if current.get(b) != source)
+
+    db = get_shard_db(source)
+
+    # only ints go in these, and filtering on the rowid never reads a
+    # body for a post that stays
+    def in_buckets(chosen):
+        return f"id % {buckets} IN ({', '.join(map(str, chosen))})"
+
+    removed = db.execute(f'DELETE FROM post WHERE {in_buckets(leftover)}').rowcount
+    db.commit()
+
+    if not moving:
+        return 0, removed
+
+    targets = {}
+
+    for bucket in moving:
+        targets.setdefault(plan[bucket], []).append(bucket)
+
+    for target, target_buckets in targets.items():
+        target_db = get_shard_db(target)
+        target_db.execute(f'DELETE FROM post WHERE {in_buckets(target_buckets)}')
+        target_db.commit()
+
+    columns = [row['name'] for row in db.execute('PRAGMA table_info(post)')]
+    insert = (
+        f"INSERT INTO post ({', '.join(columns)})"
+        f" VALUES ({', '.join('?' * len(columns))})"
+    )
+
+    last_id = 0
+    moved = 0
+
+    while True:
+        rows = db.execute(
+            f"SELECT {', '.join(columns)} FROM post"
+            f' WHERE id > ? AND {in_buckets(moving)} ORDER BY id LIMIT ?',
+            (last_id, batch_size)
+        ).fetchall()
+
+        if not rows:
+            break
+
+        by_target = {}
+
+        for row in rows:
+            by_target.setdefault(plan[row['id'] % buckets], []).append(tuple(row))
+
+        for target, target_rows in by_target.items():
+            target_db = get_shard_db(target)
+            target_db.executemany(insert, target_rows)
+            target_db.commit()
+
+        last_id = rows[-1]['id']
+        moved += len(rows)
+
+    # the new shards have everything, so they can take over before the
+    # copies left here are deleted
+    get_db().executemany(
+        'UPDATE shard_map SET shard = ? WHERE bucket = ? AND shard = ?',
+        ((plan[bucket], bucket, source) for bucket in moving)
+    )
+    get_db().commit()
+    g.pop('shard_map', None)
+
+    db.execute(f'DELETE FROM post WHERE {in_buckets(moving)}')
+    db.commit()
+
+    return moved, removed
+
+'''
+    Turning sharding on for a database that already has posts leaves them
+    in DATABASE's own post table, which isn't read once DATABASE_SHARDS is
+    set. rebalance-shards moves them onto the shards (see
+    move_unsharded_posts), and until shard_map has every bucket and
+    DATABASE's post table is empty requests get a 503 with the reason,
+    rather than a blog with posts missing. Views that skip loading the
+    user, like /hello and /metrics, still answer, so health checks and
+    monitoring keep working meanwhile.
+'''
+def sharding_problem():
+    # why posts can't be served from the shards yet, None when they can
+    db = get_db()
+    mapped = 0
+
+    # databases from before sharding don't have the table
+    if db.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'shard_map'"
+    ).fetchone():
+        mapped = db.execute('SELECT COUNT(*) FROM shard_map').fetchone()[0]
+
+    if mapped < get_bucket_count():
+        return 'shard_map is missing buckets, run flask rebalance-shards.'
+
+    if db.execute('SELECT EXISTS (SELECT 1 FROM post)').fetchone()[0]:
+        return (
+            "DATABASE's own post table still has posts, run flask"
+            ' rebalance-shards to move them onto the shards.'
+        )
+
+    return None
+
+def check_sharding():
+    # once per process, it can only change by running a command
+    if current_app.extensions.get('flaskr.sharding_checked'):
+        return
+
+    endpoint = request.endpoint
+
+    if endpoint is None or endpoint.rsplit('.', 1)[-1] == 'static':
+        return
+
+    view = current_app.view_functions.get(endpoint)
+
+    if getattr(view, 'skip_user_load', False):
+        return
+
+    problem = sharding_problem()
+
+    if problem is not None:
+        abort(503, problem)
+
+    current_app.extensions['flaskr.sharding_checked'] = True
+
+def move_unsharded_posts(batch_size):
+    '''
+        Moves the posts in DATABASE's own post table onto the shards that
+        shard_map gives their authors' buckets. Returns how many moved.
+
+        Their ids don't carry their bucket, so each post gets the id
+        id * SHARD_BUCKETS + bucket, and links to the old ids break. As
+        the new id only depends on the old one, a batch that was copied
+        but not yet deleted here (the shards and DATABASE commit
+        separately) is copied over itself again on the next run. To keep
+        that from replacing a post that was already on a shard, the move
+        only starts while the shards are empty, and import_progress
+        marks it as under way until it's finished.
+    '''
+    db = get_db()
+    buckets = get_bucket_count()
+    count = db.execute('SELECT COUNT(*) FROM post').fetchone()[0]
+
+    if not count:
+        return 0
+
+    started = db.execute(
+        "SELECT 1 FROM import_progress WHERE source = 'unsharded-posts'"
+    ).fetchone()
+
+    if not started:
+        for index in range(get_shard_count()):
+            if get_shard_db(index).execute(
+                'SELECT EXISTS (SELECT 1 FROM post)'
+            ).fetchone()[0]:
+                raise click.UsageError(
+                    f'DATABASE has {count} posts of its own and shard {index}'
+                    ' has posts as well. Posts can only be moved from'
+                    ' DATABASE onto empty shards.'
+                )
+
+        db.execute(
+            'INSERT INTO import_progress (source, rows)'
+            " VALUES ('unsharded-posts', 0)"
+        )
+        db.commit()
+
+    shard_map = dict(
+        tuple(row) for row in db.execute('SELECT bucket, shard FROM shard_map')
+    )
+    columns = [
+        row['name'] for row in db.execute('PRAGMA table_info(post)')
+        if row['name'] != 'id'
+    ]
+    insert = (
+        f"INSERT OR REPLACE INTO post (id, {', '.join(columns)})"
+        f" VALUES ({', '.join('?' * (len(columns) + 1))})"
+    )
+    moved = 0
+
+    while True:
+        rows = db.execute(
+            f"SELECT id, {', '.join(columns)} FROM post ORDER BY id LIMIT ?",
+            (batch_size,)
+        ).fetchall()
+
+        if not rows:
+            break
+
+        by_shard = {}
+
+        for row in rows:
+            bucket = row['author_id'] % buckets
+            by_shard.setdefault(shard_map[bucket], []).append(
+                (row['id'] * buckets + bucket, *tuple(row)[1:])
+            )
+
+        for shard, shard_rows in by_shard.items():
+            shard_db = get_shard_db(shard)
+            shard_db.executemany(insert, shard_rows)
+            shard_db.commit()
+
+        db.executemany('DELETE FROM post WHERE id = ?', ((row['id'],) for row in rows))
+        db.execute(
+            "UPDATE import_progress SET rows = rows + ? WHERE source = 'unsharded-posts'",
+            (len(rows),)
+        )
+        db.commit()
+        moved += len(rows)
+        click.echo(f'{moved} of {count} posts moved from DATABASE', err=True)
+
+    db.execute("DELETE FROM import_progress WHERE source = 'unsharded-posts'")
+    db.commit()
+    return moved
+
+
+'''
+    rebalance-shards evens out the buckets over DATABASE_SHARDS, after
+    adding a shard to the end of the list for example, and is also what
+    sets the shards up when sharding is first turned on. A new shard file
+    gets the post tables first, and any posts still in DATABASE's own
+    post table are moved onto the shards. Shards can be added but not
+    taken away, since a bucket can only be moved off a shard that's
+    still listed.
+
+    Each bucket is copied to its new shard, shard_map is switched over,
+    and then the old copy is deleted, so reads find every post the whole
+    time. Writes to a bucket while it's moving can be lost, so run it
+    with writes stopped. Running it again finishes a move that was cut
+    short, and deletes the copies such a move left behind.
+'''
+@click.command('rebalance-shards')
+@click.option('--batch-size', default=1000, show_default=True)
+@click.option('--dry-run', is_flag=True, help='Only show what would move.')
+@with_appcontext
+def rebalance_shards_command(batch_size, dry_run):
+    '''Spread post buckets evenly over DATABASE_SHARDS'''
+    count = get_shard_count()
+
+    if not count:
+        raise click.UsageError('DATABASE_SHARDS is not set.')
+
+    db = get_db()
+    unsharded = db.execute('SELECT COUNT(*) FROM post').fetchone()[0]
+
+    # a database from before sharding doesn't have it yet
+    db.execute(
+        'CREATE TABLE IF NOT EXISTS shard_map'
+        ' (bucket INTEGER PRIMARY KEY, shard INTEGER NOT NULL)'
+    )
+    current = dict(
+        tuple(row) for row in db.execute('SELECT bucket, shard FROM shard_map')
+    )
+    missing = sorted({shard for shard in current.values() if shard >= count})
+
+    if missing:
+        raise click.UsageError(
+            f"shard_map uses shards {', '.join(map(str, missing))}, but"
+            f' DATABASE_SHARDS only lists {count}.'
+        )
+
+    plan = plan_buckets(current, count, get_bucket_count())
+
+    for bucket, shard in plan.items():
+        if current.get(bucket) != shard:
+            click.echo(f'bucket {bucket}: shard {current.get(bucket)} -> {shard}')
+
+    if unsharded:
+        click.echo(f"{unsharded} posts in DATABASE's own post table go onto the shards.")
+
+    if dry_run:
+        return
+
+    for index in range(count):
+        shard = get_shard_db(index)
+
+        if shard.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'post'"
+        ).fetchone() is None:
+            create_post_tables(shard)
+
+    # buckets that had no shard yet have no posts to move
+    db.executemany(
+        'INSERT OR IGNORE INTO shard_map (bucket, shard) VALUES (?, ?)',
+        plan.items()
+    )
+    db.commit()
+
+    if unsharded:
+        click.echo(
+            f'Moved {move_unsharded_posts(batch_size)} posts from DATABASE,'
+            ' post n now has id n * SHARD_BUCKETS + its bucket.'
+        )
+
+    moved = removed = 0
+
+    for index in range(count):
+        counts = move_posts(index, plan, batch_size)
+        moved += counts[0]
+        removed += counts[1]
+
+    click.echo(f'Moved {moved} posts.')
+
+    if removed:
+        click.echo(f'Deleted {removed} copies left by an earlier move.')
+
+def init_app(app):
+    app.cli.add_command(rebalance_shards_command)
+
+    if app.config['DATABASE_SHARDS']:
+        app.before_request(check_sharding)
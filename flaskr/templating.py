@@ -0,0 +1,76 @@
+import os
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from jinja2 import FileSystemBytecodeCache
+
+
+'''
+    Jinja compiles each template to Python bytecode the first time it's
+    used in a process, which every new worker pays for again. A bytecode
+    cache keeps the compiled code around, chosen with
+    TEMPLATE_BYTECODE_CACHE:
+
+        None          no cache, templates compile on first use
+        'filesystem'  files in TEMPLATE_BYTECODE_CACHE_DIR (instance/
+                      jinja_cache by default), shared by every worker
+                      and kept across restarts
+
+    There's no in-memory option. Within a process Jinja already keeps
+    compiled templates in env.cache, and workers forked after the
+    templates were loaded (gunicorn --preload) inherit that, so a second
+    copy of the bytecode in memory would never be read.
+
+    Jinja checks each cached entry against the template source, so a
+    changed template is compiled again rather than served stale.
+    flask precompile-templates fills the cache at deploy time.
+'''
+class DirectoryBytecodeCache(FileSystemBytecodeCache):
+    # the directory is created on the first write rather than when the
+    # app starts, so startup doesn't touch the filesystem for it
+    def dump_bytecode(self, bucket):
+        os.makedirs(self.directory, exist_ok=True)
+        super().dump_bytecode(bucket)
+
+
+def make_bytecode_cache(app):
+    kind = app.config['TEMPLATE_BYTECODE_CACHE']
+
+    if kind is None:
+        return None
+
+    if kind == 'filesystem':
+        directory = (app.config['TEMPLATE_BYTECODE_CACHE_DIR']
+                     or os.path.join(app.instance_path, 'jinja_cache'))
+        return DirectoryBytecodeCache(directory)
+
+    raise ValueError(f'Unknown TEMPLATE_BYTECODE_CACHE {kind!r}')
+
+@click.command('precompile-templates')
+@with_appcontext
+def precompile_templates_command():
+    '''Compile every template into the bytecode cache'''
+    env = current_app.jinja_env
+
+    if env.bytecode_cache is None:
+        raise click.UsageError('TEMPLATE_BYTECODE_CACHE is not set.')
+
+    names = env.list_templates()
+
+    for name in names:
+        env.get_template(name)
+
+    click.echo(f'Compiled {len(names)} templates.')
+
+def init_app(app):
+    '''
+        The cache goes in jinja_options, so this has to run before
+        anything touches app.jinja_env, which creates the environment.
+    '''
+    cache = make_bytecode_cache(app)
+
+    if cache is not None:
+        app.jinja_options = dict(app.jinja_options, bytecode_cache=cache)
+
+    app.cli.add_command(precompile_templates_command)
@@ -0,0 +1,269 @@
+import csv
+import json
+import os
+import sys
+import time
+from itertools import chain, islice
+
+import click
+from flask.cli import with_appcontext
+
+from flaskr.db import get_db, get_shard_count, get_shard_db
+from flaskr.shards import (
+    NEW_POST_ID, get_bucket_count, get_post_shards, merge_posts, new_post_id,
+    owned_posts, shard_for_bucket
+)
+
+
+'''
+    Bulk loading and dumping of posts and users from the command line.
+
+    Files are read and written a record at a time, and rows are inserted
+    with executemany in batches of --batch-size, one transaction per batch,
+    so memory use doesn't grow with the size of the file.
+
+    Every batch also records in import_progress how many records of that
+    file have been committed, in the same transaction as the rows. If an
+    import fails, running it again on the same file skips what's already
+    in and picks up from the last committed batch.
+
+    With shards (see flaskr.shards), posts are written to their author's
+    shard and exported from all of them in id order. The shards commit
+    before import_progress does, so a failure between the two can mean a
+    resumed import writes that batch again.
+'''
+COLUMNS = {
+    'post': ('id', 'author_id', 'created', 'title', 'body'),
+    'user': ('id', 'username', 'password'),
+}
+
+def read_records(f, fmt):
+    if fmt == 'csv':
+        yield from csv.DictReader(f)
+    else:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+def write_records(f, fmt, columns, rows):
+    if fmt == 'csv':
+        writer = csv.writer(f)
+        writer.writerow(columns)
+        for row in rows:
+            writer.writerow(row)
+    else:
+        for row in rows:
+            f.write(json.dumps(dict(zip(columns, row)), default=str) + '\n')
+
+def detect_format(path, fmt):
+    if fmt is not None:
+        return fmt
+
+    return 'csv' if path.endswith('.csv') else 'jsonl'
+
+def report(count, start):
+    elapsed = time.perf_counter() - start
+    rate = count / elapsed if elapsed > 0 else 0
+    click.echo(f'{count} rows in {elapsed:.1f}s ({rate:.0f} rows/s)', err=True)
+
+def import_rows(table, path, fmt=None, batch_size=10000):
+    db = get_db()
+    fmt = detect_format(path, fmt)
+    source = None if path == '-' else f'{table}:{os.path.abspath(path)}'
+
+    done = 0
+    if source is not None:
+        row = db.execute(
+            'SELECT rows FROM import_progress WHERE source = ?', (source,)
+        ).fetchone()
+        done = row['rows'] if row is not None else 0
+
+    if done:
+        click.echo(f'Resuming after {done} rows already imported.', err=True)
+
+    f = sys.stdin if path == '-' else open(path, newline='')
+
+    try:
+        records = islice(read_records(f, fmt), done, None)
+        first = next(records, None)
+
+        if first is None:
+            click.echo('Nothing to import.', err=True)
+            return 0
+
+        columns = [c for c in first if c in COLUMNS[table]]
+        unknown = set(first) - set(columns)
+        if unknown:
+            raise click.UsageError(
+                f"Unknown {table} columns: {', '.join(sorted(unknown))}"
+            )
+
+        query = (
+            f"INSERT INTO {table} ({', '.join(columns)})"
+            f" VALUES ({', '.join(':' + c for c in columns)})"
+        )
+
+        records = chain([first], records)
+        imported = 0
+        start = time.perf_counter()
+
+        while True:
+            batch = list(islice(records, batch_size))
+
+            if not batch:
+                break
+
+            if table == 'post' and get_shard_count():
+                insert_sharded_posts(batch, columns)
+            else:
+                db.executemany(query, batch)
+
+            imported += len(batch)
+
+            if source is not None:
+                db.execute(
+                    'INSERT OR REPLACE INTO import_progress (source, rows)'
+                    ' VALUES (?, ?)',
+                    (source, done + imported)
+                )
+
+            db.commit()
+            report(imported, start)
+
+        if source is not None:
+            db.execute('DELETE FROM import_progress WHERE source = ?', (source,))
+            db.commit()
+
+        return imported
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+def insert_sharded_posts(records, columns):
+    '''
+        Writes a batch of post records to their authors' shards. A post
+        keeps its id if it has one, which has to be in the author's bucket
+        (as ids from a sharded export are), and gets a new one otherwise.
+        Shards have no user table to fill in username, so it's looked up
+        here.
+    '''
+    buckets = get_bucket_count()
+    authors = sorted({int(record['author_id']) for record in records})
+    usernames = dict(tuple(row) for row in get_db().execute(
+        f"SELECT id, username FROM user WHERE id IN ({', '.join('?' * len(authors))})",
+        authors
+    ))
+    names = [c for c in columns if c != 'id']
+    placeholders = ', '.join('?' * (len(names) + 1))
+
+    if 'id' in columns:
+        query = f"INSERT INTO post (id, {', '.join(names)}, username) VALUES (?, {placeholders})"
+    else:
+        query = f"INSERT INTO post (id, {', '.join(names)}, username) VALUES ({NEW_POST_ID}, {placeholders})"
+
+    shards = {}
+    by_shard = {}
+
+    for record in records:
+        author_id = int(record['author_id'])
+        bucket = author_id % buckets
+
+        if 'id' not in columns:
+            head = new_post_id(author_id)[1]
+        elif int(record['id']) % buckets == bucket:
+            head = (record['id'],)
+        else:
+            raise click.UsageError(
+                f"Post {record['id']} isn't in its author's shard bucket,"
+                ' import the file without the id column to give it a new id.'
+            )
+
+        if bucket not in shards:
+            shards[bucket] = shard_for_bucket(bucket)
+
+        by_shard.setdefault(shards[bucket], []).append(
+            (*head, *(record[c] for c in names), usernames.get(author_id))
+        )
+
+    for shard, rows in by_shard.items():
+        shard_db = get_shard_db(shard)
+        shard_db.executemany(query, rows)
+        shard_db.commit()
+
+def fetch_batches(cursor, size):
+    while True:
+        batch = cursor.fetchmany(size)
+
+        if not batch:
+            return
+
+        yield from batch
+
+# exported as the plain text, however it's stored
+EXPORT_EXPRESSIONS = {
+    'body': 'body_text(body, body_z) AS body',
+}
+
+def export_rows(table, f, fmt='jsonl', batch_size=10000):
+    columns = COLUMNS[table]
+    select = ', '.join(EXPORT_EXPRESSIONS.get(c, c) for c in columns)
+    shards = get_post_shards() if table == 'post' else [(None, get_db())]
+
+    def shard_query(shard):
+        owned = owned_posts(shard, 'id')
+        where = f' WHERE {owned}' if owned else ''
+        return f'SELECT {select} FROM {table}{where} ORDER BY id'
+
+    rows = merge_posts(
+        (fetch_batches(db.execute(shard_query(shard)), batch_size)
+         for shard, db in shards),
+        key=lambda row: row['id'],
+    )
+
+    start = time.perf_counter()
+    exported = 0
+
+    def counted():
+        nonlocal exported
+
+        for row in rows:
+            exported += 1
+            yield tuple(row)
+
+    write_records(f, fmt, columns, counted())
+    report(exported, start)
+    return exported
+
+
+def make_commands(table, name):
+    @click.command(f'import-{name}',
+                   help=f'Load {name} from a JSONL or CSV file.')
+    @click.argument('path', type=click.Path(dir_okay=False, allow_dash=True))
+    @click.option('--format', 'fmt', type=click.Choice(('jsonl', 'csv')),
+                  help='Defaults to csv for .csv files, jsonl otherwise.')
+    @click.option('--batch-size', default=10000, show_default=True)
+    @with_appcontext
+    def import_command(path, fmt, batch_size):
+        import_rows(table, path, fmt, batch_size)
+
+    @click.command(f'export-{name}',
+                   help=f'Write all {name} to a JSONL or CSV file.')
+    @click.argument('path', type=click.Path(dir_okay=False, allow_dash=True))
+    @click.option('--format', 'fmt', type=click.Choice(('jsonl', 'csv')),
+                  help='Defaults to csv for .csv files, jsonl otherwise.')
+    @click.option('--batch-size', default=10000, show_default=True)
+    @with_appcontext
+    def export_command(path, fmt, batch_size):
+        fmt = detect_format(path, fmt)
+
+        if path == '-':
+            export_rows(table, sys.stdout, fmt, batch_size)
+        else:
+            with open(path, 'w', newline='') as f:
+                export_rows(table, f, fmt, batch_size)
+
+    return import_command, export_command
+
+
+import_posts_command, export_posts_command = make_commands('post', 'posts')
+import_users_command, export_users_command = make_commands('user', 'users')
@@ -0,0 +1,221 @@
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+
+from flask import current_app
+
+from flaskr.db import (
+    connect, get_shard_db, get_write_db, logged_as, statement_source
+)
+from flaskr.profiling import phase
+
+
+'''
+    Group commit for writes, turned on by setting WRITE_BATCH_WINDOW.
+
+    Normally every write commits on its own, so each one takes SQLite's
+    write lock and pays for its own sync to disk, and a burst of writers
+    queues up behind each other. With group commit, writes are handed to
+    a single writer thread instead. It waits up to WRITE_BATCH_WINDOW
+    seconds (or until WRITE_BATCH_MAX writes are waiting) and commits
+    everything that arrived in one transaction.
+
+    A request only gets its result once that commit has finished. The
+    writer's connection uses synchronous=FULL, so a commit is on disk by
+    the time it returns, and one sync now covers the whole batch.
+
+    Each write runs inside its own SAVEPOINT. If one fails, e.g. with an
+    IntegrityError on a duplicate username or a statement hook raising,
+    only that write is rolled back. The error is raised in the request
+    that made the write, and the rest of the batch still commits. If the
+    batch itself fails, every write in it gets the error, and the writer
+    carries on with the next batch either way, so no request is left
+    waiting on a thread that has died. Requests also stop waiting after
+    WRITE_BATCH_TIMEOUT seconds, whatever the writer is doing.
+
+    With DATABASE_SHARDS set, each shard gets a writer of its own, since
+    each shard file has its own write lock.
+'''
+class GroupCommitWriter(object):
+    def __init__(self, app, window, max_batch=64, database=None):
+        self.app = app
+        self.window = window
+        self.max_batch = max_batch
+        self.database = database
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+        self.batches = 0
+        self.writes = 0
+
+    def _connect(self):
+        # an app context is only needed to read the config, the writer's
+        # statements run outside it so request hooks leave them alone
+        with self.app.app_context():
+            db = connect(database=self.database)
+
+        db.execute('PRAGMA synchronous = FULL')
+        return db
+
+    def _start(self):
+        # started on the first write, like the hashing pool, which keeps
+        # the thread out of processes that fork after the app is created
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, args=(self._connect(),), daemon=True
+                )
+                self._thread.start()
+
+    def submit(self, sql, parameters=()):
+        '''
+            Queues a write and returns a Future for the new row's id. The
+            Future is set once the write has been committed, or with the
+            error if it failed.
+        '''
+        self._start()
+        future = Future()
+        # who made the write, for the statement log
+        self._queue.put((sql, parameters, future, statement_source()))
+        return future
+
+    def _collect(self, first):
+        batch = [first]
+        deadline = time.monotonic() + self.window
+
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+
+            try:
+                item = self._queue.get(timeout=max(remaining, 0))
+            except queue.Empty:
+                break
+
+            if item is None:
+                self._queue.put(None)
+                break
+
+            batch.append(item)
+
+        return batch
+
+    def _run(self, db):
+        while True:
+            item = self._queue.get()
+
+            if item is None:
+                db.close()
+                return
+
+            batch = self._collect(item)
+
+            try:
+                self._commit(db, batch)
+            except BaseException as e:
+                # the whole batch failed, e.g. the commit itself. The
+                # thread has to outlive it or later writes would wait
+                # forever
+                for sql, parameters, future, source in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+                try:
+                    db.rollback()
+                except sqlite3.Error:
+                    # a broken connection, the next batch will fail too
+                    pass
+
+    def _commit(self, db, batch):
+        results = []
+        db.execute('BEGIN IMMEDIATE')
+
+        for sql, parameters, future, source in batch:
+            db.execute('SAVEPOINT write')
+
+            try:
+                with logged_as(source):
+                    results.append(db.execute(sql, parameters).lastrowid)
+            except Exception as e:
+                db.execute('ROLLBACK TO write')
+                results.append(e)
+
+            db.execute('RELEASE write')
+
+        db.commit()
+
+        self.batches += 1
+        self.writes += sum(
+            not isinstance(result, Exception) for result in results
+        )
+
+        for (sql, parameters, future, source), result in zip(batch, results):
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    def stats(self):
+        return {'batches': self.batches, 'writes': self.writes}
+
+    def close(self):
+        with self._lock:
+            if self._thread is not None:
+                self._queue.put(None)
+                self._thread.join()
+                self._thread = None
+
+
+def get_writer(shard=None):
+    if shard is None:
+        return current_app.extensions.get('flaskr.writer')
+
+    writers = current_app.extensions.get('flaskr.shard_writers')
+    return writers[shard] if writers is not None else None
+
+def write(sql, parameters=(), shard=None):
+    '''
+        Runs one INSERT, UPDATE or DELETE and commits it, through the
+        group commit writer when it's on. Returns the new row's id and
+        raises the same sqlite3 errors a direct execute would. shard is
+        the index of the shard to write to, None for DATABASE.
+    '''
+    writer = get_writer(shard)
+
+    with phase('db_write'):
+        if writer is not None:
+            return writer.submit(sql, parameters).result(
+                timeout=current_app.config['WRITE_BATCH_TIMEOUT']
+            )
+
+        db = get_write_db() if shard is None else get_shard_db(shard)
+        cursor = db.execute(sql, parameters)
+        db.commit()
+        return cursor.lastrowid
+
+def init_app(app):
+    '''
+        WRITE_BATCH_WINDOW is in seconds, None commits every write on its
+        own. WRITE_BATCH_MAX caps how many writes go in one transaction.
+        WRITE_BATCH_TIMEOUT is how many seconds a request waits for its
+        write before write() raises concurrent.futures.TimeoutError.
+    '''
+    if app.config['WRITE_BATCH_WINDOW'] is not None:
+        app.extensions['flaskr.writer'] = GroupCommitWriter(
+            app,
+            app.config['WRITE_BATCH_WINDOW'],
+            max_batch=app.config['WRITE_BATCH_MAX'],
+        )
+
+        if app.config['DATABASE_SHARDS']:
+            app.extensions['flaskr.shard_writers'] = [
+                GroupCommitWriter(
+                    app,
+                    app.config['WRITE_BATCH_WINDOW'],
+                    max_batch=app.config['WRITE_BATCH_MAX'],
+                    database=database,
+                )
+                for database in app.config['DATABASE_SHARDS']
+            ]
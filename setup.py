@@ -9,6 +9,10 @@ setup(
     install_requires=[
         'flask',
     ],
+    extras_require={
+        'async': ['flask[async]'],
+        'asgi': ['a2wsgi'],
+    },
 )
 
 '''
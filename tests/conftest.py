@@ -2,7 +2,7 @@ import os
 import tempfile
 
 import pytest
-from flaskr import create_app
+from flaskr import close_app, create_app
 from flaskr.db import get_db, init_db
 
 with open(os.path.join(os.path.dirname(__file__), 'data.sql'), 'rb') as f:
@@ -23,8 +23,35 @@ def app():
 
     yield app
 
+    close_app(app)
     os.close(db_fd)
-    os.unlink(db_path)
+
+    for path in (db_path, db_path + '-wal', db_path + '-shm'):
+        if os.path.exists(path):
+            os.unlink(path)
+
+@pytest.fixture
+def make_app(app):
+    '''
+        make_app(**config) creates another app on the app fixture's
+        database, with config added, for tests of the opt in features.
+        Their writer threads, pools and hashing workers are closed at
+        the end of the test, before the database is removed.
+    '''
+    apps = []
+
+    def make_app(**config):
+        apps.append(create_app({
+            'TESTING': True,
+            'DATABASE': app.config['DATABASE'],
+            **config,
+        }))
+        return apps[-1]
+
+    yield make_app
+
+    for made in apps:
+        close_app(made)
 
 @pytest.fixture
 def client(app):
@@ -41,7 +68,8 @@ def runner(app):
     points to this temporary path insead of the instance folder.
 
     After setting the path, the database tables are created and the test data
-    is inserted. After the test is over, the temporary file is closed and removed.
+    is inserted. After the test is over, the temporary file is closed and removed,
+    along with the -wal and -shm files SQLite keeps next to it in WAL mode.
 
     TESTING tells Flask that the app is in test mode. Flask changes some internal
     behaviour so it is easier to test. Other extensions can also use the flag to
@@ -0,0 +1,89 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip('asgiref')
+
+from conftest import AuthActions
+from flaskr.aio import AsyncConnection, get_async_db
+from flaskr.db import get_db
+
+
+'''
+    The same database as the app fixture, with ASYNC_VIEWS turned on.
+'''
+@pytest.fixture
+def async_app(make_app):
+    return make_app(ASYNC_VIEWS=True)
+
+@pytest.fixture
+def async_client(async_app):
+    return async_app.test_client()
+
+def test_views_replaced(app, async_app):
+    assert not asyncio.iscoroutinefunction(app.view_functions['blog.index'])
+    assert asyncio.iscoroutinefunction(async_app.view_functions['blog.index'])
+    assert asyncio.iscoroutinefunction(async_app.view_functions['auth.login'])
+
+def test_index(async_client):
+    response = async_client.get('/')
+    assert b'test title' in response.data
+    assert response.headers['ETag']
+
+    response = async_client.get(
+        '/', headers={'If-None-Match': response.headers['ETag']}
+    )
+    assert response.status_code == 304
+
+def test_register_and_login(async_client, async_app):
+    response = async_client.post(
+        '/auth/register', data={'username': 'a', 'password': 'a'}
+    )
+    assert response.headers['Location'] == 'http://localhost/auth/login'
+
+    response = async_client.post(
+        '/auth/register', data={'username': 'a', 'password': 'a'}
+    )
+    assert b'already registered' in response.data
+
+    auth = AuthActions(async_client)
+    assert auth.login('a', 'b').status_code == 200
+    assert auth.login('a', 'a').headers['Location'] == 'http://localhost/'
+
+def test_write_views(async_client, async_app):
+    AuthActions(async_client).login()
+
+    assert async_client.get('/create').status_code == 200
+    async_client.post('/create', data={'title': 'created', 'body': ''})
+    async_client.post('/1/update', data={'title': 'updated', 'body': ''})
+
+    with async_app.app_context():
+        db = get_db()
+        assert db.execute('SELECT COUNT(id) FROM post').fetchone()[0] == 2
+        assert db.execute(
+            'SELECT title FROM post WHERE id = 1'
+        ).fetchone()[0] == 'updated'
+
+    assert async_client.post('/2/delete').headers['Location'] == 'http://localhost/'
+    assert async_client.post('/2/update').status_code == 404
+
+    with async_app.app_context():
+        assert get_db().execute('SELECT COUNT(id) FROM post').fetchone()[0] == 1
+
+def test_login_required(async_client):
+    response = async_client.post('/create')
+    assert response.headers['Location'] == 'http://localhost/auth/login'
+
+def test_async_connection(app):
+    async def query():
+        db = await get_async_db()
+        assert isinstance(db, AsyncConnection)
+        assert db.db is get_db()
+
+        await db.execute("UPDATE user SET username = 'async' WHERE id = 1")
+        await db.commit()
+        rows = await db.fetchall('SELECT username FROM user ORDER BY id')
+        return [row[0] for row in rows]
+
+    with app.app_context():
+        assert asyncio.run(query()) == ['async', 'other']
@@ -0,0 +1,70 @@
+import asyncio
+import time
+
+import pytest
+
+pytest.importorskip('a2wsgi')
+pytest.importorskip('asgiref')
+
+from asgiref.testing import ApplicationCommunicator
+
+from flaskr.asgi import create_asgi_app
+
+
+'''
+    The ASGI app, on the same database as the app fixture.
+'''
+@pytest.fixture
+def asgi_app(app):
+    return create_asgi_app({
+        'TESTING': True,
+        'DATABASE': app.config['DATABASE'],
+    })
+
+'''
+    Drives the ASGI app by hand with the messages an ASGI server would
+    send for a GET.
+'''
+async def asgi_get(asgi_app, path):
+    communicator = ApplicationCommunicator(asgi_app, {
+        'type': 'http',
+        'http_version': '1.1',
+        'method': 'GET',
+        'path': path,
+        'raw_path': path.encode(),
+        'root_path': '',
+        'scheme': 'http',
+        'query_string': b'',
+        'headers': [(b'host', b'localhost')],
+        'server': ('localhost', 80),
+        'client': ('127.0.0.1', 1234),
+    })
+    await communicator.send_input({'type': 'http.request', 'body': b''})
+    start = await communicator.receive_output(5)
+    body = await communicator.receive_output(5)
+    return start, body
+
+def test_asgi_app(asgi_app):
+    start, body = asyncio.run(asgi_get(asgi_app, '/hello'))
+    assert start['status'] == 200
+    assert body['body'] == b'Hello, World!'
+
+def test_asgi_requests_overlap(asgi_app):
+    def slow():
+        time.sleep(0.5)
+        return 'done'
+
+    asgi_app.app.add_url_rule('/slow', 'slow', slow)
+
+    async def get_slow_four_times():
+        return await asyncio.gather(
+            *(asgi_get(asgi_app, '/slow') for _ in range(4))
+        )
+
+    start = time.perf_counter()
+    responses = asyncio.run(get_slow_four_times())
+    elapsed = time.perf_counter() - start
+
+    assert [body['body'] for _, body in responses] == [b'done'] * 4
+    # one after another would take 2s
+    assert elapsed < 1.5
@@ -1,6 +1,7 @@
 import pytest
 from flask import g, session
-from flaskr.db import get_db 
+from flaskr.auth import invalidate_user
+from flaskr.db import get_db
 
 def test_register(client, app):
     assert client.get('/auth/register').status_code == 200
@@ -82,4 +83,77 @@ def test_logout(client, auth):
 
     with client:
         auth.logout()
-        assert 'user_id' not in session 
\ No newline at end of file
+        assert 'user_id' not in session 
+
+''' 
+    Once a user has been loaded it should come from the user cache, so
+    changes made directly in the database aren't seen until the entry
+    is invalidated.
+'''
+def test_user_cache(client, auth, app):
+    auth.login()
+
+    with client:
+        client.get('/')
+        assert g.user['username'] == 'test'
+
+    with app.app_context():
+        db = get_db()
+        db.execute("UPDATE user SET username = 'renamed' WHERE id = 1")
+        db.commit()
+
+    with client:
+        client.get('/')
+        assert g.user['username'] == 'test'
+        assert app.extensions['flaskr.user_cache'].hits >= 1
+
+    with app.app_context():
+        invalidate_user(1)
+
+    with client:
+        client.get('/')
+        assert g.user['username'] == 'renamed'
+
+
+def test_user_cache_disabled(app, client, auth):
+    app.extensions.pop('flaskr.user_cache')
+    auth.login()
+
+    with client:
+        client.get('/')
+        assert g.user['username'] == 'test'
+
+
+def test_skip_user_load(client, auth, monkeypatch):
+    auth.login()
+
+    def fail(id):
+        raise AssertionError('user should not be loaded')
+
+    monkeypatch.setattr('flaskr.auth.get_user', fail)
+
+    with client:
+        assert client.get('/hello').data == b'Hello, World!'
+        assert g.user is None
+
+
+''' 
+    The test users' hashes use fewer pbkdf2 iterations than the configured
+    method, so logging in should replace the stored hash with one using
+    the configured method, which still accepts the same password.
+'''
+def test_login_rehashes_password(client, auth, app):
+    auth.login()
+
+    with app.app_context():
+        pwhash = get_db().execute(
+            'SELECT password FROM user WHERE id = 1'
+        ).fetchone()['password']
+
+    assert pwhash.startswith('pbkdf2:sha256:260000$')
+    assert auth.login().headers['Location'] == 'http://localhost/'
+
+    with app.app_context():
+        assert get_db().execute(
+            'SELECT password FROM user WHERE id = 1'
+        ).fetchone()['password'] == pwhash
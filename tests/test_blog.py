@@ -1,5 +1,8 @@
+from urllib.parse import unquote_plus, urlencode
+
 import pytest
-from flaskr.db import get_db
+from flaskr.blog import EXCERPT_LENGTH, get_posts_page, make_excerpt
+from flaskr.db import get_db, get_table_version
 
 ''' 
     all of the blog views use the auth fixture. Call auth.login()
@@ -122,3 +125,419 @@ def test_delete(client, auth, app):
         post = db.execute('SELECT * FROM post WHERE id = 1').fetchone()
         assert post is None
 
+
+
+''' 
+    The index is paged with keyset cursors. With a page size of one, each
+    page should hold a single post, and following the Older/Newer links
+    should walk through every post exactly once in both directions.
+'''
+
+def page_link(direction, cursor):
+    return f'href="/?{urlencode({direction: cursor})}"'.encode()
+
+def test_index_pagination(client, app):
+    app.config['POSTS_PER_PAGE'] = 1
+
+    with app.app_context():
+        db = get_db()
+        db.executemany(
+            'INSERT INTO post (title, body, author_id, created)'
+            ' VALUES (?, ?, 1, ?)',
+            (('second', '', '2018-01-02 00:00:00'),
+             ('third', '', '2018-01-02 00:00:00'))
+        )
+        db.commit()
+
+    response = client.get('/')
+    assert b'third' in response.data
+    assert b'Newer' not in response.data
+    assert page_link('after', '2018-01-02 00:00:00,3') in response.data
+
+    response = client.get('/?after=2018-01-02+00:00:00,3')
+    assert b'second' in response.data
+    assert b'third' not in response.data
+
+    response = client.get('/?after=2018-01-02+00:00:00,2')
+    assert b'test title' in response.data
+    assert b'Older' not in response.data
+    assert page_link('before', '2018-01-01 00:00:00,1') in response.data
+
+    response = client.get('/?before=2018-01-01+00:00:00,1')
+    assert b'second' in response.data
+    assert b'Older' in response.data
+    assert b'Newer' in response.data
+
+
+@pytest.mark.parametrize('cursor', ('nonsense', 'bad,1', '2018-01-01,x'))
+def test_index_invalid_cursor(client, cursor):
+    assert client.get('/', query_string={'after': cursor}).status_code == 400
+
+
+''' 
+    Posts on the index are rendered from cached fragments. Editing a post
+    bumps its version so the next index shows the new content, while the
+    Edit link is still rendered per user.
+'''
+
+def test_fragment_cache(client, auth, app):
+    client.get('/')
+    cache = app.extensions['flaskr.fragment_cache']
+    assert len(cache) == 1
+
+    response = client.get('/')
+    assert cache.hits == 1
+    assert b'href="/1/update"' not in response.data
+
+    auth.login()
+    response = client.get('/')
+    assert b'test title' in response.data
+    assert b'href="/1/update"' in response.data
+
+    client.post('/1/update', data={'title': 'updated', 'body': ''})
+    response = client.get('/')
+    assert b'updated' in response.data
+    assert b'test title' not in response.data
+
+    client.post('/1/delete')
+    assert len(cache) == 0
+
+
+def test_fragment_cache_disabled(client, app):
+    app.extensions.pop('flaskr.fragment_cache')
+    assert b'test title' in client.get('/').data
+
+
+def test_fragment_escapes_content(client, app):
+    with app.app_context():
+        db = get_db()
+        db.execute("UPDATE post SET title = '<edit-link>' WHERE id = 1")
+        db.commit()
+
+    response = client.get('/')
+    assert b'&lt;edit-link&gt;' in response.data
+
+
+''' 
+    The index sends an ETag. Sending it back should get a 304 without the
+    posts being queried, until a post changes or a different user asks for
+    the page. There's no Last-Modified, so If-Modified-Since alone always
+    gets the full page.
+'''
+
+def test_index_conditional_get(client, auth, monkeypatch):
+    response = client.get('/')
+    etag = response.headers['ETag']
+    assert 'Last-Modified' not in response.headers
+    assert response.headers['Cache-Control'] == 'no-cache'
+
+    def fail(**kwargs):
+        raise AssertionError('posts should not be queried')
+
+    with monkeypatch.context() as m:
+        m.setattr('flaskr.blog.get_posts_page', fail)
+        response = client.get('/', headers={'If-None-Match': etag})
+        assert response.status_code == 304
+        assert response.data == b''
+
+    response = client.get('/', headers={
+        'If-Modified-Since': 'Fri, 01 Jan 2100 00:00:00 GMT'
+    })
+    assert response.status_code == 200
+
+    auth.login()
+    response = client.get('/', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    etag = response.headers['ETag']
+
+    client.post('/create', data={'title': 'created', 'body': ''})
+    response = client.get('/', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert b'created' in response.data
+
+
+''' 
+    Search should find posts by title or body through the FTS index, which
+    follows updates and deletes. Matches are highlighted while the rest of
+    the post is still escaped, and query syntax is treated as plain text.
+'''
+
+def test_search(client, auth, app):
+    assert client.get('/search').status_code == 200
+
+    response = client.get('/search?q=body')
+    assert b'test title' in response.data
+    assert b'<mark>body</mark>' in response.data
+
+    auth.login()
+    client.post('/1/update', data={'title': 'updated', 'body': '<b>new</b>'})
+    assert b'No posts match' in client.get('/search?q=body').data
+    response = client.get('/search?q=new')
+    assert b'&lt;b&gt;<mark>new</mark>&lt;/b&gt;' in response.data
+
+    assert client.get('/search?q="NEAR(').status_code == 200
+
+    client.post('/1/delete')
+    assert b'No posts match' in client.get('/search?q=new').data
+
+
+def test_search_pagination(client, app):
+    app.config['POSTS_PER_PAGE'] = 1
+
+    with app.app_context():
+        db = get_db()
+        db.execute(
+            "INSERT INTO post (title, body, author_id) VALUES ('test', 'test', 1)"
+        )
+        db.commit()
+
+    response = client.get('/search?q=test')
+    assert b'More results' in response.data
+    cursor = response.data.split(b'after=')[1].split(b'"')[0].decode()
+
+    response = client.get('/search', query_string={
+        'q': 'test', 'after': unquote_plus(cursor)
+    })
+    assert b'test title' in response.data
+    assert b'More results' not in response.data
+
+    assert client.get('/search?q=test&after=x').status_code == 400
+
+
+def test_rebuild_search_command(runner, app):
+    with app.app_context():
+        db = get_db()
+        db.execute("INSERT INTO post_fts (post_fts) VALUES ('delete-all')")
+        db.commit()
+        assert get_db().execute(
+            "SELECT rowid FROM post_fts WHERE post_fts MATCH 'body'"
+        ).fetchone() is None
+
+    result = runner.invoke(args=['rebuild-search'])
+    assert 'Rebuilt' in result.output
+
+    with app.app_context():
+        assert get_db().execute(
+            "SELECT rowid FROM post_fts WHERE post_fts MATCH 'body'"
+        ).fetchone()[0] == 1
+
+
+''' 
+    /all streams every post, optionally only those by one author, ignoring
+    POSTS_PER_PAGE and without paging links.
+'''
+
+def test_all_posts_streamed(client, auth, app):
+    app.config['POSTS_PER_PAGE'] = 1
+
+    with app.app_context():
+        db = get_db()
+        db.execute(
+            "INSERT INTO post (title, body, author_id) VALUES ('by other', '', 2)"
+        )
+        db.commit()
+
+    auth.login()
+    response = client.get('/all')
+    assert response.is_streamed
+    assert b'test title' in response.data
+    assert b'by other' in response.data
+    assert b'href="/1/update"' in response.data
+    assert b'Older' not in response.data
+
+    response = client.get('/all?author=test')
+    assert b'test title' in response.data
+    assert b'by other' not in response.data
+
+
+''' 
+    /u/<username> only lists that author's posts, pages like the index,
+    and the query should keep being answered from post_author_created.
+'''
+
+def test_author(client, app):
+    app.config['POSTS_PER_PAGE'] = 1
+
+    with app.app_context():
+        db = get_db()
+        db.executemany(
+            'INSERT INTO post (title, body, author_id, created)'
+            ' VALUES (?, ?, ?, ?)',
+            (('newer', '', 1, '2018-01-02 00:00:00'),
+             ('by other', '', 2, '2018-01-03 00:00:00'))
+        )
+        db.commit()
+
+    response = client.get('/u/test')
+    assert b'Posts by test' in response.data
+    assert b'newer' in response.data
+    assert b'by other' not in response.data
+    assert page_link('after', '2018-01-02 00:00:00,2').replace(
+        b'"/?', b'"/u/test?'
+    ) in response.data
+
+    response = client.get('/u/test?after=2018-01-02+00:00:00,2')
+    assert b'test title' in response.data
+    assert b'Older' not in response.data
+
+    assert client.get('/u/nobody').status_code == 404
+
+
+def test_author_uses_index(app):
+    with app.test_request_context('/u/test'):
+        db = get_db()
+        statements = []
+        db.set_trace_callback(statements.append)
+        get_posts_page(after='2018-01-01 00:00:00,1', where='p.author_id = ?',
+                       params=(1,))
+        db.set_trace_callback(None)
+
+        plan = ' '.join(row['detail'] for row in db.execute(
+            'EXPLAIN QUERY PLAN ' + statements[-1]
+        ))
+
+    assert 'USING INDEX post_author_created' in plan
+    assert 'TEMP B-TREE' not in plan
+
+
+'''
+    Listings show a stored excerpt and link to the post's own page for the
+    whole body. The listing query shouldn't read body for posts that have
+    an excerpt stored.
+'''
+
+def test_make_excerpt():
+    assert make_excerpt('short') == 'short'
+
+    body = 'word ' * EXCERPT_LENGTH
+    excerpt = make_excerpt(body)
+    assert len(excerpt) < EXCERPT_LENGTH
+    assert excerpt.endswith('word…')
+
+def test_excerpt_and_post_view(client, auth):
+    auth.login()
+    body = 'start ' + 'x' * EXCERPT_LENGTH + ' end'
+    client.post('/create', data={'title': 'long', 'body': body})
+
+    response = client.get('/')
+    assert b'start' in response.data
+    assert b' end' not in response.data
+    assert b'href="/2">Read more' in response.data
+    assert b'/1">Read more' not in response.data
+
+    response = client.get('/2')
+    assert body.encode() in response.data
+    assert b'href="/2/update"' in response.data
+
+    assert client.get('/3').status_code == 404
+
+def test_listing_skips_body(client, auth, app):
+    auth.login()
+    client.post('/create', data={'title': 'long', 'body': 'x' * 10000})
+
+    with app.test_request_context('/'):
+        db = get_db()
+        statements = []
+        db.set_trace_callback(statements.append)
+        post = get_posts_page().posts[0]
+        db.set_trace_callback(None)
+
+    assert post['body_length'] == 10000
+    assert len(post['excerpt']) <= EXCERPT_LENGTH
+    assert 'body' not in post.keys()
+    assert ' body,' not in statements[-1]
+
+def test_backfill_excerpts(runner, app):
+    with app.app_context():
+        db = get_db()
+        db.execute(
+            "INSERT INTO post (title, body, author_id) VALUES ('raw', ?, 1)",
+            ('y ' * EXCERPT_LENGTH,)
+        )
+        db.commit()
+
+    result = runner.invoke(args=['backfill-excerpts'])
+    assert 'Backfilled 2 posts.' in result.output
+
+    with app.app_context():
+        rows = get_db().execute(
+            'SELECT excerpt, body_length, version FROM post ORDER BY id'
+        ).fetchall()
+
+    assert tuple(rows[0]) == ('test\nbody', 9, 1)
+    assert rows[1]['excerpt'].endswith('…')
+    assert rows[1]['body_length'] == 2 * EXCERPT_LENGTH
+
+    assert 'Backfilled 0 posts.' in runner.invoke(
+        args=['backfill-excerpts']
+    ).output
+    assert 'Backfilled 2 posts.' in runner.invoke(
+        args=['backfill-excerpts', '--all']
+    ).output
+
+
+'''
+    Each post keeps a copy of its author's username, so the index reads
+    only the post table. The copy follows renames, and check-usernames
+    finds and repairs copies that were changed behind the triggers' back.
+'''
+def test_index_reads_post_only(app):
+    with app.test_request_context('/'):
+        db = get_db()
+        statements = []
+        db.set_trace_callback(statements.append)
+        get_posts_page()
+        db.set_trace_callback(None)
+
+        plan = ' '.join(row['detail'] for row in db.execute(
+            'EXPLAIN QUERY PLAN ' + statements[-1]
+        ))
+
+    assert 'USING INDEX post_created_id' in plan
+    assert 'user' not in plan
+
+def test_username_follows_user(client, auth, app):
+    with app.app_context():
+        before = get_table_version('post')[0]
+
+    auth.login()
+    client.post('/create', data={'title': 'new', 'body': 'body'})
+
+    with app.app_context():
+        db = get_db()
+        assert db.execute('SELECT username FROM post WHERE id = 2').fetchone()[0] == 'test'
+        # insert_post set it, so the trigger didn't write the row again
+        assert get_table_version('post')[0] == before + 1
+
+        db.execute("UPDATE user SET username = 'renamed' WHERE id = 1")
+        db.execute('UPDATE post SET author_id = 2 WHERE id = 2')
+        db.commit()
+
+        rows = db.execute('SELECT username, version FROM post ORDER BY id').fetchall()
+
+    assert tuple(rows[0]) == ('renamed', 1)
+    assert rows[1]['username'] == 'other'
+    assert b'by renamed' in client.get('/1').data
+
+def test_check_usernames(runner, app):
+    assert 'All post usernames match.' in runner.invoke(
+        args=['check-usernames']
+    ).output
+
+    with app.app_context():
+        db = get_db()
+        db.execute("UPDATE post SET username = 'stale' WHERE id = 1")
+        db.commit()
+
+    result = runner.invoke(args=['check-usernames'])
+    assert result.exit_code != 0
+    assert "post 1: 'stale', user has 'test'" in result.output
+    assert '1 posts have the wrong username.' in result.output
+
+    result = runner.invoke(args=['check-usernames', '--fix'])
+    assert 'Fixed 1 posts.' in result.output
+
+    with app.app_context():
+        row = get_db().execute('SELECT username, version FROM post').fetchone()
+
+    assert tuple(row) == ('test', 1)
@@ -0,0 +1,66 @@
+from flaskr.cache import LRUCache
+
+
+def test_get_set():
+    cache = LRUCache(2)
+    assert cache.get('a') is None
+    cache.set('a', 1)
+    assert cache.get('a') == 1
+    assert cache.stats() == {'hits': 1, 'misses': 1, 'size': 1, 'maxsize': 2}
+
+
+''' 
+    Once the cache is full, the least recently used entry should be the
+    one dropped. Reading an entry counts as using it.
+'''
+def test_evicts_least_recently_used():
+    cache = LRUCache(2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.get('a')
+    cache.set('c', 3)
+
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+    assert len(cache) == 2
+
+
+def test_ttl(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr('flaskr.cache.time.monotonic', lambda: now[0])
+
+    cache = LRUCache(2, ttl=10)
+    cache.set('a', 1)
+    now[0] += 5
+    assert cache.get('a') == 1
+    now[0] += 10
+    assert cache.get('a') is None
+    assert len(cache) == 0
+
+
+def test_delete_clear():
+    cache = LRUCache(2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.delete('a')
+    cache.delete('missing')
+    assert cache.get('a') is None
+    cache.clear()
+    assert cache.get('b') is None
+
+
+def test_expire(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr('flaskr.cache.time.monotonic', lambda: now[0])
+
+    cache = LRUCache(3, ttl=10)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    now[0] += 5
+    cache.set('c', 3)
+    now[0] += 6
+
+    assert cache.expire() == 2
+    assert len(cache) == 1
+    assert cache.get('c') == 3
@@ -0,0 +1,207 @@
+import pytest
+
+from conftest import AuthActions
+from flaskr.compression import BodyCodec, StoredPost, train_dictionary
+from flaskr.db import get_db
+
+
+BODY = 'the quick brown fox jumps over the lazy dog. ' * 40
+
+@pytest.fixture
+def compressed_app(make_app):
+    return make_app(BODY_COMPRESSION_THRESHOLD=100)
+
+def stored_body(app, id):
+    with app.app_context():
+        return get_db().execute(
+            'SELECT body, body_z FROM post WHERE id = ?', (id,)
+        ).fetchone()
+
+
+'''
+    Bodies over the threshold round trip through zlib, with or without a
+    dictionary, and shorter ones are left as they are.
+'''
+@pytest.mark.parametrize('dictionary', (False, True))
+def test_round_trip(compressed_app, dictionary):
+    with compressed_app.app_context():
+        db = get_db()
+        dictionary_id = 0
+
+        if dictionary:
+            dictionary_id = db.execute(
+                'INSERT INTO compression_dict (data) VALUES (?)',
+                (train_dictionary([BODY, BODY]),)
+            ).lastrowid
+            db.commit()
+
+        codec = BodyCodec(compressed_app.config['DATABASE'], threshold=100)
+        body, body_z = codec.compress(BODY, dictionary_id)
+        assert body == ''
+        assert len(body_z) < len(BODY)
+        assert codec.body_text(body, body_z) == BODY
+
+        assert codec.compress('short', dictionary_id) == ('short', None)
+        assert codec.body_text('short', None) == 'short'
+
+def test_dictionary_helps_short_bodies(app):
+    codec = BodyCodec(app.config['DATABASE'], threshold=0)
+    sample = ['a post about flask views and sqlite databases'] * 10
+
+    with app.app_context():
+        db = get_db()
+        dictionary_id = db.execute(
+            'INSERT INTO compression_dict (data) VALUES (?)',
+            (train_dictionary(sample),)
+        ).lastrowid
+        db.commit()
+
+    body = 'another post about flask views'
+    assert (len(codec.compress(body, dictionary_id)[1])
+            < len(codec.compress(body)[1]))
+
+
+'''
+    A long post is stored compressed, but the post page, the list, search
+    and export all still see the text.
+'''
+def test_create_compressed(compressed_app, runner, tmp_path):
+    client = compressed_app.test_client()
+    AuthActions(client).login()
+    client.post('/create', data={'title': 'long', 'body': BODY})
+
+    row = stored_body(compressed_app, 2)
+    assert row['body'] == ''
+    assert row['body_z'] is not None
+
+    assert BODY.encode() in client.get('/2').data
+    assert b'<mark>fox</mark>' in client.get('/search?q=fox').data
+
+    path = tmp_path / 'posts.jsonl'
+    compressed_app.test_cli_runner().invoke(args=['export-posts', str(path)])
+    assert BODY in path.read_text()
+
+    client.post('/2/update', data={'title': 'long', 'body': 'short now'})
+    assert tuple(stored_body(compressed_app, 2)) == ('short now', None)
+    assert b'No posts match' in client.get('/search?q=fox').data
+
+def test_stored_post_is_lazy(compressed_app, monkeypatch):
+    with compressed_app.app_context():
+        db = get_db()
+        db.execute(
+            'INSERT INTO post (title, body, body_z, author_id) VALUES (?, ?, ?, 1)',
+            ('long', *compressed_app.extensions['flaskr.body_codec'].compress(BODY))
+        )
+        post = StoredPost(db.execute('SELECT * FROM post WHERE id = 2').fetchone())
+
+        calls = []
+        codec = compressed_app.extensions['flaskr.body_codec']
+        decompress = codec.decompress
+        monkeypatch.setattr(
+            codec, 'decompress', lambda data: calls.append(1) or decompress(data)
+        )
+
+        assert post['title'] == 'long'
+        assert calls == []
+        assert post['body'] == BODY
+        assert post['body'] == BODY
+        assert calls == [1]
+
+
+'''
+    compress-bodies converts the posts stored before compression was
+    turned on, and can be run again safely.
+'''
+def test_compress_bodies(app, compressed_app):
+    with app.app_context():
+        db = get_db()
+        db.execute(
+            "INSERT INTO post (title, body, author_id) VALUES ('long', ?, 1)",
+            (BODY,)
+        )
+        db.commit()
+
+    runner = compressed_app.test_cli_runner()
+    result = runner.invoke(args=['compress-bodies', '--batch-size', '1'])
+    assert 'Compressed 1 posts' in result.output
+    assert 'VACUUM' in result.output
+
+    row = stored_body(compressed_app, 2)
+    assert row['body'] == ''
+    assert stored_body(compressed_app, 1)['body_z'] is None
+
+    client = compressed_app.test_client()
+    assert BODY.encode() in client.get('/2').data
+    assert b'<mark>fox</mark>' in client.get('/search?q=fox').data
+
+    result = runner.invoke(args=['compress-bodies'])
+    assert 'Nothing to compress.' in result.output
+
+def test_compress_bodies_needs_threshold(runner):
+    result = runner.invoke(args=['compress-bodies'])
+    assert result.exit_code != 0
+    assert 'BODY_COMPRESSION_THRESHOLD' in result.output
+
+def test_train_body_dict(make_app, runner):
+    result = runner.invoke(args=['train-body-dict', '--size', '1024'])
+    assert 'Stored dictionary 1' in result.output
+
+    dict_app = make_app(
+        BODY_COMPRESSION_THRESHOLD=0,
+        BODY_COMPRESSION_DICT=True,
+    )
+    client = dict_app.test_client()
+    AuthActions(client).login()
+    client.post('/create', data={'title': 'new', 'body': 'test body again'})
+
+    body_z = stored_body(dict_app, 2)['body_z']
+    assert body_z[:4] == b'\x00\x00\x00\x01'
+    assert b'test body again' in client.get('/2').data
+
+
+'''
+    A database made before compression, with no body_z and a search index
+    reading from post, is brought up to date by compress-bodies (or
+    backfill-excerpts) and works the same afterwards.
+'''
+PRE_COMPRESSION = """
+DROP TRIGGER post_fts_insert;
+DROP TRIGGER post_fts_delete;
+DROP TRIGGER post_fts_update;
+DROP TABLE post_fts;
+DROP VIEW post_content;
+DROP TABLE compression_dict;
+ALTER TABLE post DROP COLUMN body_z;
+
+CREATE VIRTUAL TABLE post_fts USING fts5(
+  title, body, content='post', content_rowid='id'
+);
+INSERT INTO post_fts (post_fts) VALUES ('rebuild');
+
+CREATE TRIGGER post_fts_insert AFTER INSERT ON post BEGIN
+  INSERT INTO post_fts (rowid, title, body)
+  VALUES (new.id, new.title, new.body);
+END;
+"""
+
+@pytest.mark.parametrize('command', ('compress-bodies', 'backfill-excerpts'))
+def test_upgrade_old_database(app, compressed_app, command):
+    with app.app_context():
+        db = get_db()
+        db.executescript(PRE_COMPRESSION)
+        db.execute(
+            "INSERT INTO post (title, body, author_id) VALUES ('long', ?, 1)",
+            (BODY,)
+        )
+        db.commit()
+
+    client = compressed_app.test_client()
+    assert compressed_app.test_cli_runner().invoke(args=[command]).exit_code == 0
+
+    assert BODY.encode() in client.get('/2').data
+    assert b'<mark>fox</mark>' in client.get('/search?q=fox').data
+    assert b'test title' in client.get('/search?q=test').data
+
+    AuthActions(client).login()
+    client.post('/2/update', data={'title': 'long', 'body': 'short now'})
+    assert b'No posts match' in client.get('/search?q=fox').data
@@ -1,7 +1,15 @@
+import json
 import sqlite3
 
 import pytest
-from flaskr.db import get_db
+from flask import g
+
+from conftest import AuthActions
+from flaskr.db import (
+    get_db, get_invalidation_hooks, get_pool, get_read_db,
+    get_statement_hooks, get_write_db, log_statement, read_only, read_write,
+    statement_shape
+)
 
 
 ''' 
@@ -37,4 +45,298 @@ def test_init_db_command(runner, monkeypatch):
     monkeypatch.setattr('flaskr.db.init_db', fake_init_db)
     result = runner.invoke(args=['init-db'])
     assert 'Initialized' in result.output
-    assert Recorder.called
\ No newline at end of file
+    assert Recorder.called
+
+''' 
+    With DB_POOL_SIZE set, the connection should outlive the app context
+    and be handed out again to the next one instead of being closed.
+'''
+@pytest.fixture
+def pooled_app(make_app):
+    return make_app(DB_POOL_SIZE=1)
+
+def test_pool_reuses_connection(pooled_app):
+    with pooled_app.app_context():
+        db = get_db()
+
+    assert db.execute('SELECT 1').fetchone()[0] == 1
+
+    with pooled_app.app_context():
+        assert get_db() is db
+        assert isinstance(get_db().execute('SELECT * FROM user').fetchone(),
+                          sqlite3.Row)
+
+
+def test_pool_discards_stale_connections(pooled_app):
+    pool = get_pool(pooled_app)
+
+    with pooled_app.app_context():
+        db = get_db()
+
+    db.close()
+    with pooled_app.app_context():
+        replaced = get_db()
+        assert replaced is not db
+
+    pool.max_lifetime = 0
+    with pooled_app.app_context():
+        assert get_db() is not replaced
+
+    with pytest.raises(sqlite3.ProgrammingError):
+        replaced.execute('SELECT 1')
+
+
+def test_pool_rolls_back_on_release(pooled_app):
+    with pooled_app.app_context():
+        get_db().execute("INSERT INTO user (username, password) VALUES ('x', 'x')")
+
+    with pooled_app.app_context():
+        db = get_db()
+        assert not db.in_transaction
+        assert db.execute(
+            "SELECT * FROM user WHERE username = 'x'"
+        ).fetchone() is None
+
+
+def test_pragmas_applied(app):
+    with app.app_context():
+        db = get_db()
+        assert db.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+        assert db.execute('PRAGMA busy_timeout').fetchone()[0] == 5000
+        # synchronous NORMAL is reported as 1
+        assert db.execute('PRAGMA synchronous').fetchone()[0] == 1
+
+
+def test_db_tune_command(runner, app):
+    app.config['DB_PRAGMAS'] = {'cache_size': -2000, 'temp_store': 'MEMORY'}
+    result = runner.invoke(args=['db-tune'])
+    assert 'cache_size = -2000' in result.output
+    # temp_store MEMORY is reported as 2
+    assert 'temp_store = 2' in result.output
+
+
+''' 
+    Statement hooks should get each statement once, with the time spent
+    running it, whether its rows are fetched all at once, one at a time,
+    or not read to the end.
+'''
+def test_statement_hooks(app):
+    seen = []
+
+    with app.app_context():
+        get_statement_hooks().append(
+            lambda sql, parameters, seconds: seen.append((sql, parameters))
+        )
+        db = get_db()
+
+        db.execute('SELECT * FROM user WHERE id = ?', (1,)).fetchone()
+        list(db.execute('SELECT * FROM user'))
+        db.execute('SELECT * FROM user').fetchall()
+        db.executemany('UPDATE user SET password = ? WHERE id = ?',
+                       (('a', 1), ('b', 2)))
+        with pytest.raises(sqlite3.IntegrityError):
+            db.execute("INSERT INTO user (username, password) VALUES ('test', 'x')")
+
+    assert seen == [
+        ('SELECT * FROM user WHERE id = ?', (1,)),
+        ('SELECT * FROM user', ()),
+        ('SELECT * FROM user', ()),
+        ('UPDATE user SET password = ? WHERE id = ?', None),
+        ("INSERT INTO user (username, password) VALUES ('test', 'x')", ()),
+    ]
+
+
+''' 
+    Slow statements and statements repeated within one request should be
+    logged as JSON, with the endpoint that ran them.
+'''
+def test_slow_query_log(app, client, caplog):
+    app.config['SLOW_QUERY_THRESHOLD'] = 0
+    get_statement_hooks(app).append(log_statement)
+
+    with caplog.at_level('WARNING', logger='flaskr.db'):
+        client.get('/')
+
+    events = [json.loads(r.getMessage()) for r in caplog.records]
+    slow = [e for e in events if e['event'] == 'slow_query']
+    assert slow
+    assert all(e['endpoint'] == 'blog.index' for e in slow)
+    assert any('FROM post p' in e['sql'] for e in slow)
+
+
+def test_n_plus_one_detector(app, caplog):
+    app.config['N_PLUS_ONE_THRESHOLD'] = 2
+    get_statement_hooks(app).append(log_statement)
+
+    with app.test_request_context('/'), caplog.at_level('WARNING'):
+        db = get_db()
+        for id in range(4):
+            db.execute(f'SELECT * FROM post WHERE id = {id}').fetchone()
+
+    events = [json.loads(r.getMessage()) for r in caplog.records]
+    assert events == [{
+        'event': 'n_plus_one',
+        'endpoint': 'blog.index',
+        'sql': 'SELECT * FROM post WHERE id = ?',
+        'count': 3,
+    }]
+
+
+def test_statement_shape_cached(app):
+    app.config['N_PLUS_ONE_THRESHOLD'] = 10
+    get_statement_hooks(app).append(log_statement)
+    statement_shape.cache_clear()
+
+    with app.test_request_context('/'):
+        db = get_db()
+        for id in range(4):
+            db.execute('SELECT * FROM post WHERE id = ?', (id,)).fetchone()
+
+    assert statement_shape.cache_info().misses == 1
+
+
+'''
+    With DB_READ_ROUTING on, GET requests read through a separate mode=ro
+    connection, other methods and views marked read_write get the
+    read-write one.
+'''
+@pytest.fixture
+def routed_app(make_app):
+    return make_app(DB_READ_ROUTING=True)
+
+def test_read_routing_off(app):
+    with app.test_request_context('/'):
+        assert get_read_db() is get_db() is get_write_db()
+
+def test_read_routing(routed_app):
+    with routed_app.test_request_context('/'):
+        db = get_db()
+        assert db is get_read_db()
+        assert db is not get_write_db()
+
+        with pytest.raises(sqlite3.OperationalError) as e:
+            db.execute('DELETE FROM post')
+
+        assert 'readonly' in str(e.value)
+
+    with routed_app.test_request_context('/create', method='POST'):
+        assert get_db() is get_write_db()
+
+    with routed_app.app_context():
+        # outside a request, e.g. the CLI, is read-write
+        assert get_db() is get_write_db()
+
+def test_read_routing_decorators(routed_app):
+    @routed_app.route('/read-write-view')
+    @read_write
+    def read_write_view():
+        return str(get_db() is get_write_db())
+
+    @routed_app.route('/read-only-view', methods=('POST',))
+    @read_only
+    def read_only_view():
+        return str(get_db() is get_read_db())
+
+    client = routed_app.test_client()
+    assert client.get('/read-write-view').data == b'True'
+    assert client.post('/read-only-view').data == b'True'
+
+def test_read_routing_views(routed_app):
+    client = routed_app.test_client()
+    client.post('/auth/login', data={'username': 'test', 'password': 'test'})
+    client.post('/create', data={'title': 'routed', 'body': ''})
+
+    assert b'routed' in client.get('/').data
+
+def test_read_replica(app, make_app, tmp_path):
+    replica = tmp_path / 'replica.sqlite'
+
+    with app.app_context():
+        get_db().execute(f"VACUUM INTO '{replica}'")
+        get_db().execute("UPDATE post SET title = 'changed'")
+        get_db().commit()
+
+    replica_app = make_app(
+        DATABASE_REPLICA=str(replica),
+        DB_READ_ROUTING=True,
+        DB_POOL_SIZE=1,
+    )
+
+    with replica_app.test_request_context('/'):
+        assert get_db().execute('SELECT title FROM post').fetchone()[0] == 'test title'
+        assert get_write_db().execute('SELECT title FROM post').fetchone()[0] == 'changed'
+        db = get_db()
+
+    # the read-only connection went back to its own pool
+    assert get_pool(replica_app, read_only=True).acquire() is db
+
+
+'''
+    With CACHE_COHERENCE on, a write from another connection (standing in
+    for another worker) calls the hooks for the table it changed, once,
+    at the start of the next request.
+'''
+@pytest.fixture
+def coherent_app(make_app):
+    return make_app(CACHE_COHERENCE=True)
+
+def test_invalidation_hooks(app, coherent_app):
+    calls = []
+    get_invalidation_hooks('post', coherent_app).append(calls.append)
+    client = coherent_app.test_client()
+
+    client.get('/')
+    assert calls == ['post']
+    client.get('/')
+    assert calls == ['post']
+
+    with app.app_context():
+        db = get_db()
+        db.execute("UPDATE user SET password = 'x' WHERE id = 2")
+        db.commit()
+
+    client.get('/')
+    assert calls == ['post']
+
+    with app.app_context():
+        db = get_db()
+        db.execute("UPDATE post SET title = 'changed'")
+        db.commit()
+
+    client.get('/')
+    assert calls == ['post', 'post']
+
+def test_user_cache_coherence(app, coherent_app):
+    client = coherent_app.test_client()
+    AuthActions(client).login()
+
+    with client:
+        client.get('/')
+        assert g.user['username'] == 'test'
+
+    with app.app_context():
+        db = get_db()
+        db.execute("UPDATE user SET username = 'renamed' WHERE id = 1")
+        db.commit()
+
+    with client:
+        client.get('/')
+        assert g.user['username'] == 'renamed'
+
+def test_coherence_skips(coherent_app, monkeypatch):
+    calls = []
+    get_invalidation_hooks('user', coherent_app).append(calls.append)
+    client = coherent_app.test_client()
+    client.get('/')
+    assert calls == ['user']
+
+    # a new user can't be cached anywhere yet
+    client.post('/auth/register', data={'username': 'a', 'password': 'a'})
+    client.get('/')
+    assert calls == ['user']
+
+    monkeypatch.setattr(
+        coherent_app.extensions['flaskr.table_versions'], 'changed',
+        lambda rows: pytest.fail('checked versions for /hello')
+    )
+    assert client.get('/hello').status_code == 200
@@ -1,4 +1,6 @@
-from flaskr import create_app
+from flaskr import close_app, create_app
+from flaskr.db import get_pool
+from flaskr.writer import get_writer
 
 def test_config():
     assert not create_app().testing
@@ -6,4 +8,17 @@ def test_config():
 
 def test_hello(client):
     response = client.get('/hello')
-    assert response.data == b'Hello, World!'
\ No newline at end of file
+    assert response.data == b'Hello, World!'
+
+def test_close_app(make_app):
+    app = make_app(DB_POOL_SIZE=1, WRITE_BATCH_WINDOW=0.001)
+    app.test_client().get('/')
+
+    with app.app_context():
+        writer = get_writer()
+        writer.submit('DELETE FROM post WHERE id = 0').result()
+
+    close_app(app)
+
+    assert writer._thread is None
+    assert get_pool(app)._idle.empty()
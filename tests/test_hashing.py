@@ -0,0 +1,83 @@
+import pytest
+from werkzeug.exceptions import ServiceUnavailable
+
+from flaskr.hashing import PasswordHasher
+
+
+@pytest.mark.parametrize('workers', (0, 1))
+def test_hash_and_verify(workers):
+    hasher = PasswordHasher('pbkdf2:sha256:1000', 8, workers=workers)
+
+    try:
+        pwhash = hasher.hash('secret')
+        assert pwhash.startswith('pbkdf2:sha256:1000$')
+        assert hasher.verify(pwhash, 'secret')
+        assert not hasher.verify(pwhash, 'wrong')
+    finally:
+        hasher.shutdown()
+
+    stats = hasher.stats()
+    assert stats['count'] == 3
+    assert stats['max_seconds'] > 0
+
+
+''' 
+    Once queue_limit hashes are in flight, the next one should be refused
+    with a 503 straight away instead of waiting.
+'''
+def test_queue_limit():
+    hasher = PasswordHasher('pbkdf2:sha256:1000', 8, queue_limit=1)
+    hasher._slots.acquire()
+
+    with pytest.raises(ServiceUnavailable):
+        hasher.hash('secret')
+
+    assert hasher.stats()['rejected'] == 1
+
+    hasher._slots.release()
+    assert hasher.hash('secret')
+
+
+def test_login_overloaded(client, app):
+    hasher = PasswordHasher('pbkdf2:sha256:1000', 8, queue_limit=1)
+    hasher._slots.acquire()
+    app.extensions['flaskr.hasher'] = hasher
+
+    response = client.post(
+        '/auth/login', data={'username': 'test', 'password': 'test'}
+    )
+    assert response.status_code == 503
+
+
+def test_needs_rehash():
+    hasher = PasswordHasher('pbkdf2:sha256:1000', 8)
+
+    assert not hasher.needs_rehash(hasher.hash('secret'))
+    assert hasher.needs_rehash('pbkdf2:sha256:50000$TCI4GzcX$0de171a4')
+    assert hasher.needs_rehash('pbkdf2:sha256:1000$TCI4G$0de171a4')
+    assert hasher.stats()['count'] == 1
+
+def test_target_method():
+    for method in ('pbkdf2:sha256', 'pbkdf2:sha512:1000', 'sha256'):
+        hasher = PasswordHasher(method, 8)
+        target = hasher.target_method
+        assert hasher.stats()['count'] == 0
+        assert hasher.hash('secret').split('$', 1)[0] == target
+
+
+def test_hash_report_command(runner, client, auth):
+    auth.login()
+    result = runner.invoke(args=['hash-report'])
+    assert 'pbkdf2:sha256:50000: 1\n' in result.output
+    assert 'pbkdf2:sha256:260000: 1 (target)' in result.output
+
+
+def test_workers_not_forked():
+    hasher = PasswordHasher('pbkdf2:sha256:1000', 8, workers=1)
+
+    try:
+        hasher.hash('secret')
+        start_method = hasher._executor._mp_context.get_start_method()
+        assert start_method in ('forkserver', 'spawn')
+    finally:
+        hasher.shutdown()
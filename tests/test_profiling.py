@@ -0,0 +1,44 @@
+import pytest
+
+
+@pytest.fixture
+def profiled_client(make_app):
+    return make_app(PROFILING=True).test_client()
+
+
+def test_disabled(client):
+    assert 'Server-Timing' not in client.get('/').headers
+    assert client.get('/metrics').status_code == 404
+
+
+''' 
+    With PROFILING on, each response should carry a Server-Timing header
+    with the phases the request went through.
+'''
+def test_server_timing(profiled_client):
+    profiled_client.post(
+        '/auth/login', data={'username': 'test', 'password': 'test'}
+    )
+    timing = profiled_client.get('/').headers['Server-Timing']
+    phases = dict(part.split(';dur=') for part in timing.split(', '))
+
+    assert {'user_load', 'db_connect', 'sql', 'template', 'total'} <= set(phases)
+    assert float(phases['total']) >= float(phases['template'])
+
+
+def test_metrics(profiled_client):
+    profiled_client.post(
+        '/auth/login', data={'username': 'test', 'password': 'test'}
+    )
+    profiled_client.get('/')
+    profiled_client.get('/')
+
+    response = profiled_client.get('/metrics')
+    assert response.mimetype == 'text/plain'
+    text = response.get_data(as_text=True)
+
+    assert 'flaskr_request_seconds_count{endpoint="blog.index"} 2' in text
+    assert 'flaskr_phase_seconds_total{endpoint="auth.login",phase="hash"}' in text
+    assert 'flaskr_sql_seconds_count{statement="SELECT * FROM user WHERE username = ?"} 1' in text
+    assert 'flaskr_cache_requests_total{cache="user_cache",result="hit"}' in text
+    assert 'flaskr_password_hash_seconds_count' in text
@@ -0,0 +1,94 @@
+import time
+
+import pytest
+from flask import g, session
+
+from conftest import AuthActions
+from flaskr.db import get_db
+
+
+@pytest.fixture(params=('memory', 'sqlite'))
+def session_app(make_app, request):
+    return make_app(SESSION_BACKEND=request.param)
+
+def stored(app, sid):
+    with app.app_context():
+        return app.session_interface.store.load(sid)
+
+def session_cookie(client):
+    cookie = next(
+        (c for c in client.cookie_jar if c.name == 'session'), None
+    )
+    return cookie.value if cookie is not None else None
+
+def test_login_uses_session_id(session_app):
+    client = session_app.test_client()
+    AuthActions(client).login()
+    sid = session_cookie(client)
+
+    # just the opaque id, nothing signed
+    assert sid is not None and '.' not in sid
+    assert len(sid) == 43
+
+    with client:
+        client.get('/')
+        assert session['user_id'] == 1
+        assert g.user['username'] == 'test'
+
+    assert stored(session_app, sid) is not None
+
+def test_logout_deletes_session(session_app):
+    client = session_app.test_client()
+    AuthActions(client).login()
+    sid = session_cookie(client)
+
+    AuthActions(client).logout()
+    assert session_cookie(client) is None
+    assert stored(session_app, sid) is None
+
+'''
+    Logging in clears the session, so it should come back with a new id
+    and the one from before should stop working.
+'''
+def test_login_rotates_id(session_app):
+    client = session_app.test_client()
+
+    with client.session_transaction() as sess:
+        sess['theme'] = 'dark'
+
+    before = session_cookie(client)
+    AuthActions(client).login()
+    after = session_cookie(client)
+
+    assert before != after
+    assert stored(session_app, before) is None
+
+def test_unchanged_session_not_saved(session_app, monkeypatch):
+    client = session_app.test_client()
+    AuthActions(client).login()
+    saves = []
+    monkeypatch.setattr(
+        session_app.session_interface.store, 'save',
+        lambda sid, data: saves.append(sid)
+    )
+
+    client.get('/')
+    assert saves == []
+
+def test_sqlite_sweep(make_app):
+    sqlite_app = make_app(SESSION_BACKEND='sqlite', SESSION_SWEEP_INTERVAL=0)
+
+    with sqlite_app.app_context():
+        db = get_db()
+        db.execute(
+            "INSERT INTO session (id, data, expires) VALUES ('old', '{}', ?)",
+            (time.time() - 1,)
+        )
+        db.commit()
+
+    AuthActions(sqlite_app.test_client()).login()
+
+    with sqlite_app.app_context():
+        assert get_db().execute(
+            "SELECT COUNT(*) FROM session WHERE id = 'old'"
+        ).fetchone()[0] == 0
@@ -0,0 +1,418 @@
+import pytest
+from flask import g
+
+from flaskr.blog import get_posts_page, insert_post
+from flaskr.db import create_post_tables, get_db, get_invalidation_hooks, get_shard_db
+from flaskr.shards import plan_buckets
+
+
+'''
+    make_sharded_app(shards, **config) is make_app with posts sharded
+    over that many files next to the test database, in 8 buckets.
+'''
+@pytest.fixture
+def make_sharded_app(make_app, tmp_path):
+    def make_sharded_app(shards, **config):
+        return make_app(
+            DATABASE_SHARDS=[str(tmp_path / f'shard{i}.sqlite') for i in range(shards)],
+            SHARD_BUCKETS=8,
+            **config,
+        )
+
+    return make_sharded_app
+
+def shard_database(app, users=2):
+    '''
+        Shards the test database the way init_db does a new one, with
+        bucket n on shard n % count, leaving the shards empty: data.sql's
+        post stays in DATABASE's own post table, which sharding doesn't
+        use, so it's removed. Users named user3 and up are added if asked
+        for.
+    '''
+    with app.app_context():
+        db = get_db()
+        count = len(app.config['DATABASE_SHARDS'])
+
+        for index in range(count):
+            create_post_tables(get_shard_db(index))
+
+        db.executemany(
+            'INSERT INTO shard_map (bucket, shard) VALUES (?, ?)',
+            ((bucket, bucket % count) for bucket in range(app.config['SHARD_BUCKETS']))
+        )
+        db.execute('DELETE FROM post')
+        db.executemany(
+            "INSERT INTO user (username, password) VALUES (?, 'x')",
+            ((f'user{i}',) for i in range(3, users + 1))
+        )
+        db.commit()
+
+@pytest.fixture
+def sharded_app(make_sharded_app):
+    app = make_sharded_app(3)
+    shard_database(app, users=3)
+    return app
+
+'''
+    In this module client (and so auth) is the sharded app's.
+'''
+@pytest.fixture
+def client(sharded_app):
+    return sharded_app.test_client()
+
+def add_post(app, author_id, title, created=None):
+    with app.test_request_context():
+        author = get_db().execute(
+            'SELECT * FROM user WHERE id = ?', (author_id,)
+        ).fetchone()
+        id = insert_post(author, title, f'body of {title}')
+
+        if created is not None:
+            for index in range(len(app.config['DATABASE_SHARDS'])):
+                db = get_shard_db(index)
+                db.execute('UPDATE post SET created = ? WHERE id = ?', (created, id))
+                db.commit()
+
+    return id
+
+def shard_posts(app, index):
+    with app.app_context():
+        return [tuple(row) for row in get_shard_db(index).execute(
+            'SELECT id, author_id, username, title FROM post ORDER BY id'
+        )]
+
+
+'''
+    A post goes to the shard that holds its author's bucket, with an id
+    in that bucket, and is found again from the id alone.
+'''
+def test_posts_routed_by_author(sharded_app, client, auth):
+    auth.login()
+    client.post('/create', data={'title': 'by test', 'body': 'one'})
+    auth.login('other', 'other')
+    client.post('/create', data={'title': 'by other', 'body': 'two'})
+
+    # buckets 1 and 2 start on shards 1 and 2
+    assert shard_posts(sharded_app, 0) == []
+    assert shard_posts(sharded_app, 1) == [(9, 1, 'test', 'by test')]
+    assert shard_posts(sharded_app, 2) == [(10, 2, 'other', 'by other')]
+
+    assert b'by test' in client.get('/9').data
+    assert b'by other' in client.get('/10').data
+    assert client.get('/17').status_code == 404
+
+def test_update_delete_route_by_id(sharded_app, client, auth):
+    auth.login('other', 'other')
+    client.post('/create', data={'title': 'first', 'body': 'one'})
+
+    client.post('/10/update', data={'title': 'updated', 'body': 'two'})
+    assert shard_posts(sharded_app, 2) == [(10, 2, 'other', 'updated')]
+
+    client.post('/10/delete')
+    assert shard_posts(sharded_app, 2) == []
+    assert client.get('/10').status_code == 404
+
+    # ids aren't used again after a delete
+    client.post('/create', data={'title': 'second', 'body': 'three'})
+    assert shard_posts(sharded_app, 2) == [(18, 2, 'other', 'second')]
+
+
+'''
+    The index merges every shard's posts into one list in created order,
+    and pages through it both ways. The ETag covers every shard.
+'''
+def test_index_merges_shards(sharded_app, client):
+    sharded_app.config['POSTS_PER_PAGE'] = 2
+
+    for i in range(6):
+        add_post(sharded_app, i % 3 + 1, f'post {i}', f'2018-01-01 00:00:0{i}')
+
+    titles = []
+    cursor = None
+
+    with sharded_app.test_request_context('/'):
+        while True:
+            page = get_posts_page(after=cursor)
+            titles.extend(post['title'] for post in page.posts)
+            cursor = page.next_cursor
+
+            if cursor is None:
+                break
+
+        assert titles == [f'post {i}' for i in reversed(range(6))]
+
+        back = get_posts_page(before=page.prev_cursor)
+        assert [post['title'] for post in back.posts] == ['post 3', 'post 2']
+
+    response = client.get('/')
+    assert b'post 5' in response.data
+    assert b'post 3' not in response.data
+
+    etag = response.headers['ETag']
+    add_post(sharded_app, 3, 'on shard 0')
+    assert client.get('/', headers={'If-None-Match': etag}).status_code == 200
+
+def test_author_page_and_search(sharded_app, client):
+    add_post(sharded_app, 1, 'apple from test')
+    add_post(sharded_app, 2, 'apple from other')
+
+    response = client.get('/u/other')
+    assert b'apple from other' in response.data
+    assert b'apple from test' not in response.data
+
+    response = client.get('/all?author=test')
+    assert b'apple from test' in response.data
+    assert b'apple from other' not in response.data
+
+    response = client.get('/search?q=apple')
+    assert b'apple from test' in response.data
+    assert b'apple from other' in response.data
+
+'''
+    Renaming a user doesn't reach their posts on the shards, which have no
+    user table for a trigger to read. check-usernames finds those posts
+    and --fix brings them up to date.
+'''
+def test_rename_needs_check_usernames(sharded_app):
+    id = add_post(sharded_app, 2, 'renamed later')
+
+    with sharded_app.app_context():
+        db = get_db()
+        db.execute("UPDATE user SET username = 'renamed' WHERE id = 2")
+        db.commit()
+
+    runner = sharded_app.test_cli_runner()
+    result = runner.invoke(args=['check-usernames'])
+    assert f"post {id}: 'other', user has 'renamed'" in result.output
+    assert result.exit_code != 0
+
+    result = runner.invoke(args=['check-usernames', '--fix'])
+    assert 'Fixed 1 posts.' in result.output
+    assert shard_posts(sharded_app, 2) == [(id, 2, 'renamed', 'renamed later')]
+
+def copy_to_shard(app, id, source, target):
+    # as if rebalance-shards was part way through moving the post's bucket
+    with app.app_context():
+        row = get_shard_db(source).execute(
+            'SELECT * FROM post WHERE id = ?', (id,)
+        ).fetchone()
+        target_db = get_shard_db(target)
+        target_db.execute(
+            f"INSERT INTO post ({', '.join(row.keys())})"
+            f" VALUES ({', '.join('?' * len(row))})",
+            tuple(row)
+        )
+        target_db.commit()
+
+'''
+    A copy of a post on a shard that doesn't own its bucket, as a move cut
+    short leaves behind, is filtered out of every listing and search.
+'''
+def test_reads_skip_copies_on_other_shards(sharded_app, client, auth):
+    id = add_post(sharded_app, 1, 'moving')
+    assert id == 9
+    copy_to_shard(sharded_app, id, 1, 0)
+
+    auth.login()
+    client.post('/9/update', data={'title': 'moving', 'body': 'edited'})
+
+    # only the copy on the shard that shard_map says is read
+    for path in ('/', '/all'):
+        response = client.get(path)
+        assert response.data.count(b'<article') == 1
+        assert b'edited' in response.data
+
+    # the copy's old body is still in shard 0's search index
+    assert b'No posts match' in client.get('/search?q=body').data
+
+'''
+    Copies left behind on a shard by a move that was cut short, after
+    shard_map was switched, are deleted by the next rebalance-shards
+    instead of being copied back over the live posts.
+'''
+def test_rebalance_deletes_leftovers(sharded_app, client, auth):
+    add_post(sharded_app, 1, 'kept')
+    add_post(sharded_app, 1, 'deleted')
+    copy_to_shard(sharded_app, 9, 1, 0)
+    copy_to_shard(sharded_app, 17, 1, 0)
+
+    auth.login()
+    client.post('/9/update', data={'title': 'edited', 'body': 'edited'})
+    client.post('/17/delete')
+
+    result = sharded_app.test_cli_runner().invoke(args=['rebalance-shards'])
+    assert 'Moved 0 posts.' in result.output
+    assert 'Deleted 2 copies' in result.output
+
+    assert shard_posts(sharded_app, 0) == []
+    assert shard_posts(sharded_app, 1) == [(9, 1, 'test', 'edited')]
+
+def test_coherence_opens_shards_for_post_hooks(make_sharded_app):
+    app = make_sharded_app(3, CACHE_COHERENCE=True)
+    shard_database(app)
+    client = app.test_client()
+
+    # only the user cache is listening, so the shards are left closed
+    with client:
+        client.get('/auth/login')
+        assert not g.get('shard_dbs')
+
+    calls = []
+    get_invalidation_hooks('post', app).append(calls.append)
+
+    with client:
+        client.get('/auth/login')
+        assert len(g.shard_dbs) == 3
+
+    assert calls == ['post']
+
+    # DATABASE's stale post row doesn't make idle requests look like changes
+    client.get('/auth/login')
+    client.get('/')
+    assert calls == ['post']
+
+    add_post(app, 1, 'new')
+    client.get('/')
+    assert calls == ['post', 'post']
+
+
+'''
+    Adding a shard and running rebalance-shards moves just enough buckets
+    onto it, after which every post is on the shard shard_map says.
+'''
+def test_plan_buckets():
+    current = {bucket: bucket % 2 for bucket in range(8)}
+    plan = plan_buckets(current, 3, 8)
+
+    assert [list(plan.values()).count(shard) for shard in range(3)] == [3, 3, 2]
+    assert {b for b in plan if plan[b] != current[b]} == {6, 7}
+
+def test_rebalance_shards(make_sharded_app):
+    app = make_sharded_app(2)
+    shard_database(app, users=6)
+    ids = [add_post(app, author, f'post by {author}') for author in range(1, 7)]
+
+    app = make_sharded_app(3)
+    runner = app.test_cli_runner()
+
+    result = runner.invoke(args=['rebalance-shards', '--dry-run'])
+    assert 'bucket 6: shard 0 -> 2' in result.output
+    assert 'bucket 7: shard 1 -> 2' in result.output
+    assert 'Moved' not in result.output
+
+    result = runner.invoke(args=['rebalance-shards', '--batch-size', '1'])
+    assert 'Moved 1 posts.' in result.output
+
+    with app.app_context():
+        shard_map = dict(
+            tuple(row) for row in get_db().execute('SELECT bucket, shard FROM shard_map')
+        )
+
+    assert [list(shard_map.values()).count(shard) for shard in range(3)] == [3, 3, 2]
+
+    for shard in range(3):
+        for id, *_ in shard_posts(app, shard):
+            assert shard_map[id % 8] == shard
+
+    assert [post[3] for post in shard_posts(app, 2)] == ['post by 6']
+
+    client = app.test_client()
+
+    for id in ids:
+        assert client.get(f'/{id}').status_code == 200
+
+    assert b'post by 6' in client.get('/search?q=6').data
+    assert client.get('/all').data.count(b'body of post by') == 6
+
+    # a new post in the moved bucket gets a new id on its new shard
+    assert add_post(app, 6, 'after the move') == ids[-1] + 8
+
+    result = runner.invoke(args=['rebalance-shards'])
+    assert 'bucket' not in result.output
+    assert 'Moved 0 posts.' in result.output
+
+def test_rebalance_needs_shards(runner, make_sharded_app):
+    result = runner.invoke(args=['rebalance-shards'])
+    assert 'DATABASE_SHARDS is not set.' in result.output
+
+    shard_database(make_sharded_app(3))
+    result = make_sharded_app(2).test_cli_runner().invoke(args=['rebalance-shards'])
+    assert 'shard_map uses shards 2' in result.output
+
+
+'''
+    Turning sharding on for a database that already has posts: the app
+    answers 503 (but for /hello) until rebalance-shards has moved them
+    onto the shards, with ids in their authors' buckets.
+'''
+def test_shard_existing_posts(app, make_sharded_app):
+    with app.app_context():
+        db = get_db()
+        db.execute('DROP TABLE shard_map')
+        db.commit()
+
+    sharded = make_sharded_app(3)
+
+    response = sharded.test_client().get('/')
+    assert response.status_code == 503
+    assert b'rebalance-shards' in response.data
+    assert sharded.test_client().get('/hello').status_code == 200
+
+    runner = sharded.test_cli_runner()
+    result = runner.invoke(args=['rebalance-shards', '--batch-size', '1'])
+    assert 'Moved 1 posts from DATABASE' in result.output
+
+    # post 1 by author 1, bucket 1, which starts on shard 1
+    assert shard_posts(sharded, 1) == [(9, 1, 'test', 'test title')]
+
+    with sharded.app_context():
+        assert get_db().execute('SELECT COUNT(*) FROM post').fetchone()[0] == 0
+
+    client = sharded.test_client()
+    assert b'test title' in client.get('/').data
+    assert b'test title' in client.get('/9').data
+    assert b'test title' in client.get('/search?q=test').data
+
+def test_unsharded_posts_need_empty_shards(sharded_app):
+    add_post(sharded_app, 1, 'on a shard')
+
+    with sharded_app.app_context():
+        db = get_db()
+        db.execute("INSERT INTO post (title, body, author_id) VALUES ('old', '', 1)")
+        db.commit()
+
+    result = sharded_app.test_cli_runner().invoke(args=['rebalance-shards'])
+    assert 'shard 1 has posts as well' in result.output
+    assert shard_posts(sharded_app, 1) == [(9, 1, 'test', 'on a shard')]
+
+
+'''
+    Exports come from every shard in id order, and imports put each post
+    back on its author's shard, keeping or making ids in its bucket.
+'''
+def test_export_import(sharded_app, tmp_path):
+    add_post(sharded_app, 2, 'second')
+    add_post(sharded_app, 1, 'first')
+    path = str(tmp_path / 'posts.jsonl')
+    runner = sharded_app.test_cli_runner()
+
+    result = runner.invoke(args=['export-posts', path])
+    assert '2 rows' in result.output
+
+    with sharded_app.app_context():
+        for index in range(3):
+            get_shard_db(index).execute('DELETE FROM post')
+            get_shard_db(index).commit()
+
+    runner.invoke(args=['import-posts', path])
+    assert shard_posts(sharded_app, 1) == [(9, 1, 'test', 'first')]
+    assert shard_posts(sharded_app, 2) == [(10, 2, 'other', 'second')]
+
+    with open(path) as f:
+        lines = f.read().replace('"id": 9', '"id": 10', 1)
+
+    with open(path, 'w') as f:
+        f.write(lines)
+
+    result = runner.invoke(args=['import-posts', path])
+    assert "isn't in its author's shard bucket" in result.output
@@ -0,0 +1,50 @@
+import pytest
+
+from flaskr import create_app
+from flaskr.db import get_db, init_db
+
+
+@pytest.fixture
+def cached_app(make_app, tmp_path):
+    return make_app(
+        TEMPLATE_BYTECODE_CACHE='filesystem',
+        TEMPLATE_BYTECODE_CACHE_DIR=str(tmp_path / 'jinja_cache'),
+    )
+
+def test_no_cache_by_default(app, runner):
+    assert app.jinja_env.bytecode_cache is None
+
+    result = runner.invoke(args=['precompile-templates'])
+    assert 'TEMPLATE_BYTECODE_CACHE is not set' in result.output
+
+'''
+    After precompile-templates, a new app using the same cache directory
+    should render without compiling anything.
+'''
+def test_precompile_templates(cached_app, tmp_path, monkeypatch):
+    result = cached_app.test_cli_runner().invoke(args=['precompile-templates'])
+    count = len(cached_app.jinja_env.list_templates())
+    assert f'Compiled {count} templates.' in result.output
+    assert len(list((tmp_path / 'jinja_cache').iterdir())) == count
+
+    fresh_app = create_app(cached_app.config)
+
+    def compile(*args, **kwargs):
+        raise AssertionError('template was compiled')
+
+    monkeypatch.setattr(fresh_app.jinja_env, 'compile', compile)
+    assert b'test title' in fresh_app.test_client().get('/').data
+
+def test_unknown_cache(make_app):
+    with pytest.raises(ValueError, match='memory'):
+        make_app(TEMPLATE_BYTECODE_CACHE='memory')
+
+def test_init_db_creates_folder(tmp_path):
+    database = tmp_path / 'instance' / 'flaskr.sqlite'
+    app = create_app({'TESTING': True, 'DATABASE': str(database)})
+
+    with app.app_context():
+        init_db()
+        assert get_db().execute('SELECT COUNT(*) FROM post').fetchone()[0] == 0
+
+    assert database.exists()
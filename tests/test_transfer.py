@@ -0,0 +1,81 @@
+import json
+
+import pytest
+from flaskr.db import get_db
+
+
+''' 
+    Exporting and importing should round trip posts through both JSONL and
+    CSV, with the same ids and content.
+'''
+@pytest.mark.parametrize('filename', ('posts.jsonl', 'posts.csv'))
+def test_export_import_posts(runner, app, tmp_path, filename):
+    path = str(tmp_path / filename)
+    result = runner.invoke(args=['export-posts', path])
+    assert result.exit_code == 0
+    assert '1 rows' in result.output
+
+    with app.app_context():
+        db = get_db()
+        db.execute('DELETE FROM post')
+        db.commit()
+
+    result = runner.invoke(args=['import-posts', path, '--batch-size', '1'])
+    assert result.exit_code == 0
+
+    with app.app_context():
+        post = get_db().execute('SELECT * FROM post').fetchone()
+        assert post['id'] == 1
+        assert post['title'] == 'test title'
+        assert post['body'] == 'test\nbody'
+
+
+def test_export_users_stdout(runner):
+    result = runner.invoke(args=['export-users', '-'])
+    lines = [l for l in result.output.splitlines() if l.startswith('{')]
+    assert [json.loads(l)['username'] for l in lines] == ['test', 'other']
+
+
+''' 
+    When a batch fails, the batches before it should stay committed and a
+    second run should start after them rather than from the beginning.
+'''
+def test_import_resumes(runner, app, tmp_path):
+    path = tmp_path / 'posts.jsonl'
+    records = [
+        {'title': 'a', 'body': '', 'author_id': 1},
+        {'title': 'b', 'body': '', 'author_id': 1},
+        {'title': None, 'body': '', 'author_id': 1},
+        {'title': 'd', 'body': '', 'author_id': 1},
+    ]
+    path.write_text('\n'.join(json.dumps(r) for r in records))
+
+    result = runner.invoke(args=['import-posts', str(path), '--batch-size', '2'])
+    assert result.exit_code != 0
+
+    with app.app_context():
+        assert get_db().execute('SELECT COUNT(*) FROM post').fetchone()[0] == 3
+
+    records[2]['title'] = 'c'
+    path.write_text('\n'.join(json.dumps(r) for r in records))
+
+    result = runner.invoke(args=['import-posts', str(path), '--batch-size', '2'])
+    assert result.exit_code == 0
+    assert 'Resuming after 2 rows' in result.output
+
+    with app.app_context():
+        db = get_db()
+        titles = [r['title'] for r in db.execute(
+            'SELECT title FROM post WHERE id > 1 ORDER BY id'
+        )]
+        assert titles == ['a', 'b', 'c', 'd']
+        assert db.execute('SELECT * FROM import_progress').fetchone() is None
+
+
+def test_import_unknown_column(runner, tmp_path):
+    path = tmp_path / 'posts.jsonl'
+    path.write_text(json.dumps({'title': 'a', 'colour': 'red'}))
+
+    result = runner.invoke(args=['import-posts', str(path)])
+    assert result.exit_code != 0
+    assert 'Unknown post columns: colour' in result.output
@@ -0,0 +1,150 @@
+import concurrent.futures
+import json
+import sqlite3
+
+import pytest
+
+from flaskr.db import get_db, get_statement_hooks, log_statement
+from flaskr.writer import GroupCommitWriter, get_writer, write
+
+
+@pytest.fixture
+def batched_app(make_app):
+    return make_app(WRITE_BATCH_WINDOW=0.001)
+
+def test_writer_off_by_default(app):
+    with app.app_context():
+        assert get_writer() is None
+
+def test_views_write_through_writer(batched_app):
+    client = batched_app.test_client()
+    client.post('/auth/register', data={'username': 'a', 'password': 'a'})
+
+    response = client.post(
+        '/auth/register', data={'username': 'a', 'password': 'a'}
+    )
+    assert b'already registered' in response.data
+
+    client.post('/auth/login', data={'username': 'a', 'password': 'a'})
+    client.post('/create', data={'title': 'batched', 'body': ''})
+
+    with batched_app.app_context():
+        assert get_db().execute(
+            "SELECT COUNT(id) FROM post WHERE title = 'batched'"
+        ).fetchone()[0] == 1
+
+    # both registers and the create, the failed register wasn't counted
+    assert batched_app.extensions['flaskr.writer'].stats()['writes'] == 2
+
+'''
+    Writes queued within the window go in one transaction. The duplicate
+    username fails on its own and the writes around it still commit.
+'''
+def test_group_commit(app):
+    writer = GroupCommitWriter(app, window=0.5)
+    insert = 'INSERT INTO user (username, password) VALUES (?, ?)'
+
+    try:
+        futures = [
+            writer.submit(insert, ('a', 'x')),
+            writer.submit(insert, ('test', 'x')),
+            writer.submit(insert, ('b', 'x')),
+        ]
+
+        assert futures[0].result() > 2
+        with pytest.raises(sqlite3.IntegrityError):
+            futures[1].result()
+        assert futures[2].result() == futures[0].result() + 1
+    finally:
+        writer.close()
+
+    assert writer.stats() == {'batches': 1, 'writes': 2}
+
+    with app.app_context():
+        assert get_db().execute(
+            "SELECT COUNT(id) FROM user WHERE username IN ('a', 'b')"
+        ).fetchone()[0] == 2
+
+'''
+    A write whose statement hook raises fails on its own, an error that
+    fails the whole batch reaches every write in it, and the writer keeps
+    going after both.
+'''
+class Stop(BaseException):
+    pass
+
+def test_writer_survives_errors(app):
+    def hook(sql, parameters, seconds):
+        if 'raise' in sql:
+            raise ValueError(sql)
+        if 'stop' in sql:
+            raise Stop(sql)
+
+    get_statement_hooks(app).append(hook)
+    writer = GroupCommitWriter(app, window=0.5)
+    update = "UPDATE post SET title = '{}'"
+
+    try:
+        failed, committed = (
+            writer.submit(update.format('raise')),
+            writer.submit(update.format('committed')),
+        )
+        with pytest.raises(ValueError):
+            failed.result(timeout=5)
+        committed.result(timeout=5)
+
+        futures = [writer.submit(update.format(title))
+                   for title in ('lost', 'stop')]
+        for future in futures:
+            with pytest.raises(Stop):
+                future.result(timeout=5)
+
+        writer.submit(update.format('after')).result(timeout=5)
+    finally:
+        writer.close()
+
+    assert writer.stats() == {'batches': 2, 'writes': 2}
+
+    with app.app_context():
+        assert get_db().execute(
+            'SELECT title FROM post'
+        ).fetchone()[0] == 'after'
+
+def test_write_timeout(batched_app, monkeypatch):
+    batched_app.config['WRITE_BATCH_TIMEOUT'] = 0.01
+    monkeypatch.setattr(GroupCommitWriter, '_start', lambda self: None)
+
+    with batched_app.app_context():
+        with pytest.raises(concurrent.futures.TimeoutError):
+            write('UPDATE post SET version = version + 1')
+
+def test_max_batch(app):
+    writer = GroupCommitWriter(app, window=0.5, max_batch=2)
+
+    try:
+        futures = [
+            writer.submit('UPDATE post SET version = version + 1')
+            for _ in range(3)
+        ]
+        for future in futures:
+            future.result()
+    finally:
+        writer.close()
+
+    assert writer.stats() == {'batches': 2, 'writes': 3}
+
+def test_writes_logged(batched_app, caplog):
+    batched_app.config['SLOW_QUERY_THRESHOLD'] = 0
+    get_statement_hooks(batched_app).append(log_statement)
+    client = batched_app.test_client()
+
+    with caplog.at_level('WARNING', logger='flaskr.db'):
+        client.post('/auth/register', data={'username': 'a', 'password': 'a'})
+
+    events = [json.loads(r.getMessage()) for r in caplog.records]
+    assert any(
+        e['endpoint'] == 'auth.register' and e['sql'].startswith('INSERT INTO user')
+        for e in events
+    )
+    # the writer's own BEGIN and SAVEPOINTs aren't from any request
+    assert not any(e['sql'].startswith('SAVEPOINT') for e in events)